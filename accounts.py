@@ -0,0 +1,272 @@
+"""
+Accounts Module
+Registry of the ClasseViva accounts to monitor and the scheduler polling them
+Every account has its own monitor, session cache and state; polls run on a
+shared thread pool with a concurrency cap and start times spread over the
+check interval
+"""
+
+import os
+import json
+import time
+import heapq
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from dedupe_index import DedupeIndex
+from state_store import create_state_store
+from config import ACCOUNTS_FILE, ACCOUNTS_DIR, POLL_CONCURRENCY, STATE_BACKEND
+
+logger = logging.getLogger(__name__)
+
+
+class PollFailed(Exception):
+    """Raised when a poll could not fetch the communications (ClasseViva down, login refused)"""
+
+
+class Account(NamedTuple):
+    """A ClasseViva account and the files holding its state"""
+    name: str
+    username: str
+    password: str
+    state_file: str
+    state_db_file: str
+    session_cache_file: str
+
+
+def account_for(name: str, username: str, password: str, root: str = ACCOUNTS_DIR) -> Account:
+    """Account whose files live in root/name/"""
+    directory = os.path.join(root, name)
+    return Account(name, username, password,
+                   state_file=os.path.join(directory, "state.json"),
+                   state_db_file=os.path.join(directory, "state.db"),
+                   session_cache_file=os.path.join(directory, "session_cache.json"))
+
+
+def load_accounts(path: str = ACCOUNTS_FILE, default: Optional[Account] = None,
+                  root: str = ACCOUNTS_DIR) -> List[Account]:
+    """
+    Read the accounts file: a JSON list of {"name", "username", "password"}
+    
+    Args:
+        path: Accounts file
+        default: Account monitored when the file does not exist
+        root: Directory holding one subdirectory of state per account
+    
+    Returns:
+        List of accounts
+    
+    Raises:
+        ValueError: If the file is malformed or names an account twice
+    """
+    if not os.path.exists(path):
+        return [default] if default else []
+    
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    
+    accounts = []
+    for entry in entries:
+        try:
+            accounts.append(account_for(entry['name'], entry['username'], entry['password'], root))
+        except (KeyError, TypeError):
+            raise ValueError(f"Invalid account entry in {path}: {entry!r}")
+    
+    names = [account.name for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate account names in {path}")
+    return accounts
+
+
+class AccountPoller:
+    """
+    One monitored account: its monitor and the state it polls with
+    
+    Args:
+        account: The account
+        monitor: ClasseVivaMonitor logged in as the account
+        store: State backend of the account (see create_state_store)
+    """
+    
+    def __init__(self, account: Account, monitor, store=None):
+        self.account = account
+        self.monitor = monitor
+        if store is None:
+            os.makedirs(os.path.dirname(account.state_file) or ".", exist_ok=True)
+            store = create_state_store(STATE_BACKEND, account.state_file, account.state_db_file)
+        self.store = store
+        monitor.state_store = store
+        self.state = self._load()
+        self.first_run = len(self.state.get('sent_hashes', [])) == 0
+        self.polls = 0
+        self.errors = 0
+    
+    @property
+    def name(self) -> str:
+        return self.account.name
+    
+    def _load(self) -> Dict:
+        """Load the account's state, starting empty if it is unreadable"""
+        try:
+            return self.store.load()
+        except Exception as e:
+            logger.warning(f"State of account {self.account.name} unreadable, starting empty: {e}")
+            return {'sent_hashes': DedupeIndex()}
+    
+    def poll(self) -> int:
+        """
+        Check the account for new communications
+        
+        Returns:
+            Number of new communications processed
+        
+        Raises:
+            PollFailed: If the communications could not be fetched
+        """
+        try:
+            new_count = self.monitor.check_updates(self.state, is_first_run=self.first_run)
+            # check_updates() reports a failed request as "nothing new"
+            if not self.monitor.last_poll_ok:
+                raise PollFailed(f"communications of {self.account.name} could not be fetched")
+        except Exception:
+            self.errors += 1
+            raise
+        self.first_run = False
+        self.polls += 1
+        return new_count
+    
+    def close(self):
+        """Release the state backend"""
+        self.store.close()
+
+
+class PollScheduler:
+    """
+    Polls many accounts on a shared thread pool
+    
+    Accounts start interval / len(pollers) apart and keep that spacing,
+    at most max_concurrent polls run at a time, and an account is never
+    polled again before its previous poll has finished.
+    
+    Args:
+        pollers: Objects with a poll() method (AccountPoller)
+        interval: Seconds between two polls of the same account
+        max_concurrent: Polls running at the same time
+        on_result: Called after every poll with (poller, new count, exception or None)
+        clock: Monotonic time source
+        make_policy: Builds one interval policy per account (see polling.AdaptiveInterval);
+                     without it every account is polled every interval seconds
+    """
+    
+    def __init__(self, pollers: List, interval: float, max_concurrent: int = POLL_CONCURRENCY,
+                 on_result: Optional[Callable] = None, clock: Callable[[], float] = time.monotonic,
+                 make_policy: Optional[Callable] = None):
+        self.pollers = pollers
+        self.interval = interval
+        self.max_concurrent = max_concurrent
+        self.on_result = on_result
+        self.clock = clock
+        self.policies = [make_policy() for _ in pollers] if make_policy else None
+        self.running = 0
+        self.max_running = 0
+        self._started_at: Optional[float] = None
+        self._poll_times: deque = deque()
+        self._due: List = []
+        self._cond = threading.Condition()
+        self._stopped = False
+    
+    def next_interval(self, index: int, new_count: int, error: Optional[Exception]) -> float:
+        """Seconds until the next poll of an account"""
+        if self.policies is None:
+            return self.interval
+        return self.policies[index].next_interval(new_count, error)
+    
+    def polls_per_day(self) -> float:
+        """Polls of all accounts in the last 24 hours, extrapolated while younger than a day"""
+        with self._cond:
+            if self._started_at is None:
+                return 0.0
+            now = self.clock()
+            while self._poll_times and self._poll_times[0] < now - 86400:
+                self._poll_times.popleft()
+            elapsed = min(max(now - self._started_at, 1.0), 86400)
+            return len(self._poll_times) * 86400 / elapsed
+    
+    def stop(self):
+        """Stop scheduling; polls already running are finished"""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+    
+    def run(self, max_polls: Optional[int] = None):
+        """
+        Poll until stop() is called
+        
+        Args:
+            max_polls: Return after starting this many polls (for tests)
+        """
+        start = self.clock()
+        step = self.interval / max(len(self.pollers), 1)
+        with self._cond:
+            self._started_at = start
+            self._due = [(start + index * step, index) for index in range(len(self.pollers))]
+            heapq.heapify(self._due)
+        
+        started = 0
+        with ThreadPoolExecutor(max_workers=self.max_concurrent, thread_name_prefix="poll") as pool:
+            while max_polls is None or started < max_polls:
+                with self._cond:
+                    while not self._stopped:
+                        wait = self._due[0][0] - self.clock() if self._due else None
+                        if wait is not None and wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    if self._stopped:
+                        break
+                    due, index = heapq.heappop(self._due)
+                
+                pool.submit(self._poll, index, due)
+                started += 1
+    
+    def _poll(self, index: int, due: float):
+        """Run one poll and schedule the account's next one"""
+        poller = self.pollers[index]
+        with self._cond:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            self._poll_times.append(self.clock())
+        
+        new_count, error = 0, None
+        try:
+            new_count = poller.poll()
+        except Exception as e:
+            error = e
+            logger.error(f"Poll of {getattr(poller, 'name', index)} failed: {e}")
+        finally:
+            with self._cond:
+                self.running -= 1
+                # Keep the account's slot in the stagger unless the poll overran it
+                delay = self.next_interval(index, new_count, error)
+                heapq.heappush(self._due, (max(due + delay, self.clock()), index))
+                self._cond.notify_all()
+        
+        if self.on_result:
+            self.on_result(poller, new_count, error)
+
+
+def deliver_via(pollers: List[AccountPoller]) -> Callable:
+    """
+    Outbox delivery callback for several accounts
+    Queued attachments are downloaded again by the account that saw them
+    """
+    monitors = {poller.name: poller.monitor for poller in pollers}
+    fallback = pollers[0].monitor
+    
+    def deliver(entry) -> bool:
+        account = entry.attachments[0].get('account') if entry.attachments else None
+        return monitors.get(account, fallback).deliver(entry)
+    
+    return deliver
@@ -0,0 +1,662 @@
+"""
+Async Engine Module
+asyncio version of the monitor loop (enabled with ASYNC_ENGINE in config.py)
+ClasseViva polling, attachment downloads and Telegram sends share one
+event loop and one aiohttp connection pool instead of worker threads
+
+The notifier, ClasseVivaMonitor and the state functions come from the
+module that starts the engine (monitor or bot), see run_async()
+"""
+
+import json
+import time
+import asyncio
+import hashlib
+from datetime import datetime
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+
+import aiohttp
+import pytz
+from colorama import Fore, Style
+
+import json_codec
+from accounts import PollFailed
+from attachments import Attachment, AttachmentCache, AttachmentTooLarge, stream_response_async
+from class_detector import ClassDetector
+from polling import AdaptiveInterval
+from session_manager import SessionManager, is_auth_failure, LOGIN_PAGE_PEEK
+from state_store import ensure_sent_index
+from config import DOWNLOAD_WORKERS, PIPELINE_QUEUE_SIZE, TELEGRAM_SEND_ATTEMPTS
+
+CLASSEVIVA_URL = "https://web.spaggiari.eu"
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+ITALIAN_TZ = pytz.timezone('Europe/Rome')
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Same headers as the synchronous client
+LOGIN_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'X-Requested-With': 'XMLHttpRequest',
+    'Origin': 'https://web.spaggiari.eu',
+    'Referer': 'https://web.spaggiari.eu/auth-p7/app/default/login.php',
+    'Cache-Control': 'no-cache',
+    'Pragma': 'no-cache'
+}
+
+API_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'Accept-Language': 'it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7',
+    'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
+    'X-Requested-With': 'XMLHttpRequest',
+    'Origin': 'https://web.spaggiari.eu',
+    'Referer': 'https://web.spaggiari.eu/sif/app/default/bacheca_personale.php'
+}
+
+
+def log_colored(message: str, color: str = Fore.WHITE):
+    """Log with color and Italian timezone timestamp"""
+    now = datetime.now(ITALIAN_TZ)
+    timestamp = now.strftime('[%Y-%m-%d %H:%M:%S]')
+    print(f"{timestamp} {color}{message}{Style.RESET_ALL}")
+
+
+class AsyncClasseVivaClient:
+    """
+    ClasseViva client for the asyncio engine
+    Mirrors ClasseVivaMonitor.login(), get_communications() and
+    download_attachment() on top of an aiohttp.ClientSession
+    """
+    
+    def __init__(self, username: str, password: str, http: aiohttp.ClientSession,
+                 base_url: str = CLASSEVIVA_URL, session_cache_file: Optional[str] = None,
+                 attachment_cache: Optional[AttachmentCache] = None):
+        self.username = username
+        self.password = password
+        self.http = http
+        self.base_url = base_url.rstrip('/')
+        self.attachment_cache = attachment_cache
+        self.phpsessid = None
+        self.webidentity = None
+        self.auth_expired = False
+        self.last_fetch_ok = False
+        self.session_manager = SessionManager(cache_file=session_cache_file)
+        self._session_cache_checked = False
+        self._downloads = asyncio.Semaphore(DOWNLOAD_WORKERS)
+    
+    def _cookie_header(self) -> Dict[str, str]:
+        """Session cookies sent explicitly, like the synchronous client does"""
+        return {'Cookie': f"PHPSESSID={self.phpsessid}; webidentity={self.webidentity}"}
+    
+    async def login(self) -> bool:
+        """Authenticate with ClasseViva"""
+        try:
+            log_colored("LOGIN: Tentativo di login...", Fore.CYAN)
+            self.phpsessid = None
+            
+            url = f"{self.base_url}/auth-p7/app/default/AuthApi4.php?a=aLoginPwd"
+            payload = {
+                'uid': self.username,
+                'pwd': self.password,
+                'cid': '',
+                'pin': '',
+                'target': ''
+            }
+            
+            async with self.http.post(url, data=payload, headers=LOGIN_HEADERS,
+                                      timeout=aiohttp.ClientTimeout(total=30)) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None, loads=json_codec.loads)
+                cookies = {name: morsel.value for name, morsel in response.cookies.items()}
+            
+            if not data or data.get('error'):
+                error = data.get('error', 'Unknown error') if isinstance(data, dict) else 'Unknown error'
+                log_colored(f"ERRORE: Login fallito - {error}", Fore.RED)
+                return False
+            
+            self.phpsessid = cookies.get('PHPSESSID')
+            self.webidentity = cookies.get('webidentity')
+            
+            # Some accounts only get webidentity in the JSON body (type + id + 'W')
+            if not self.webidentity:
+                try:
+                    account = data['data']['auth']['accountInfo']
+                    self.webidentity = f"{account['type']}{account['id']}W"
+                except (KeyError, TypeError):
+                    pass
+            
+            if not self.phpsessid or not self.webidentity:
+                log_colored("ERRORE: Login fallito - cookie di sessione mancanti", Fore.RED)
+                return False
+            
+            log_colored("LOGIN: Login riuscito!", Fore.GREEN)
+            return True
+        
+        except Exception as e:
+            log_colored(f"ERRORE: Login fallito - {str(e)}", Fore.RED)
+            return False
+    
+    async def get_communications(self, ncna: int = 1) -> List[Dict]:
+        """
+        Retrieve communications from ClasseViva
+        
+        Args:
+            ncna: 0 = get all, 1 = get only new
+        """
+        self.auth_expired = False
+        self.last_fetch_ok = False
+        
+        if not self.phpsessid or not self.webidentity:
+            log_colored("ERRORE: Non autenticato. Eseguire login() prima.", Fore.RED)
+            return []
+        
+        try:
+            log_colored("API: Recupero comunicazioni...", Fore.CYAN)
+            
+            url = f"{self.base_url}/sif/app/default/bacheca_personale.php"
+            payload = {
+                'action': 'get_comunicazioni',
+                'cerca': '',
+                'ncna': str(ncna),
+                'tipo_com': ''
+            }
+            
+            async with self.http.post(url, data=payload, headers={**API_HEADERS, **self._cookie_header()},
+                                      timeout=aiohttp.ClientTimeout(total=30)) as response:
+                body = await response.read()
+                # Expired sessions come back as 401/403 or a login page
+                if is_auth_failure(response, body):
+                    self.auth_expired = True
+                    log_colored("SESSIONE: Sessione scaduta o rifiutata", Fore.YELLOW)
+                    return []
+                
+                response.raise_for_status()
+            
+            try:
+                data = json_codec.loads(body)
+            except ValueError:
+                # Not the API answer: log in again before trusting the session
+                self.auth_expired = True
+                log_colored("SESSIONE: Risposta non valida, nuovo login", Fore.YELLOW)
+                return []
+            
+            # Extract communications from response
+            communications = []
+            if isinstance(data, dict):
+                if 'data' in data:
+                    communications = data['data']
+                elif 'comunicazioni' in data:
+                    communications = data['comunicazioni']
+            elif isinstance(data, list):
+                communications = data
+            
+            self.last_fetch_ok = True
+            log_colored(f"API: Recuperate {len(communications)} comunicazioni", Fore.GREEN)
+            return communications
+        
+        except Exception as e:
+            log_colored(f"ERRORE: Recupero comunicazioni fallito - {str(e)}", Fore.RED)
+            return []
+    
+    async def fetch_communications(self, ncna: int = 1) -> List[Dict]:
+        """
+        Retrieve communications reusing the authenticated session
+        Same policy as ClasseVivaMonitor.fetch_communications()
+        
+        Args:
+            ncna: 0 = get all, 1 = get only new
+        """
+        if not self._session_cache_checked:
+            self._session_cache_checked = True
+            if self.session_manager.restore(self):
+                log_colored("SESSIONE: Sessione ripristinata dalla cache", Fore.CYAN)
+        
+        if not await self.session_manager.ensure_async(self):
+            return []
+        
+        communications = await self.get_communications(ncna=ncna)
+        
+        if self.auth_expired:
+            self.session_manager.invalidate("auth")
+            if not await self.session_manager.login_async(self):
+                return []
+            communications = await self.get_communications(ncna=ncna)
+        
+        return communications
+    
+    async def download_attachment(self, attachment_id: str, filename: str) -> Optional[Attachment]:
+        """
+        Download attachment into a spooled buffer
+        At most DOWNLOAD_WORKERS downloads run at the same time
+        Returns the Attachment (caller must close it) or None if failed
+        """
+        cached = self.attachment_cache.get(attachment_id) if self.attachment_cache else None
+        if cached is not None:
+            log_colored(f"DOWNLOAD: {filename} dalla cache", Fore.GREEN)
+            return Attachment.from_bytes(filename, cached)
+        
+        if not self.phpsessid or not self.webidentity:
+            log_colored("ERRORE: Non autenticato.", Fore.RED)
+            return None
+        
+        attachment = Attachment(filename)
+        try:
+            async with self._downloads:
+                log_colored(f"DOWNLOAD: Scaricamento {filename}...", Fore.CYAN)
+                url = f"{self.base_url}/sif/app/default/bacheca_personale.php"
+                params = {'action': 'download', 'id': attachment_id}
+                headers = {'User-Agent': USER_AGENT, **self._cookie_header()}
+                
+                async with self.http.get(url, params=params, headers=headers,
+                                         timeout=aiohttp.ClientTimeout(total=60)) as response:
+                    # The login page of an expired session must never reach the cache
+                    html = 'text/html' in response.headers.get('Content-Type', '')
+                    start = await response.content.read(LOGIN_PAGE_PEEK) if html else None
+                    if is_auth_failure(response, start):
+                        raise ValueError("sessione scaduta")
+                    response.raise_for_status()
+                    if html:
+                        raise ValueError("pagina HTML al posto dell'allegato")
+                    await stream_response_async(response, attachment.file)
+            
+            if self.attachment_cache:
+                self.attachment_cache.put(attachment_id, attachment.file)
+            
+            log_colored(f"DOWNLOAD: Scaricato {filename}", Fore.GREEN)
+            return attachment
+        
+        except AttachmentTooLarge as e:
+            log_colored(f"ERRORE: Allegato {filename} troppo grande - {str(e)}", Fore.YELLOW)
+        except Exception as e:
+            log_colored(f"ERRORE: Download allegato fallito - {str(e)}", Fore.RED)
+        
+        attachment.close()
+        return None
+
+
+class AsyncTelegramNotifier:
+    """
+    Telegram notification sender for the asyncio engine
+    Wraps the caller's TelegramNotifier: message formatting, the file_id
+    cache and the rate limiter are its own, only the transport is aiohttp
+    """
+    
+    def __init__(self, notifier, http: aiohttp.ClientSession, api_url: str = TELEGRAM_API_URL):
+        self.notifier = notifier
+        self.chat_id = notifier.chat_id
+        self.http = http
+        self.base_url = f"{api_url.rstrip('/')}/bot{notifier.bot_token}"
+        self.rate_limiter = notifier.rate_limiter
+    
+    def __getattr__(self, name: str):
+        # format_communication(), build_media(), the file_id helpers, ...
+        return getattr(self.notifier, name)
+    
+    def close(self):
+        """Close the wrapped notifier, the aiohttp session is owned by run_async()"""
+        self.notifier.close()
+    
+    async def _post(self, method: str, timeout: int, json: Optional[Dict] = None,
+                    fields: Optional[List[Tuple[str, object, Optional[str]]]] = None):
+        """
+        Call a Bot API method within the rate limits, rescheduling on 429
+        
+        Args:
+            method: Bot API method
+            timeout: Request timeout in seconds
+            json: JSON body
+            fields: Multipart fields as (name, value, filename or None)
+        
+        Returns:
+            The result field of the answer
+        """
+        url = f"{self.base_url}/{method}"
+        for attempt in range(1, TELEGRAM_SEND_ATTEMPTS + 1):
+            wait = self.rate_limiter.reserve(self.chat_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+            
+            # A FormData can only be sent once, build it for every attempt
+            data = None
+            if fields is not None:
+                data = aiohttp.FormData()
+                for name, value, filename in fields:
+                    data.add_field(name, value, filename=filename)
+            
+            async with self.http.post(url, json=json, data=data,
+                                      timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status != 429 or attempt == TELEGRAM_SEND_ATTEMPTS:
+                    if response.status >= 400:
+                        # Keep Telegram's description, the senders look at it
+                        try:
+                            description = str((await response.json(content_type=None)).get('description', ''))
+                        except (ValueError, AttributeError, aiohttp.ContentTypeError):
+                            description = response.reason or ""
+                        raise aiohttp.ClientResponseError(response.request_info, response.history,
+                                                          status=response.status, message=description,
+                                                          headers=response.headers)
+                    return (await response.json(content_type=None)).get('result')
+                
+                try:
+                    retry_after = float((await response.json(content_type=None))['parameters']['retry_after'])
+                except (ValueError, KeyError, TypeError):
+                    retry_after = float(response.headers.get('Retry-After', 1))
+            
+            log_colored(f"TELEGRAM: Limite raggiunto, nuovo tentativo tra {retry_after}s", Fore.YELLOW)
+            self.rate_limiter.pause(self.chat_id, retry_after)
+    
+    async def send_message(self, text: str) -> bool:
+        """Send a text message to Telegram"""
+        try:
+            await self._post('sendMessage', 10, json={
+                'chat_id': self.chat_id,
+                'text': text,
+                'parse_mode': 'HTML'
+            })
+            log_colored("TELEGRAM: Messaggio inviato", Fore.GREEN)
+            return True
+        except Exception as e:
+            log_colored(f"ERRORE: Invio messaggio Telegram fallito - {str(e)}", Fore.RED)
+            return False
+    
+    async def send_document(self, document: Attachment, caption: str = "") -> bool:
+        """Send a document to Telegram, by file_id if it was uploaded before"""
+        try:
+            fields = [
+                ('chat_id', str(self.chat_id), None),
+                ('caption', caption, None),
+                ('parse_mode', 'HTML', None),
+            ]
+            file_id = self.cached_file_id(document)
+            if file_id:
+                try:
+                    await self._post('sendDocument', 30, fields=fields + [('document', file_id, None)])
+                    log_colored(f"TELEGRAM: Documento inviato ({document.filename}, già caricato)", Fore.GREEN)
+                    return True
+                except aiohttp.ClientResponseError as e:
+                    # Other 400s (caption too long, bad HTML, ...) would fail the upload too
+                    if not self.stale_file_id(e.status, e.message):
+                        raise
+                    self.forget_file_ids([document])
+            
+            result = await self._post('sendDocument', 30, fields=fields + [
+                ('document', document.read(), document.filename),
+            ])
+            self.remember_file_ids([document], result)
+            log_colored(f"TELEGRAM: Documento inviato ({document.filename})", Fore.GREEN)
+            return True
+        except Exception as e:
+            log_colored(f"ERRORE: Invio documento Telegram fallito - {str(e)}", Fore.RED)
+            return False
+    
+    async def send_media_group(self, documents: List[Attachment], caption: str = "") -> bool:
+        """Send multiple documents as a media group, uploading only new content"""
+        try:
+            for reuse in (True, False):
+                media, uploads, reused = self.build_media(documents, caption, reuse)
+                fields = [(name, document.read(), document.filename) for name, document in uploads]
+                fields.append(('chat_id', str(self.chat_id), None))
+                fields.append(('media', json.dumps(media), None))
+                
+                try:
+                    result = await self._post('sendMediaGroup', 60, fields=fields)
+                except aiohttp.ClientResponseError as e:
+                    # A stale file_id fails the whole group: upload everything again
+                    if not reused or not self.stale_file_id(e.status, e.message):
+                        raise
+                    self.forget_file_ids(reused)
+                    continue
+                break
+            
+            if uploads:
+                self.remember_file_ids(documents, result)
+            log_colored(f"TELEGRAM: Media group inviato ({len(documents)} file)", Fore.GREEN)
+            return True
+        except Exception as e:
+            log_colored(f"ERRORE: Invio media group Telegram fallito - {str(e)}", Fore.RED)
+            return False
+
+
+class AsyncMonitor:
+    """
+    Poll cycle of the asyncio engine
+    Communications are prepared (downloads + class detection) up to
+    PIPELINE_QUEUE_SIZE ahead of the one being sent, and sent in order
+    
+    Args:
+        client: ClasseViva client
+        notifier: Telegram sender
+        host: Module running the engine (monitor or bot), providing
+              ClasseVivaMonitor and the state functions
+        detector: Class detector
+    """
+    
+    def __init__(self, client: AsyncClasseVivaClient, notifier: AsyncTelegramNotifier,
+                 host: ModuleType, detector: Optional[ClassDetector] = None):
+        self.client = client
+        self.notifier = notifier
+        self.host = host
+        self.detector = detector or ClassDetector()
+        # Whether the last check_updates() could fetch the communications
+        self.last_poll_ok = False
+    
+    async def prepare(self, job: Dict) -> Dict:
+        """Download the attachments of a communication and detect its classes"""
+        comm = job['comm']
+        
+        # Extract text for class detection
+        title = comm.get("evtText", comm.get("titolo", ""))
+        notes = comm.get("notes", comm.get("testo", ""))
+        classes = self.detector.detect_classes_in_text(f"{title} {notes}")
+        
+        attachments = self.host.ClasseVivaMonitor.parse_attachments(comm)
+        
+        # Downloads of one communication overlap; gather keeps their order
+        results = await asyncio.gather(*(self.client.download_attachment(a['id'], a['filename'])
+                                         for a in attachments))
+        job['documents'] = [document for document in results if document is not None]
+        
+        # PDF parsing blocks on a worker process, keep it off the event loop
+        for document in job['documents']:
+            try:
+                classes.update(await asyncio.to_thread(self.detector.detect_classes_in_pdf, document.read()))
+            except Exception as e:
+                log_colored(f"ERRORE: Analisi PDF fallita - {str(e)}", Fore.YELLOW)
+        
+        job['classes'] = classes
+        return job
+    
+    async def notify(self, job: Dict) -> bool:
+        """Send a communication and its attachments to Telegram, True if all sends succeeded"""
+        documents = job['documents']
+        message = self.notifier.format_communication(job['comm'], job['classes'])
+        
+        if documents:
+            if len(documents) == 1:
+                return await self.notifier.send_document(documents[0], caption=message)
+            # Send message first, then media group
+            return (await self.notifier.send_message(message)
+                    and await self.notifier.send_media_group(documents))
+        return await self.notifier.send_message(message)
+    
+    @staticmethod
+    def release_job(job: Dict):
+        """Release the attachment buffers of a communication"""
+        for document in job.get('documents', []):
+            document.close()
+        job['documents'] = []
+    
+    async def check_updates(self, state: Dict, is_first_run: bool = False) -> int:
+        """
+        Check for new communications and send them to Telegram
+        
+        Args:
+            state: Dictionary containing seen communication hashes
+            is_first_run: If True, fetch all but send only latest
+        
+        Returns:
+            Number of new communications processed
+        """
+        communications = await self.client.fetch_communications(ncna=0 if is_first_run else 1)
+        # Kept aside: the retention pass may fetch again
+        self.last_poll_ok = self.client.last_fetch_ok
+        if not communications:
+            return 0
+        
+        sent_hashes = ensure_sent_index(state)
+        comms_to_send = communications[:1] if is_first_run else communications
+        
+        jobs = []
+        queued = set()
+        for comm in comms_to_send:
+            comm_id = comm.get('evtId', comm.get('id', ''))
+            comm_hash = hashlib.md5(str(comm_id).encode()).hexdigest()
+            if comm_hash in sent_hashes or comm_hash in queued:
+                continue
+            queued.add(comm_hash)
+            jobs.append({'comm': comm, 'comm_id': comm_id, 'hash': comm_hash, 'documents': []})
+        
+        new_count = 0
+        tasks: Dict[int, asyncio.Task] = {}
+        try:
+            for i, job in enumerate(jobs):
+                # Keep the next few communications downloading while this one is sent
+                for ahead in range(i, min(i + max(1, PIPELINE_QUEUE_SIZE), len(jobs))):
+                    if ahead not in tasks:
+                        tasks[ahead] = asyncio.create_task(self.prepare(jobs[ahead]))
+                
+                try:
+                    await tasks.pop(i)
+                    if not await self.notify(job):
+                        # Not marked as sent, so the next poll tries again
+                        log_colored(f"TELEGRAM: Invio della comunicazione {job['comm_id']} rimandato", Fore.YELLOW)
+                        continue
+                except Exception as e:
+                    log_colored(f"ERRORE: Elaborazione comunicazione fallita - {str(e)}", Fore.RED)
+                    continue
+                finally:
+                    self.release_job(job)
+                
+                # Mark as sent
+                sent_hashes.add(job['hash'], {
+                    'comm_id': str(job['comm_id']),
+                    'sent_at': time.time(),
+                    'classes': sorted(job['classes'])
+                })
+                new_count += 1
+        finally:
+            # Only reached with pending tasks if the cycle was interrupted
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            for index in tasks:
+                self.release_job(jobs[index])
+        
+        # On first run, save ALL communication hashes (not just the one we sent)
+        if is_first_run:
+            for comm in communications:
+                comm_id = comm.get('evtId', comm.get('id', ''))
+                comm_hash = hashlib.md5(str(comm_id).encode()).hexdigest()
+                sent_hashes.add(comm_hash, {'comm_id': str(comm_id), 'sent_at': time.time()})
+        
+        await self.apply_retention(state, listing=communications if is_first_run else None)
+        
+        self.host.save_state(state)
+        log_colored(f"STATE: Salvate {len(sent_hashes)} comunicazioni", Fore.GREEN)
+        return new_count
+    
+    async def apply_retention(self, state: Dict, listing: Optional[List[Dict]] = None) -> int:
+        """Same policy as ClasseVivaMonitor.apply_retention()"""
+        now = time.time()
+        if not self.host.retention_due(state, now):
+            return 0
+        
+        communications = listing
+        if communications is None:
+            communications = await self.client.fetch_communications(ncna=0)
+        if not self.client.last_fetch_ok:
+            log_colored("STATE: Pulizia storico rimandata (elenco completo non disponibile)", Fore.YELLOW)
+            return 0
+        
+        return self.host.prune_sent_hashes(state, communications, now)
+    
+    async def run(self, interval: float, cycles: Optional[int] = None,
+                  policy: Optional[AdaptiveInterval] = None):
+        """
+        Poll forever (or for a number of cycles after the first check)
+        
+        Args:
+            interval: Seconds between checks
+            cycles: Stop after this many checks following the first one
+            policy: Interval policy replacing the fixed interval (see polling.AdaptiveInterval)
+        """
+        state = self.host.load_state()
+        is_first_run = len(state.get('sent_hashes', [])) == 0
+        
+        if is_first_run:
+            log_colored("INFO: Prima esecuzione - invio ultima comunicazione", Fore.CYAN)
+        else:
+            log_colored("INFO: Ripresa monitoraggio", Fore.CYAN)
+        
+        done = 0
+        while True:
+            try:
+                new_count, error = await self.poll(state, is_first_run=is_first_run), None
+                if done == 0:
+                    log_colored(f"INFO: Primo controllo completato ({new_count} nuove)", Fore.GREEN)
+                elif new_count > 0:
+                    log_colored(f"INFO: Trovate e inviate {new_count} nuove comunicazioni", Fore.GREEN)
+                else:
+                    log_colored("INFO: Nessuna nuova comunicazione", Fore.CYAN)
+                is_first_run = False
+            except Exception as e:
+                new_count, error = 0, e
+                log_colored(f"ERRORE: Errore nel loop principale - {str(e)}", Fore.RED)
+            
+            if cycles is not None and done >= cycles:
+                break
+            # Failed checks back off like the threaded loop
+            await asyncio.sleep(policy.next_interval(new_count, error) if policy else interval)
+            done += 1
+    
+    async def poll(self, state: Dict, is_first_run: bool = False) -> int:
+        """
+        Run check_updates()
+        
+        Raises:
+            PollFailed: If the communications could not be fetched (or the login failed)
+        """
+        new_count = await self.check_updates(state, is_first_run=is_first_run)
+        # check_updates() reports a failed request as "nothing new"
+        if not self.last_poll_ok:
+            raise PollFailed("communications could not be fetched")
+        return new_count
+
+
+async def run_async(username: str, password: str, notifier, interval: float, host: ModuleType,
+                    session_cache_file: Optional[str] = None,
+                    attachment_cache: Optional[AttachmentCache] = None,
+                    detector: Optional[ClassDetector] = None,
+                    policy: Optional[AdaptiveInterval] = None):
+    """
+    Entry point of the asyncio engine, used by main() when ASYNC_ENGINE is set
+    
+    Args:
+        notifier: The caller's TelegramNotifier, sending through aiohttp from here on
+        host: Module calling this (monitor or bot), so its own classes and state are used
+    """
+    async with aiohttp.ClientSession() as http:
+        client = AsyncClasseVivaClient(username, password, http,
+                                       session_cache_file=session_cache_file,
+                                       attachment_cache=attachment_cache)
+        notifier = AsyncTelegramNotifier(notifier, http)
+        try:
+            await AsyncMonitor(client, notifier, host, detector).run(interval, policy=policy)
+        finally:
+            notifier.close()
@@ -0,0 +1,387 @@
+"""
+Attachment Handling Module
+Spooled attachment buffers, streaming downloads with a size cap, a
+content-addressed on-disk cache for ClasseViva attachments
+(allegato_id + SHA-256, LRU eviction) and the Telegram file_id cache
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from typing import BinaryIO, Dict, Optional, Union
+
+from config import (
+    ATTACHMENT_CACHE_DIR, ATTACHMENT_CACHE_MAX_MB, ATTACHMENT_INDEX_SAVE_INTERVAL,
+    MAX_ATTACHMENT_SIZE_MB, DOWNLOAD_CHUNK_SIZE, ATTACHMENT_SPOOL_MB,
+    FILE_ID_CACHE_FILE, FILE_ID_CACHE_MAX_ENTRIES
+)
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTACHMENT_BYTES = int(MAX_ATTACHMENT_SIZE_MB * 1024 * 1024)
+ATTACHMENT_SPOOL_BYTES = int(ATTACHMENT_SPOOL_MB * 1024 * 1024)
+
+
+class AttachmentTooLarge(Exception):
+    """Raised when a download exceeds the attachment size cap"""
+
+
+class Attachment:
+    """
+    A downloaded attachment held in a spooled buffer
+    Small files stay in memory, larger ones roll over to an anonymous
+    temporary file, so nothing is written under a shared name in /tmp.
+    The same buffer is handed to the class detector and the notifier.
+    """
+    
+    def __init__(self, filename: str, max_memory: int = ATTACHMENT_SPOOL_BYTES):
+        self.filename = filename
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._sha256: Optional[str] = None
+    
+    @classmethod
+    def from_bytes(cls, filename: str, content: bytes) -> 'Attachment':
+        """Wrap already available content (e.g. from the attachment cache)"""
+        attachment = cls(filename)
+        attachment.file.write(content)
+        return attachment
+    
+    @property
+    def size(self) -> int:
+        """Size of the buffered content in bytes"""
+        self.file.seek(0, os.SEEK_END)
+        return self.file.tell()
+    
+    @property
+    def sha256(self) -> str:
+        """SHA-256 of the content, computed once the download is complete"""
+        if self._sha256 is None:
+            digest = hashlib.sha256()
+            file = self.open()
+            for chunk in iter(lambda: file.read(DOWNLOAD_CHUNK_SIZE), b""):
+                digest.update(chunk)
+            self._sha256 = digest.hexdigest()
+        return self._sha256
+    
+    def open(self) -> BinaryIO:
+        """Return the buffer rewound to the start, ready for reading"""
+        self.file.seek(0)
+        return self.file
+    
+    def read(self) -> bytes:
+        """Return the whole content"""
+        return self.open().read()
+    
+    def close(self):
+        """Release the buffer (and its temporary file, if any)"""
+        self.file.close()
+    
+    def __enter__(self) -> 'Attachment':
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def __repr__(self) -> str:
+        return f"Attachment({self.filename!r})"
+
+
+def stream_response(response, dest: BinaryIO, max_bytes: int = MAX_ATTACHMENT_BYTES,
+                    chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+    """
+    Copy a streamed HTTP response body into a file object in chunks
+    Aborts before reading the body if Content-Length is over the cap,
+    and as soon as the received bytes exceed it otherwise
+    
+    Args:
+        response: requests.Response obtained with stream=True
+        dest: Writable binary file object
+        max_bytes: Maximum accepted size
+        chunk_size: Bytes per chunk
+    
+    Returns:
+        Number of bytes written
+    
+    Raises:
+        AttachmentTooLarge: If the body is larger than max_bytes
+    """
+    content_length = response.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise AttachmentTooLarge(f"{int(content_length)} bytes announced, limit is {max_bytes}")
+    
+    total = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        total += len(chunk)
+        if total > max_bytes:
+            raise AttachmentTooLarge(f"more than {max_bytes} bytes received")
+        dest.write(chunk)
+    return total
+
+
+async def stream_response_async(response, dest: BinaryIO, max_bytes: int = MAX_ATTACHMENT_BYTES,
+                                chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+    """
+    Same as stream_response() for an aiohttp.ClientResponse
+    
+    Raises:
+        AttachmentTooLarge: If the body is larger than max_bytes
+    """
+    content_length = response.headers.get('Content-Length', '')
+    if content_length.isdigit() and int(content_length) > max_bytes:
+        raise AttachmentTooLarge(f"{int(content_length)} bytes announced, limit is {max_bytes}")
+    
+    total = 0
+    async for chunk in response.content.iter_chunked(chunk_size):
+        total += len(chunk)
+        if total > max_bytes:
+            raise AttachmentTooLarge(f"more than {max_bytes} bytes received")
+        dest.write(chunk)
+    return total
+
+
+class AttachmentCache:
+    """
+    Stores each distinct attachment once under its SHA-256
+    An index maps allegato_id to the content hash and tracks last use;
+    last use updated by cache hits is written at most every save_interval
+    seconds, and on put() or close()
+    """
+    
+    def __init__(self, directory: str = ATTACHMENT_CACHE_DIR, max_mb: float = ATTACHMENT_CACHE_MAX_MB,
+                 save_interval: float = ATTACHMENT_INDEX_SAVE_INTERVAL):
+        self.directory = directory
+        self.blob_dir = os.path.join(directory, "blobs")
+        self.index_path = os.path.join(directory, "index.json")
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.save_interval = save_interval
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self._by_id: Dict[str, str] = {}
+        self._blobs: Dict[str, Dict] = {}
+        self._load_index()
+    
+    def get(self, allegato_id: str) -> Optional[bytes]:
+        """
+        Return cached attachment bytes
+        
+        Args:
+            allegato_id: ClasseViva attachment ID
+        
+        Returns:
+            Attachment content, or None if not cached
+        """
+        if not allegato_id:
+            return None
+        
+        with self._lock:
+            sha256 = self._by_id.get(str(allegato_id))
+            content = self._read_blob(sha256) if sha256 else None
+            
+            if content is None:
+                self.misses += 1
+                return None
+            
+            self.hits += 1
+            self._blobs[sha256]['last_used'] = time.time()
+            self._dirty = True
+            if time.monotonic() - self._saved_at >= self.save_interval:
+                self._save_index()
+            return content
+    
+    def put(self, allegato_id: str, content: Union[bytes, BinaryIO]) -> Optional[str]:
+        """
+        Store an attachment, evicting least recently used blobs if needed
+        
+        Args:
+            allegato_id: ClasseViva attachment ID
+            content: Attachment bytes or a readable binary file object
+        
+        Returns:
+            SHA-256 of the content, or None if it was not cached
+        """
+        if not allegato_id:
+            return None
+        
+        # Copy to a temporary blob while hashing, so large files are never held in memory
+        tmp_path = os.path.join(self.blob_dir, f".incoming-{threading.get_ident()}")
+        digest = hashlib.sha256()
+        size = 0
+        with open(tmp_path, 'wb') as f:
+            if isinstance(content, (bytes, bytearray, memoryview)):
+                digest.update(content)
+                f.write(content)
+                size = len(content)
+            else:
+                content.seek(0)
+                for chunk in iter(lambda: content.read(DOWNLOAD_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                content.seek(0)
+        sha256 = digest.hexdigest()
+        
+        if size > self.max_bytes:
+            os.remove(tmp_path)
+            return None
+        
+        with self._lock:
+            if sha256 in self._blobs:
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, self._blob_path(sha256))
+                self._blobs[sha256] = {'size': size}
+            
+            self._blobs[sha256]['last_used'] = time.time()
+            self._by_id[str(allegato_id)] = sha256
+            self._evict(keep=sha256)
+            self._save_index()
+        
+        return sha256
+    
+    def close(self):
+        """Write last use times not yet saved"""
+        with self._lock:
+            if self._dirty:
+                self._save_index()
+    
+    def total_size(self) -> int:
+        """Total size of cached blobs in bytes"""
+        return sum(blob['size'] for blob in self._blobs.values())
+    
+    def _evict(self, keep: str):
+        """Drop least recently used blobs until the cache fits its cap"""
+        total = self.total_size()
+        if total <= self.max_bytes:
+            return
+        
+        for sha256 in sorted(self._blobs, key=lambda h: self._blobs[h].get('last_used', 0)):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            total -= self._blobs.pop(sha256)['size']
+            try:
+                os.remove(self._blob_path(sha256))
+            except OSError:
+                pass
+        
+        self._by_id = {aid: sha for aid, sha in self._by_id.items() if sha in self._blobs}
+    
+    def _read_blob(self, sha256: str) -> Optional[bytes]:
+        """Read a blob, forgetting it if the file went missing"""
+        try:
+            with open(self._blob_path(sha256), 'rb') as f:
+                return f.read()
+        except OSError:
+            self._blobs.pop(sha256, None)
+            self._by_id = {aid: sha for aid, sha in self._by_id.items() if sha != sha256}
+            return None
+    
+    def _blob_path(self, sha256: str) -> str:
+        """Path of the blob file for a content hash"""
+        return os.path.join(self.blob_dir, sha256)
+    
+    def _load_index(self):
+        """Load the index, dropping entries whose blob is missing"""
+        if not os.path.exists(self.index_path):
+            return
+        
+        try:
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Attachment cache index unreadable, starting empty: {e}")
+            return
+        
+        self._blobs = {sha: info for sha, info in index.get('blobs', {}).items()
+                       if os.path.exists(self._blob_path(sha))}
+        self._by_id = {aid: sha for aid, sha in index.get('by_id', {}).items() if sha in self._blobs}
+    
+    def _save_index(self):
+        """Atomically rewrite the index"""
+        tmp_path = f"{self.index_path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'by_id': self._by_id, 'blobs': self._blobs}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        except OSError as e:
+            logger.warning(f"Could not write attachment cache index: {e}")
+
+
+class FileIdCache:
+    """
+    Persistent map from attachment SHA-256 to the Telegram file_id of its
+    first upload, so the same content is sent by reference afterwards
+    """
+    
+    def __init__(self, path: str = FILE_ID_CACHE_FILE, max_entries: int = FILE_ID_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, str] = self._load()
+    
+    def get(self, sha256: str) -> Optional[str]:
+        """Return the file_id for this content, or None if it was never uploaded"""
+        with self._lock:
+            file_id = self._entries.get(sha256)
+            if file_id is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return file_id
+    
+    def put(self, sha256: str, file_id: str):
+        """Remember the file_id Telegram assigned to an upload"""
+        with self._lock:
+            if self._entries.get(sha256) == file_id:
+                return
+            self._entries.pop(sha256, None)
+            self._entries[sha256] = file_id
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._save()
+    
+    def forget(self, sha256: str):
+        """Drop a file_id Telegram no longer accepts"""
+        with self._lock:
+            if self._entries.pop(sha256, None) is not None:
+                self._save()
+    
+    def _load(self) -> Dict[str, str]:
+        """Load the cache, ignoring a missing or corrupt file"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"file_id cache unreadable, starting empty: {e}")
+            return {}
+    
+    def _save(self):
+        """Atomically rewrite the cache file"""
+        if not self.path:
+            return
+        
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write file_id cache: {e}")
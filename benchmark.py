@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for ClasseViva Monitor hot paths
+Run: python3 benchmark.py [name ...]
+"""
+
+import sys
+import json
+import time
+import hashlib
+from typing import Callable, Dict
+
+import json_codec
+from class_detector import ClassDetector, PdfExtractor
+from dedupe_index import DedupeIndex
+
+
+def timeit(func: Callable, repeat: int) -> float:
+    """Return the average time per call in microseconds"""
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1_000_000
+
+
+def bench_dedupe():
+    """Membership lookups: legacy list vs DedupeIndex"""
+    print("Dedupe lookups (sent_hashes)")
+    print("-" * 60)
+    print(f"{'entries':>10} {'list (us)':>14} {'index (us)':>14} {'packed (KB)':>14}")
+    
+    for size in (1_000, 10_000, 100_000):
+        hashes = [hashlib.md5(str(i).encode()).hexdigest() for i in range(size)]
+        index = DedupeIndex(hashes)
+        missing = hashlib.md5(b"missing").hexdigest()
+        
+        # Worst case for the list: the hash is not there
+        list_us = timeit(lambda: missing in hashes, 20)
+        index_us = timeit(lambda: missing in index, 20_000)
+        packed_kb = len(index.to_json()) / 1024
+        
+        print(f"{size:>10} {list_us:>14.2f} {index_us:>14.3f} {packed_kb:>14.1f}")
+    print()
+
+
+def communication(i: int) -> Dict:
+    """A bacheca_personale.php entry shaped like the real ones"""
+    return {
+        'evtId': 1_000_000 + i,
+        'evtCode': 'CF',
+        'evtDatetimeBegin': '2026-10-14T08:00:00+02:00',
+        'evtDatetimeEnd': '2026-10-14T23:59:59+02:00',
+        'evtText': f"Circolare n. {i} - Uscita didattica classi 3A, 3B e 4C",
+        'notes': "<p>Si comunica che le classi <b>3A</b>, <b>3B</b> e <b>4C</b> "
+                 "parteciperanno all'uscita didattica.</p>" * 3,
+        'autore': 'Dirigente Scolastico',
+        'letta': i % 5 != 0,
+        'allegati': [{'allegato_id': 5_000_000 + i, 'filename': f"circolare_{i}.pdf"}],
+    }
+
+
+def bench_json():
+    """ClasseViva response decoding and state encoding: json vs json_codec"""
+    print(f"JSON codec (backend: {json_codec.BACKEND})")
+    print("-" * 60)
+    print(f"{'payload':>22} {'json (us)':>14} {'codec (us)':>14} {'speedup':>8}")
+    
+    def row(name, baseline, codec, repeat):
+        json_us = timeit(baseline, repeat)
+        codec_us = timeit(codec, repeat)
+        print(f"{name:>22} {json_us:>14.1f} {codec_us:>14.1f} {json_us / codec_us:>7.1f}x")
+    
+    # ncna=1 polls return a handful of entries, ncna=0 the whole year
+    for size in (5, 300):
+        body = json.dumps({'data': [communication(i) for i in range(size)]}).encode()
+        row(f"response, {size} comms", lambda: json.loads(body), lambda: json_codec.loads(body), 200)
+    
+    # state.json: packed sent_hashes plus a few meta keys
+    index = DedupeIndex.from_entries((hashlib.md5(str(i).encode()).hexdigest(), 1_760_000_000 + i)
+                                     for i in range(10_000))
+    state = {'sent_hashes': index.to_json(), 'last_retention': 1_760_000_000.5, 'last_check': '2026-10-14 08:00:00'}
+    row("state, 10000 hashes", lambda: json.dumps(state, indent=2), lambda: json_codec.dumps(state), 200)
+    print()
+
+
+def bench_detect():
+    """Detection over a backlog: per-text calls vs the batch API, str vs bytes"""
+    print("Class detection (300 communications + 300 PDF pages)")
+    print("-" * 60)
+    print(f"{'method':>36} {'total (ms)':>14}")
+    
+    patterns = {'rooms': r'\bAula (\d+)\b', 'teachers': r'\bProf\.(?:ssa)? ([A-Z]\.[A-Z]\.)'}
+    detector = ClassDetector(extractor=PdfExtractor(), patterns=patterns)
+    texts = [f"{comm['evtText']} {comm['notes']}" for comm in map(communication, range(300))]
+    texts += [f"Prof.ssa M.R. - Aula {i % 30}: orario delle classi 1AB, 2CD e 5EF. " * 20 for i in range(300)]
+    raw = [text.encode() for text in texts]
+    
+    def row(name, func):
+        print(f"{name:>36} {timeit(func, 20) / 1000:>14.2f}")
+    
+    row("detect_classes_in_text per text", lambda: [detector.detect_classes_in_text(text) for text in texts])
+    row("detect_classes_batch", lambda: detector.detect_classes_batch(texts))
+    row("detect_classes_batch (bytes)", lambda: detector.detect_classes_batch(raw))
+    row("3 patterns, scan_batch", lambda: detector.scan_batch(texts))
+    row("3 patterns, scan_batch (bytes)", lambda: detector.scan_batch(raw))
+    print()
+
+
+BENCHMARKS = {
+    'dedupe': bench_dedupe,
+    'json': bench_json,
+    'detect': bench_detect,
+}
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark: {name} (available: {', '.join(BENCHMARKS)})")
+            return 1
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,14 +8,19 @@ With hardcoded credentials and class detection integration
 """
 
 import os
+import re
 import sys
 import json
 import time
 import hashlib
 import requests
 import signal
+import threading
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime
-from typing import Optional, Dict, List, Set
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Dict, List, Set, Tuple
 from bs4 import BeautifulSoup
 import pytz
 from colorama import Fore, Style, init
@@ -24,7 +29,26 @@ from colorama import Fore, Style, init
 init(autoreset=True)
 
 # Import class detector
-from class_detector import detect_classes
+from class_detector import detect_classes, ClassDetector, PdfResultCache
+from session_manager import SessionManager, is_auth_failure, LOGIN_PAGE_PEEK
+from dedupe_index import DedupeIndex
+from state_store import create_state_store, ensure_sent_index
+import json_codec
+from attachments import Attachment, AttachmentCache, AttachmentTooLarge, FileIdCache, stream_response
+from pipeline import Pipeline, Stage
+from rate_limit import RateLimiter
+from outbox import Outbox, OutboxEntry, OutboxWorker, MESSAGE, DOCUMENT, MEDIA_GROUP
+from subscriptions import SubscriptionRegistry
+from accounts import Account, AccountPoller, PollScheduler, load_accounts, deliver_via
+from polling import AdaptiveInterval
+from config import (
+    SESSION_CACHE_FILE, STATE_BACKEND, STATE_DB_FILE, DOWNLOAD_WORKERS,
+    PIPELINE_DOWNLOAD_WORKERS, PIPELINE_DETECT_WORKERS, ASYNC_ENGINE,
+    TELEGRAM_POOL_SIZE, TELEGRAM_MAX_RETRIES, TELEGRAM_SEND_ATTEMPTS,
+    DIGEST_MODE, DIGEST_MIN_ITEMS, FANOUT_WORKERS, ACCOUNTS_FILE,
+    ADAPTIVE_POLLING, ACTIVE_HOURS, STATS_INTERVAL, SUBSCRIPTIONS_FILE, OUTBOX_ENABLED,
+    RETENTION_MAX_AGE_DAYS, RETENTION_MAX_ENTRIES, RETENTION_INTERVAL
+)
 
 # Italian timezone
 ITALIAN_TZ = pytz.timezone('Europe/Rome')
@@ -53,78 +77,357 @@ class TelegramNotifier:
     """
     Telegram notification sender
     Based on EXACT TelegramNotifier class from local_monitor.py lines 39-260
+    
+    Meant to be created once and reused: all requests go through one
+    pooled keep-alive session, so bursts of notifications share a warm
+    connection instead of a new TCP+TLS handshake per message
+    
+    Sends are paced by global and per-chat token buckets; a 429 pauses
+    the chat for retry_after and the send is attempted again
+    
+    With a FileIdCache, a document is uploaded once and later sends of the
+    same content reference the file_id Telegram returned for it
     """
     
-    def __init__(self, bot_token: str, chat_id: str):
+    # Bot API limits
+    MAX_MESSAGE_LENGTH = 4096
+    MAX_MEDIA_GROUP = 10
+    DIGEST_SEPARATOR = "\n➖➖➖➖➖\n\n"
+    
+    # parse_mode=HTML: a tag, an entity or one character, and the tags split_text() keeps balanced
+    HTML_ATOM = re.compile(r"<[^<>]*>|&#?\w+;|.", re.DOTALL)
+    HTML_TAG = re.compile(r"<(/?)([a-zA-Z][\w-]*)[^<>]*?(/?)>")
+    # Descriptions of a 400 caused by a file_id Telegram no longer knows
+    STALE_FILE_ID = re.compile(r"(wrong|invalid)\b.*\bfile[ _]?(id|identifier)", re.IGNORECASE)
+    
+    def __init__(self, bot_token: str, chat_id: str, pool_size: int = TELEGRAM_POOL_SIZE,
+                 max_retries: int = TELEGRAM_MAX_RETRIES, rate_limiter: Optional[RateLimiter] = None,
+                 file_ids: Optional[FileIdCache] = None):
         self.bot_token = bot_token
         self.chat_id = chat_id
         self.base_url = f"https://api.telegram.org/bot{bot_token}"
+        self.session = self.create_session(pool_size, max_retries)
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.file_ids = file_ids
+    
+    @staticmethod
+    def create_session(pool_size: int, max_retries: int) -> requests.Session:
+        """
+        Build the pooled session used for Bot API calls
+        Connection errors and 5xx responses are retried with backoff; read
+        errors are not, so a message that may already have been delivered
+        is never sent twice. 429 is left to the rate limiter.
+        """
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            status_forcelist=(500, 502, 503, 504),
+            allowed_methods=frozenset({'POST'}),
+            backoff_factor=0.5,
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    def close(self):
+        """Close the pooled connections"""
+        self.session.close()
+    
+    def _post(self, method: str, timeout: int, chat_id: Optional[str] = None, **kwargs) -> requests.Response:
+        """
+        Call a Bot API method within the rate limits
+        A 429 answer pauses the chat for its retry_after and the request is
+        rescheduled, up to TELEGRAM_SEND_ATTEMPTS times
+        
+        Raises:
+            requests.HTTPError: If Telegram still refuses the request
+        """
+        url = f"{self.base_url}/{method}"
+        chat_id = chat_id or self.chat_id
+        for attempt in range(1, TELEGRAM_SEND_ATTEMPTS + 1):
+            self.rate_limiter.acquire(chat_id)
+            
+            # Uploads are read again from the start on every attempt
+            for _, file in kwargs.get('files', {}).values():
+                file.seek(0)
+            
+            response = self.session.post(url, timeout=timeout, **kwargs)
+            if response.status_code != 429 or attempt == TELEGRAM_SEND_ATTEMPTS:
+                break
+            
+            retry_after = self.retry_after(response)
+            log_colored(f"TELEGRAM: Limite raggiunto, nuovo tentativo tra {retry_after}s", Fore.YELLOW)
+            self.rate_limiter.pause(chat_id, retry_after)
+        
+        response.raise_for_status()
+        return response
+    
+    @staticmethod
+    def retry_after(response: requests.Response) -> float:
+        """Seconds to wait after a 429, from the body or the Retry-After header"""
+        try:
+            return float(response.json()['parameters']['retry_after'])
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(response.headers.get('Retry-After', 1))
+        except ValueError:
+            return 1.0
+    
+    @classmethod
+    def stale_file_id(cls, status: Optional[int], description: Optional[str]) -> bool:
+        """Whether Telegram refused a request because a cached file_id is no longer valid"""
+        return status == 400 and bool(cls.STALE_FILE_ID.search(description or ""))
+    
+    @staticmethod
+    def error_description(response: Optional[requests.Response]) -> str:
+        """Telegram's description of a refused request"""
+        try:
+            return str(response.json().get('description', ''))
+        except (AttributeError, ValueError):
+            return ""
+    
+    def cached_file_id(self, document: Attachment) -> Optional[str]:
+        """file_id of an earlier upload of the same content, if known"""
+        return self.file_ids.get(document.sha256) if self.file_ids else None
+    
+    def remember_file_ids(self, documents: List[Attachment], result):
+        """Store the file_id Telegram assigned to each uploaded document"""
+        if not self.file_ids or not documents:
+            return
+        messages = result if isinstance(result, list) else [result]
+        for document, message in zip(documents, messages):
+            try:
+                self.file_ids.put(document.sha256, message['document']['file_id'])
+            except (KeyError, TypeError):
+                pass
+    
+    def forget_file_ids(self, documents: List[Attachment]):
+        """Drop file_ids Telegram refused, the documents are uploaded again"""
+        for document in documents:
+            self.file_ids.forget(document.sha256)
+        log_colored("TELEGRAM: file_id non più valido, nuovo caricamento", Fore.YELLOW)
+    
+    def build_media(self, documents: List[Attachment], caption: str,
+                    reuse: bool) -> Tuple[List[Dict], List[Tuple[str, Attachment]], List[Attachment]]:
+        """
+        Build the media array of a sendMediaGroup call
+        
+        Returns:
+            Tuple of (media, uploads as (attach name, document), documents sent by file_id)
+        """
+        media = []
+        uploads = []
+        reused = []
+        for i, document in enumerate(documents):
+            file_id = self.cached_file_id(document) if reuse else None
+            if file_id:
+                reused.append(document)
+            else:
+                uploads.append((f"attach_{i}", document))
+            media.append({
+                'type': 'document',
+                'media': file_id or f"attach://attach_{i}",
+                'caption': caption if i == 0 else ""
+            })
+        return media, uploads, reused
+    
+    @staticmethod
+    def message_length(text: str) -> int:
+        """Length as Telegram counts it (UTF-16 code units)"""
+        return len(text.encode('utf-16-le')) // 2
     
-    def send_message(self, text: str) -> bool:
-        """Send a text message to Telegram"""
+    @classmethod
+    def split_text(cls, text: str) -> List[str]:
+        """
+        Split a text longer than MAX_MESSAGE_LENGTH without breaking its HTML
+        Cuts at the last line break outside any element, never inside a tag or
+        an entity; a line too long for one message is cut between characters,
+        closing its open elements and opening them again in the next piece
+        """
+        if cls.message_length(text) <= cls.MAX_MESSAGE_LENGTH:
+            return [text]
+        
+        pieces = []
+        atoms: List[str] = []  # The piece being built
+        length = 0
+        reopened = 0  # Leading atoms repeating the open elements of the previous piece
+        safe = 0  # Atoms up to the last line break outside any element
+        stack: List[Tuple[str, str]] = []  # Open elements as (name, opening tag)
+        
+        for atom in cls.HTML_ATOM.findall(text):
+            after = list(stack)
+            tag = cls.HTML_TAG.fullmatch(atom)
+            if tag and tag.group(1):
+                names = [name for name, _ in after]
+                if tag.group(2).lower() in names:
+                    del after[len(names) - 1 - names[::-1].index(tag.group(2).lower()):]
+            elif tag and not tag.group(3):
+                after.append((tag.group(2).lower(), atom))
+            
+            size = cls.message_length(atom)
+            closing = cls.message_length("".join(f"</{name}>" for name, _ in after))
+            while length + size + closing > cls.MAX_MESSAGE_LENGTH and len(atoms) > reopened:
+                if safe > reopened:
+                    pieces.append("".join(atoms[:safe]).rstrip("\n"))
+                    atoms = atoms[safe:]
+                    reopened = 0
+                else:
+                    pieces.append("".join(atoms) + "".join(f"</{name}>" for name, _ in reversed(stack)))
+                    atoms = [opening for _, opening in stack]
+                    reopened = len(atoms)
+                length = sum(map(cls.message_length, atoms))
+                safe = 0
+            
+            atoms.append(atom)
+            length += size
+            stack = after
+            if atom == "\n" and not stack:
+                safe = len(atoms)
+        
+        if len(atoms) > reopened:
+            pieces.append("".join(atoms))
+        return pieces
+    
+    @classmethod
+    def pack_messages(cls, texts: List[str]) -> List[str]:
+        """Join texts, in order, into as few messages as MAX_MESSAGE_LENGTH allows"""
+        messages = []
+        current = ""
+        for text in texts:
+            for piece in cls.split_text(text):
+                candidate = f"{current}{cls.DIGEST_SEPARATOR}{piece}" if current else piece
+                if cls.message_length(candidate) <= cls.MAX_MESSAGE_LENGTH:
+                    current = candidate
+                else:
+                    messages.append(current)
+                    current = piece
+        if current:
+            messages.append(current)
+        return messages
+    
+    @classmethod
+    def chunk_documents(cls, documents: List) -> List[List]:
+        """Split documents into groups of at most MAX_MEDIA_GROUP"""
+        return [documents[i:i + cls.MAX_MEDIA_GROUP] for i in range(0, len(documents), cls.MAX_MEDIA_GROUP)]
+    
+    def send_digest(self, texts: List[str], documents: List[Attachment], chat_id: Optional[str] = None,
+                    sent: Optional[Set[str]] = None) -> bool:
+        """
+        Send a burst of communications with as few calls as possible:
+        the texts packed into messages, then every document in media groups
+        
+        Args:
+            sent: Keys of the parts already delivered, skipped here and
+                  extended with each part that goes through
+        
+        Returns:
+            True if every send succeeded
+        """
+        sent = set() if sent is None else sent
+        for message in self.pack_messages(texts):
+            key = hashlib.md5(message.encode()).hexdigest()
+            if key in sent:
+                continue
+            if not self.send_message(message, chat_id=chat_id):
+                return False
+            sent.add(key)
+        
+        for group in self.chunk_documents(documents):
+            key = ",".join(document.sha256 for document in group)
+            if key in sent:
+                continue
+            # A media group needs at least two items
+            if len(group) == 1:
+                ok = self.send_document(group[0], chat_id=chat_id)
+            else:
+                ok = self.send_media_group(group, chat_id=chat_id)
+            if not ok:
+                return False
+            sent.add(key)
+        return True
+    
+    def send_message(self, text: str, chat_id: Optional[str] = None) -> bool:
+        """Send a text message to Telegram (to chat_id, default the notifier's chat)"""
+        chat_id = chat_id or self.chat_id
         try:
-            url = f"{self.base_url}/sendMessage"
             payload = {
-                'chat_id': self.chat_id,
+                'chat_id': chat_id,
                 'text': text,
                 'parse_mode': 'HTML'
             }
-            response = requests.post(url, json=payload, timeout=10)
-            response.raise_for_status()
+            self._post('sendMessage', 10, chat_id, json=payload)
             log_colored("TELEGRAM: Messaggio inviato", Fore.GREEN)
             return True
         except Exception as e:
             log_colored(f"ERRORE: Invio messaggio Telegram fallito - {str(e)}", Fore.RED)
             return False
     
-    def send_document(self, document_path: str, caption: str = "") -> bool:
-        """Send a document to Telegram"""
+    def send_document(self, document: Attachment, caption: str = "", chat_id: Optional[str] = None) -> bool:
+        """Send a document to Telegram, by file_id if it was uploaded before"""
+        chat_id = chat_id or self.chat_id
         try:
-            url = f"{self.base_url}/sendDocument"
-            with open(document_path, 'rb') as f:
-                files = {'document': f}
-                data = {
-                    'chat_id': self.chat_id,
-                    'caption': caption,
-                    'parse_mode': 'HTML'
-                }
-                response = requests.post(url, files=files, data=data, timeout=30)
-                response.raise_for_status()
-            log_colored(f"TELEGRAM: Documento inviato ({os.path.basename(document_path)})", Fore.GREEN)
+            data = {
+                'chat_id': chat_id,
+                'caption': caption,
+                'parse_mode': 'HTML'
+            }
+            file_id = self.cached_file_id(document)
+            if file_id:
+                try:
+                    self._post('sendDocument', 30, chat_id, data={**data, 'document': file_id})
+                    log_colored(f"TELEGRAM: Documento inviato ({document.filename}, già caricato)", Fore.GREEN)
+                    return True
+                except requests.HTTPError as e:
+                    # Other 400s (caption too long, bad HTML, ...) would fail the upload too
+                    if e.response is None or not self.stale_file_id(e.response.status_code,
+                                                                    self.error_description(e.response)):
+                        raise
+                    self.forget_file_ids([document])
+            
+            files = {'document': (document.filename, document.open())}
+            response = self._post('sendDocument', 30, chat_id, files=files, data=data)
+            self.remember_file_ids([document], response.json().get('result'))
+            log_colored(f"TELEGRAM: Documento inviato ({document.filename})", Fore.GREEN)
             return True
         except Exception as e:
             log_colored(f"ERRORE: Invio documento Telegram fallito - {str(e)}", Fore.RED)
             return False
     
-    def send_media_group(self, media_paths: List[str], caption: str = "") -> bool:
-        """Send multiple documents as a media group"""
+    def send_media_group(self, documents: List[Attachment], caption: str = "",
+                         chat_id: Optional[str] = None) -> bool:
+        """Send multiple documents as a media group, uploading only new content"""
+        chat_id = chat_id or self.chat_id
         try:
-            url = f"{self.base_url}/sendMediaGroup"
-            media = []
-            files = {}
-            
-            for i, path in enumerate(media_paths):
-                attach_name = f"attach_{i}"
-                media.append({
-                    'type': 'document',
-                    'media': f"attach://{attach_name}",
-                    'caption': caption if i == 0 else ""
-                })
-                files[attach_name] = open(path, 'rb')
-            
-            data = {
-                'chat_id': self.chat_id,
-                'media': json.dumps(media)
-            }
-            
-            response = requests.post(url, files=files, data=data, timeout=60)
-            
-            # Close all file handles
-            for f in files.values():
-                f.close()
+            for reuse in (True, False):
+                media, uploads, reused = self.build_media(documents, caption, reuse)
+                files = {name: (document.filename, document.open()) for name, document in uploads}
+                data = {
+                    'chat_id': chat_id,
+                    'media': json.dumps(media)
+                }
+                
+                try:
+                    response = self._post('sendMediaGroup', 60, chat_id, files=files, data=data)
+                except requests.HTTPError as e:
+                    # A stale file_id fails the whole group: upload everything again
+                    if not reused or e.response is None or not self.stale_file_id(
+                            e.response.status_code, self.error_description(e.response)):
+                        raise
+                    self.forget_file_ids(reused)
+                    continue
+                break
             
-            response.raise_for_status()
-            log_colored(f"TELEGRAM: Media group inviato ({len(media_paths)} file)", Fore.GREEN)
+            # Messages of the group come back in the order of the media array
+            if uploads:
+                self.remember_file_ids(documents, response.json().get('result'))
+            log_colored(f"TELEGRAM: Media group inviato ({len(documents)} file)", Fore.GREEN)
             return True
         except Exception as e:
             log_colored(f"ERRORE: Invio media group Telegram fallito - {str(e)}", Fore.RED)
@@ -161,12 +464,46 @@ class ClasseVivaMonitor:
     Uses EXACT login() and get_communications() methods with FIXED webidentity extraction
     """
     
-    def __init__(self, username: str, password: str):
+    def __init__(self, username: str, password: str, session_cache_file: Optional[str] = None,
+                 attachment_cache: Optional[AttachmentCache] = None,
+                 detector: Optional[ClassDetector] = None,
+                 notifier: Optional[TelegramNotifier] = None,
+                 outbox: Optional[Outbox] = None,
+                 subscriptions: Optional[SubscriptionRegistry] = None,
+                 state_store=None, account: Optional[str] = None):
         self.username = username
         self.password = password
+        self.attachment_cache = attachment_cache
+        self.detector = detector or ClassDetector()
+        self.notifier = notifier
+        self.outbox = outbox
+        self.subscriptions = subscriptions
+        # Per-account state backend and name, set when several accounts are monitored
+        self.state_store = state_store
+        self.account = account
+        # Chats already served for communications whose fan-out partly failed
+        self._delivered: Dict[str, Set[str]] = {}
+        # Communications no chat is subscribed to, by hash with their classes
+        self._unrouted: Dict[str, Set[str]] = {}
+        # Digest parts each chat already received while the rest of its digest is retried
+        self._digest_parts: Dict[str, Set[str]] = {}
         self.session = None
         self.phpsessid = None
         self.webidentity = None
+        # Downloads of the outbox worker may log in again while a poll runs
+        self._login_lock = threading.Lock()
+        self.auth_expired = False
+        self.last_fetch_ok = False
+        # Whether the last check_updates() could fetch the communications
+        self.last_poll_ok = False
+        # Fingerprint of the last processed response per ncna (see get_communications)
+        self.unchanged = False
+        self.fingerprint_hits = 0
+        self.fingerprint_misses = 0
+        self._fingerprints: Dict[int, Tuple[str, str, List[Dict]]] = {}
+        self.last_fingerprint: Optional[Tuple[int, str, str, List[Dict]]] = None
+        self.session_manager = SessionManager(cache_file=session_cache_file)
+        self._session_cache_checked = False
     
     def login(self) -> bool:
         """
@@ -180,8 +517,12 @@ class ClasseVivaMonitor:
         try:
             log_colored("LOGIN: Tentativo di login...", Fore.CYAN)
             
-            # Create new session for each login
-            self.session = requests.Session()
+            # Reuse the pooled connection, drop only the stale cookies
+            if self.session is None:
+                self.session = requests.Session()
+            else:
+                self.session.cookies.clear()
+            self.phpsessid = None
             
             # EXACT login URL from local_monitor.py
             url = "https://web.spaggiari.eu/auth-p7/app/default/AuthApi4.php?a=aLoginPwd"
@@ -217,7 +558,7 @@ class ClasseVivaMonitor:
             response.raise_for_status()
             
             # Check response
-            data = response.json()
+            data = json_codec.loads(response.content)
             
             if data and not data.get('error'):
                 # CRITICAL FIX: Extract webidentity from JSON response (lines 327-333 from local_monitor.py)
@@ -248,7 +589,7 @@ class ClasseVivaMonitor:
             else:
                 log_colored(f"ERRORE: Login fallito - {data.get('error', 'Unknown error')}", Fore.RED)
                 return False
-                
+        
         except Exception as e:
             log_colored(f"ERRORE: Login fallito - {str(e)}", Fore.RED)
             return False
@@ -258,9 +599,19 @@ class ClasseVivaMonitor:
         EXACT get_communications method from local_monitor.py lines 360-401
         Retrieve communications from ClasseViva
         
+        A response whose body (or, failing that, list of IDs) matches the
+        last processed one is returned from memory without being parsed and
+        sets self.unchanged; commit_fingerprint(self.last_fingerprint)
+        records a response as processed
+        
         Args:
             ncna: 0 = get all, 1 = get only new
         """
+        self.auth_expired = False
+        self.last_fetch_ok = False
+        self.unchanged = False
+        self.last_fingerprint = None
+        
         if not self.phpsessid or not self.webidentity:
             log_colored("ERRORE: Non autenticato. Eseguire login() prima.", Fore.RED)
             return []
@@ -298,9 +649,32 @@ class ClasseVivaMonitor:
             }
             
             response = self.session.post(url, data=payload, headers=headers, cookies=cookies, timeout=30)
+            
+            # Expired sessions come back as 401/403 or a login page
+            if is_auth_failure(response, response.content):
+                self.auth_expired = True
+                log_colored("SESSIONE: Sessione scaduta o rifiutata", Fore.YELLOW)
+                return []
+            
             response.raise_for_status()
             
-            data = response.json()
+            # Idle polls stop here: one request plus one hash
+            body_hash = hashlib.md5(response.content).hexdigest()
+            previous = self._fingerprints.get(ncna)
+            if previous is not None and previous[0] == body_hash:
+                self.fingerprint_hits += 1
+                self.unchanged = True
+                self.last_fetch_ok = True
+                log_colored("API: Nessuna variazione dall'ultimo controllo", Fore.CYAN)
+                return previous[2]
+            
+            try:
+                data = json_codec.loads(response.content)
+            except ValueError:
+                # Not the API answer: log in again before trusting the session
+                self.auth_expired = True
+                log_colored("SESSIONE: Risposta non valida, nuovo login", Fore.YELLOW)
+                return []
             
             # Extract communications from response
             communications = []
@@ -312,6 +686,21 @@ class ClasseVivaMonitor:
             elif isinstance(data, list):
                 communications = data
             
+            self.last_fetch_ok = True
+            
+            # Same communications in a different body (e.g. a volatile field)
+            ids_hash = hashlib.md5(
+                "\n".join(str(c.get('evtId', c.get('id', ''))) for c in communications).encode()
+            ).hexdigest()
+            if previous is not None and previous[1] == ids_hash:
+                self.fingerprint_hits += 1
+                self.unchanged = True
+                self._fingerprints[ncna] = (body_hash, ids_hash, communications)
+                log_colored("API: Nessuna variazione dall'ultimo controllo", Fore.CYAN)
+                return communications
+            
+            self.fingerprint_misses += 1
+            self.last_fingerprint = (ncna, body_hash, ids_hash, communications)
             log_colored(f"API: Recuperate {len(communications)} comunicazioni", Fore.GREEN)
             
             # Count new communications
@@ -320,51 +709,381 @@ class ClasseVivaMonitor:
                 log_colored(f"INFO: {new_count} NUOVE COMUNICAZIONI!", Fore.YELLOW)
             
             return communications
-            
+        
         except Exception as e:
             log_colored(f"ERRORE: Recupero comunicazioni fallito - {str(e)}", Fore.RED)
             return []
     
-    def download_attachment(self, attachment_id: str, filename: str) -> Optional[str]:
+    def commit_fingerprint(self, fingerprint: Optional[Tuple[int, str, str, List[Dict]]]):
+        """Record a fetched response as processed, so an identical one is skipped"""
+        if fingerprint is not None:
+            ncna, body_hash, ids_hash, communications = fingerprint
+            self._fingerprints[ncna] = (body_hash, ids_hash, communications)
+    
+    def fetch_communications(self, ncna: int = 1) -> List[Dict]:
+        """
+        Retrieve communications reusing the authenticated session
+        Logs in again only when the session is missing, past its TTL,
+        or rejected by get_communications
+        
+        After a restart the cached cookies are tried first: the normal
+        get_communications call doubles as the probe, and only a rejected
+        probe falls back to AuthApi4
+        
+        Args:
+            ncna: 0 = get all, 1 = get only new
+        """
+        # Also false when no request is made because the login failed
+        self.last_fetch_ok = False
+        self.unchanged = False
+        self.last_fingerprint = None
+        
+        if not self._session_cache_checked:
+            self._session_cache_checked = True
+            if self.session_manager.restore(self):
+                if self.session is None:
+                    self.session = requests.Session()
+                log_colored("SESSIONE: Sessione ripristinata dalla cache", Fore.CYAN)
+        
+        had_session = self.session_manager.is_valid()
+        if not self.session_manager.ensure(self):
+            return []
+        if not had_session:
+            self.log_session_stats()
+        
+        phpsessid = self.phpsessid
+        communications = self.get_communications(ncna=ncna)
+        
+        if self.auth_expired:
+            if not self.relogin(phpsessid):
+                return []
+            communications = self.get_communications(ncna=ncna)
+        
+        return communications
+    
+    def log_session_stats(self):
+        """Log login count and latency after a (re-)login"""
+        stats = self.session_manager.stats()
+        log_colored(
+            f"SESSIONE: Login #{stats['logins']} in {stats['last_login_latency']:.2f}s "
+            f"(re-login: {stats['relogins']}, sessione riutilizzata: {stats['reused']} volte)",
+            Fore.CYAN
+        )
+    
+    def download_attachment(self, attachment_id: str, filename: str) -> Optional[Attachment]:
         """
-        Download attachment and save to file
-        Returns path to downloaded file or None if failed
+        Download attachment into a spooled buffer
+        The body is streamed in chunks and aborted past MAX_ATTACHMENT_SIZE_MB
+        Attachments already in the attachment cache are not downloaded again
+        Returns the Attachment (caller must close it) or None if failed
         """
+        cached = self.attachment_cache.get(attachment_id) if self.attachment_cache else None
+        if cached is not None:
+            log_colored(f"DOWNLOAD: {filename} dalla cache", Fore.GREEN)
+            return Attachment.from_bytes(filename, cached)
+        
         if not self.phpsessid or not self.webidentity:
             log_colored("ERRORE: Non autenticato.", Fore.RED)
             return None
         
+        attachment = None
         try:
             log_colored(f"DOWNLOAD: Scaricamento {filename}...", Fore.CYAN)
             
             # Construct download URL
             url = f"https://web.spaggiari.eu/sif/app/default/bacheca_personale.php?action=download&id={attachment_id}"
             
-            cookies = {
-                'PHPSESSID': self.phpsessid,
-                'webidentity': self.webidentity
-            }
-            
             headers = {
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = self.session.get(url, headers=headers, cookies=cookies, timeout=60)
-            response.raise_for_status()
+            for attempt in range(2):
+                phpsessid = self.phpsessid
+                cookies = {
+                    'PHPSESSID': phpsessid,
+                    'webidentity': self.webidentity
+                }
+                
+                # Stream into a spooled buffer instead of buffering the whole body
+                attachment = Attachment(filename)
+                with self.session.get(url, headers=headers, cookies=cookies, timeout=60, stream=True) as response:
+                    # An expired session gets the login page instead of the file (outbox
+                    # retries can run hours after the poll); it must never reach the cache
+                    html = 'text/html' in response.headers.get('Content-Type', '')
+                    start = next(iter(response.iter_content(LOGIN_PAGE_PEEK)), b"") if html else None
+                    expired = is_auth_failure(response, start)
+                    if not expired:
+                        response.raise_for_status()
+                        if html:
+                            raise ValueError("pagina HTML al posto dell'allegato")
+                        stream_response(response, attachment.file)
+                
+                if not expired:
+                    break
+                attachment.close()
+                attachment = None
+                log_colored(f"SESSIONE: Download di {filename} rifiutato, sessione scaduta", Fore.YELLOW)
+                if attempt or not self.relogin(phpsessid):
+                    return None
             
-            # Save to file
-            filepath = f"/tmp/{filename}"
-            with open(filepath, 'wb') as f:
-                f.write(response.content)
+            if self.attachment_cache:
+                self.attachment_cache.put(attachment_id, attachment.file)
             
             log_colored(f"DOWNLOAD: Scaricato {filename}", Fore.GREEN)
-            return filepath
-            
+            return attachment
+        
+        except AttachmentTooLarge as e:
+            log_colored(f"ERRORE: Allegato {filename} troppo grande - {str(e)}", Fore.YELLOW)
         except Exception as e:
             log_colored(f"ERRORE: Download allegato fallito - {str(e)}", Fore.RED)
-            return None
+        
+        # Drop partial downloads
+        if attachment is not None:
+            attachment.close()
+        return None
+    
+    def relogin(self, rejected_session: Optional[str]) -> bool:
+        """
+        Log in again after a request was rejected with rejected_session,
+        unless another thread already replaced that session
+        """
+        with self._login_lock:
+            if self.phpsessid and self.phpsessid != rejected_session:
+                return True
+            self.session_manager.invalidate("auth")
+            if not self.session_manager.login(self):
+                return False
+            self.log_session_stats()
+            return True
     
-    def parse_attachments(self, comm: Dict) -> List[Dict]:
+    def fetch_attachments(self, attachments: List[Dict]) -> List[Optional[Attachment]]:
+        """
+        Download all attachments of a communication concurrently
+        Classes are detected afterwards by the pipeline's detect stage
+        
+        Args:
+            attachments: Attachment info dicts from parse_attachments()
+        
+        Returns:
+            One result per attachment in the same order, None where the download failed
+        """
+        def fetch(attachment: Dict) -> Optional[Attachment]:
+            return self.download_attachment(attachment['id'], attachment['filename'])
+        
+        if not attachments:
+            return []
+        
+        workers = min(DOWNLOAD_WORKERS, len(attachments))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="download") as pool:
+            # map() yields results in submission order
+            return list(pool.map(fetch, attachments))
+    
+    def download_stage(self, job: Dict) -> Dict:
+        """Pipeline stage: download the attachments of a communication"""
+        attachments = self.parse_attachments(job['comm'])
+        results = self.fetch_attachments(attachments)
+        job['documents'] = [document for document in results if document is not None]
+        # References to what was downloaded, for the outbox; filenames are not unique
+        job['attachments'] = [a for a, document in zip(attachments, results) if document is not None]
+        if self.account:
+            for attachment in job['attachments']:
+                attachment['account'] = self.account
+        return job
+    
+    def detect_stage(self, job: Dict) -> Dict:
+        """Pipeline stage: detect classes in the text and in the downloaded PDFs"""
+        comm = job['comm']
+        
+        # Extract text for class detection
+        title = comm.get("evtText", comm.get("titolo", ""))
+        notes = comm.get("notes", comm.get("testo", ""))
+        classes = self.detector.detect_classes_in_text(f"{title} {notes}")
+        
+        # The same in-memory buffer is used for detection and upload
+        for document in job['documents']:
+            try:
+                classes.update(self.detector.detect_classes_in_pdf(document.read()))
+            except Exception as e:
+                log_colored(f"ERRORE: Analisi PDF fallita - {str(e)}", Fore.YELLOW)
+        
+        job['classes'] = classes
+        return job
+    
+    def route(self, notifier: 'TelegramNotifier', classes: Set[str]) -> List[str]:
+        """Chats a communication with these classes goes to"""
+        if self.subscriptions is None:
+            return [notifier.chat_id]
+        return sorted(self.subscriptions.chats_for(classes))
+    
+    def rerouted(self) -> bool:
+        """Whether a chat subscribed to a communication that had no recipient"""
+        return self.subscriptions is not None and any(self.subscriptions.chats_for(classes)
+                                                      for classes in self._unrouted.values())
+    
+    def fan_out(self, notifier: 'TelegramNotifier', key: str, chats: List[str],
+                send: Callable[[str], bool], documents: List[Attachment]) -> bool:
+        """
+        Deliver to every chat that has not received key yet
+        The first chat is served alone so its uploads fill the file_id cache;
+        once every document can be sent by file_id the other chats are
+        served concurrently, otherwise one after the other (they would all
+        read the same buffers)
+        
+        Returns:
+            True once every chat has received it
+        """
+        done = self._delivered.setdefault(key, set())
+        pending = [chat for chat in chats if chat not in done]
+        
+        for index, chat in enumerate(pending):
+            shared = not documents or all(notifier.cached_file_id(document) for document in documents)
+            if index > 0 and shared:
+                rest = pending[index:]
+                workers = min(FANOUT_WORKERS, len(rest))
+                with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout") as pool:
+                    for other, sent in zip(rest, pool.map(send, rest)):
+                        if sent:
+                            done.add(other)
+                break
+            if send(chat):
+                done.add(chat)
+        
+        if len(pending) > 1:
+            log_colored(f"TELEGRAM: Inviato a {len(done)}/{len(chats)} chat", Fore.GREEN)
+        
+        # Chats already served are skipped when the rest is retried
+        if all(chat in done for chat in chats):
+            del self._delivered[key]
+            return True
+        return False
+    
+    def notify_communication(self, notifier: 'TelegramNotifier', job: Dict) -> bool:
+        """
+        Pipeline sink: send a communication and its attachments to every
+        chat subscribed to its classes
+        Returns True if every send succeeded, False also when no chat is subscribed
+        """
+        documents = job['documents']
+        chats = self.route(notifier, job['classes'])
+        if not chats:
+            log_colored(f"ATTENZIONE: Nessuna chat iscritta per la comunicazione {job['comm_id']}", Fore.YELLOW)
+            return False
+        
+        # Format and send message
+        message = notifier.format_communication(job['comm'], job['classes'])
+        
+        def send(chat_id: str) -> bool:
+            if documents:
+                # Send with attachments
+                if len(documents) == 1:
+                    return notifier.send_document(documents[0], caption=message, chat_id=chat_id)
+                # Send message first, then media group
+                return (notifier.send_message(message, chat_id=chat_id)
+                        and notifier.send_media_group(documents, chat_id=chat_id))
+            
+            # Send message only
+            return notifier.send_message(message, chat_id=chat_id)
+        
+        return self.fan_out(notifier, job['hash'], chats, send, documents)
+    
+    def notify_digest(self, notifier: 'TelegramNotifier', jobs: List[Dict]) -> bool:
+        """
+        Send a burst of communications as one digest per chat (DIGEST_MODE)
+        Their texts are packed into as few messages as possible, followed by
+        all attachments in media groups of up to MAX_MEDIA_GROUP documents;
+        a chat whose digest partly failed only gets the parts it missed
+        Returns True if the digest was sent (or queued in the outbox)
+        """
+        texts = [notifier.format_communication(job['comm'], job['classes']) for job in jobs]
+        
+        # Each chat gets the communications routed to it
+        routed: Dict[str, List[int]] = {}
+        for index, job in enumerate(jobs):
+            for chat_id in self.route(notifier, job['classes']):
+                routed.setdefault(chat_id, []).append(index)
+        
+        digest_hash = hashlib.md5("".join(job['hash'] for job in jobs).encode()).hexdigest()
+        log_colored(f"DIGEST: {len(jobs)} comunicazioni per {len(routed)} chat", Fore.CYAN)
+        
+        if self.outbox is None:
+            def send(chat_id: str) -> bool:
+                indexes = routed[chat_id]
+                sent = self._digest_parts.setdefault(chat_id, set())
+                if not notifier.send_digest([texts[i] for i in indexes],
+                                            [document for i in indexes for document in jobs[i]['documents']],
+                                            chat_id=chat_id, sent=sent):
+                    return False
+                del self._digest_parts[chat_id]
+                return True
+            
+            documents = [document for job in jobs for document in job['documents']]
+            return self.fan_out(notifier, digest_hash, sorted(routed), send, documents)
+        
+        for chat_id, indexes in routed.items():
+            parts = [{'kind': MESSAGE, 'text': message}
+                     for message in notifier.pack_messages([texts[i] for i in indexes])]
+            attachments = [attachment for i in indexes for attachment in jobs[i].get('attachments', [])]
+            for group in notifier.chunk_documents(attachments):
+                parts.append({'kind': DOCUMENT if len(group) == 1 else MEDIA_GROUP, 'attachments': group})
+            self.outbox.enqueue(chat_id, digest_hash, parts)
+        return True
+    
+    def enqueue_communication(self, notifier: 'TelegramNotifier', job: Dict) -> int:
+        """
+        Pipeline sink with an outbox: queue the rendered notification and
+        its attachment references for the delivery worker, once per chat
+        Returns the number of outbox entries added
+        """
+        message = notifier.format_communication(job['comm'], job['classes'])
+        attachments = job.get('attachments', [])
+        
+        # Same split as notify_communication
+        if len(attachments) == 1:
+            parts = [{'kind': DOCUMENT, 'text': message, 'attachments': attachments}]
+        elif attachments:
+            parts = [{'kind': MESSAGE, 'text': message},
+                     {'kind': MEDIA_GROUP, 'attachments': attachments}]
+        else:
+            parts = [{'kind': MESSAGE, 'text': message}]
+        
+        return sum(self.outbox.enqueue(chat_id, job['hash'], parts)
+                   for chat_id in self.route(notifier, job['classes']))
+    
+    def deliver(self, entry: OutboxEntry) -> bool:
+        """
+        Outbox worker callback: send one queued notification
+        Attachments come from the attachment cache, or are downloaded again
+        Returns True if Telegram accepted it
+        """
+        notifier = self.notifier
+        if entry.kind == MESSAGE:
+            return notifier.send_message(entry.text, chat_id=entry.chat_id)
+        
+        documents = []
+        try:
+            for attachment in entry.attachments:
+                document = self.download_attachment(attachment['id'], attachment['filename'])
+                if document is None:
+                    log_colored(f"OUTBOX: Allegato {attachment['filename']} non disponibile, nuovo tentativo più tardi", Fore.YELLOW)
+                    return False
+                documents.append(document)
+            
+            if entry.kind == DOCUMENT:
+                return notifier.send_document(documents[0], caption=entry.text, chat_id=entry.chat_id)
+            return notifier.send_media_group(documents, caption=entry.text, chat_id=entry.chat_id)
+        finally:
+            for document in documents:
+                document.close()
+    
+    @staticmethod
+    def release_job(job: Dict):
+        """Release the attachment buffers of a finished or dropped communication"""
+        for document in job['documents']:
+            document.close()
+        job['documents'] = []
+    
+    @staticmethod
+    def parse_attachments(comm: Dict) -> List[Dict]:
         """
         Parse HTML to find attachment IDs
         Returns list of attachment info dicts
@@ -423,26 +1142,35 @@ class ClasseVivaMonitor:
         Returns:
             Number of new communications processed
         """
-        # Login before each check (to handle session expiration)
-        if not self.login():
-            return 0
-        
-        # Fetch communications
+        # Fetch communications (logs in only if the session expired)
         if is_first_run:
             # First run: fetch ALL communications (ncna=0)
-            communications = self.get_communications(ncna=0)
+            communications = self.fetch_communications(ncna=0)
         else:
             # Continuous monitoring: fetch only new (ncna=1)
-            communications = self.get_communications(ncna=1)
+            communications = self.fetch_communications(ncna=1)
         
-        if not communications:
+        # Kept aside: the retention pass may fetch again before it is committed
+        fingerprint = self.last_fingerprint
+        self.last_poll_ok = self.last_fetch_ok
+        
+        # Nothing changed since the last processed poll, or nothing to send;
+        # an unchanged response is still processed once a chat wants what nobody received
+        if (self.unchanged and not self.rerouted()) or not communications:
+            if not self.unchanged:
+                self.commit_fingerprint(fingerprint)
+            # Quiet polls still forget old hashes once the interval has elapsed
+            if self.last_fetch_ok and retention_due(state, time.time()):
+                self.apply_retention(state, listing=communications if is_first_run else None)
+                self.save_state(state)
             return 0
         
-        # Initialize Telegram notifier
-        notifier = TelegramNotifier(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+        # Telegram notifier is created once and reused across polls
+        if self.notifier is None:
+            self.notifier = TelegramNotifier(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+        notifier = self.notifier
         
-        # Track new communications
-        new_count = 0
+        sent_hashes = ensure_sent_index(state)
         
         # On first run, send only the latest (first) communication
         if is_first_run:
@@ -451,109 +1179,254 @@ class ClasseVivaMonitor:
             # On subsequent runs, send all new communications
             comms_to_send = communications
         
+        # Fetch stage: pick the communications that still have to be sent
+        jobs = []
+        queued = set()
         for comm in comms_to_send:
             # Generate hash for this communication
             comm_id = comm.get('evtId', comm.get('id', ''))
             comm_hash = hashlib.md5(str(comm_id).encode()).hexdigest()
             
             # Check if already sent
-            if comm_hash in state.get('sent_hashes', []):
+            if comm_hash in sent_hashes or comm_hash in queued:
                 continue
+            queued.add(comm_hash)
             
-            # Extract text for class detection
-            title = comm.get("evtText", comm.get("titolo", ""))
-            notes = comm.get("notes", comm.get("testo", ""))
-            comm_text = f"{title} {notes}"
-            
-            # Detect classes from text
-            from class_detector import ClassDetector
-            detector = ClassDetector()
-            classes = detector.detect_classes_in_text(comm_text)
-            
-            # Parse attachments
-            attachments = self.parse_attachments(comm)
-            
-            # Download PDF attachments and detect classes in them
-            attachment_paths = []
-            for attachment in attachments:
-                filepath = self.download_attachment(attachment['id'], attachment['filename'])
-                if filepath:
-                    attachment_paths.append(filepath)
-                    
-                    # Detect classes in PDF
-                    try:
-                        with open(filepath, 'rb') as f:
-                            pdf_content = f.read()
-                        pdf_classes = detector.detect_classes_in_pdf(pdf_content)
-                        classes.update(pdf_classes)
-                    except Exception as e:
-                        log_colored(f"ERRORE: Analisi PDF fallita - {str(e)}", Fore.YELLOW)
-            
-            # Format and send message
-            message = notifier.format_communication(comm, classes)
-            
-            # Send message
-            if attachment_paths:
-                # Send with attachments
-                if len(attachment_paths) == 1:
-                    notifier.send_document(attachment_paths[0], caption=message)
+            # Still nobody to send it to: skip the downloads and the detection
+            classes = self._unrouted.get(comm_hash)
+            if classes is not None and not self.route(notifier, classes):
+                continue
+            jobs.append({'comm': comm, 'comm_id': comm_id, 'hash': comm_hash, 'documents': []})
+        
+        # Forget the unrouted communications that are no longer listed
+        self._unrouted = {comm_hash: classes for comm_hash, classes in self._unrouted.items()
+                          if comm_hash in queued}
+        
+        def mark_sent(job: Dict):
+            sent_hashes.add(job['hash'], {
+                'comm_id': str(job['comm_id']),
+                'sent_at': time.time(),
+                'classes': sorted(job['classes'])
+            })
+        
+        # A burst of communications is sent as one digest after the pipeline
+        digest = DIGEST_MODE and len(jobs) >= DIGEST_MIN_ITEMS
+        batch = []
+        skipped = []
+        
+        def notify(job: Dict):
+            # Without a recipient the communication is set aside, unsent, until a chat subscribes
+            if not self.route(notifier, job['classes']):
+                self.release_job(job)
+                self._unrouted[job['hash']] = set(job['classes'])
+                skipped.append(job)
+                log_colored(f"ATTENZIONE: Nessuna chat iscritta per la comunicazione {job['comm_id']} "
+                            f"(classi: {', '.join(sorted(job['classes'])) or 'nessuna'})", Fore.YELLOW)
+                return
+            
+            if digest:
+                batch.append(job)
+                return
+            
+            try:
+                if self.outbox is not None:
+                    # Delivery is up to the outbox worker from here on
+                    self.enqueue_communication(notifier, job)
+                    delivered = True
                 else:
-                    # Send message first, then media group
-                    notifier.send_message(message)
-                    notifier.send_media_group(attachment_paths)
-                
-                # Clean up downloaded files
-                for filepath in attachment_paths:
-                    try:
-                        os.remove(filepath)
-                    except Exception:
-                        pass
-            else:
-                # Send message only
-                notifier.send_message(message)
+                    delivered = self.notify_communication(notifier, job)
+            finally:
+                self.release_job(job)
+            
+            # Not marked as sent, so the next poll tries again
+            if not delivered:
+                raise RuntimeError(f"invio della comunicazione {job['comm_id']} rimandato")
             
             # Mark as sent
-            if 'sent_hashes' not in state:
-                state['sent_hashes'] = []
-            state['sent_hashes'].append(comm_hash)
-            new_count += 1
+            mark_sent(job)
+        
+        # Download, detect and notify stages overlap across communications,
+        # while Telegram still receives them one at a time in order
+        pipeline = Pipeline([
+            Stage("download", self.download_stage, PIPELINE_DOWNLOAD_WORKERS),
+            Stage("detect", self.detect_stage, PIPELINE_DETECT_WORKERS),
+        ])
+        new_count = pipeline.run(jobs, notify, on_error=lambda job, e: self.release_job(job))
+        
+        if batch:
+            try:
+                delivered = self.notify_digest(notifier, batch)
+            finally:
+                for job in batch:
+                    self.release_job(job)
+            
+            if delivered:
+                for job in batch:
+                    mark_sent(job)
+            else:
+                log_colored("ERRORE: Invio digest fallito, nuovo tentativo al prossimo controllo", Fore.RED)
+                new_count = len(skipped)
         
         # On first run, save ALL communication hashes (not just the one we sent)
         if is_first_run:
             for comm in communications:
                 comm_id = comm.get('evtId', comm.get('id', ''))
                 comm_hash = hashlib.md5(str(comm_id).encode()).hexdigest()
-                if comm_hash not in state.get('sent_hashes', []):
-                    state['sent_hashes'].append(comm_hash)
+                sent_hashes.add(comm_hash, {'comm_id': str(comm_id), 'sent_at': time.time()})
+        
+        # Periodically forget old hashes (the first run already has the full listing)
+        self.apply_retention(state, listing=communications if is_first_run else None)
         
         # Save state
-        save_state(state)
-        log_colored(f"STATE: Salvate {len(state.get('sent_hashes', []))} comunicazioni", Fore.GREEN)
+        self.save_state(state)
+        log_colored(f"STATE: Salvate {len(sent_hashes)} comunicazioni", Fore.GREEN)
+        
+        # A response is skipped next time only once every communication in it went out
+        # or was set aside for lack of recipients
+        if new_count == len(jobs):
+            self.commit_fingerprint(fingerprint)
+        
+        return new_count - len(skipped)
+    
+    def save_state(self, state: Dict):
+        """Save state to this account's backend, or the global one"""
+        if self.state_store is None:
+            save_state(state)
+            return
+        try:
+            self.state_store.save(state)
+        except Exception as e:
+            log_colored(f"ERRORE: Salvataggio state fallito - {str(e)}", Fore.RED)
+    
+    def apply_retention(self, state: Dict, force: bool = False,
+                        listing: Optional[List[Dict]] = None) -> int:
+        """
+        Evict sent hashes older than RETENTION_MAX_AGE_DAYS or beyond
+        RETENTION_MAX_ENTRIES, at most once every RETENTION_INTERVAL
+        
+        Anything get_communications(ncna=0) still returns is protected, so
+        an evicted communication can never be sent again. If that listing
+        cannot be fetched the pass is skipped.
+        
+        Args:
+            state: Dictionary containing seen communication hashes
+            force: Run even if the interval has not elapsed
+            listing: Already fetched ncna=0 communications, if available
         
-        return new_count
+        Returns:
+            Number of evicted hashes
+        """
+        if not RETENTION_MAX_AGE_DAYS and not RETENTION_MAX_ENTRIES:
+            return 0
+        
+        now = time.time()
+        if not force and not retention_due(state, now):
+            return 0
+        
+        communications = listing
+        if communications is None:
+            communications = self.fetch_communications(ncna=0)
+        if not self.last_fetch_ok:
+            log_colored("STATE: Pulizia storico rimandata (elenco completo non disponibile)", Fore.YELLOW)
+            return 0
+        
+        return prune_sent_hashes(state, communications, now)
+
+
+def comm_hash_for(comm: Dict) -> str:
+    """Hash used to track a communication in state['sent_hashes']"""
+    comm_id = comm.get('evtId', comm.get('id', ''))
+    return hashlib.md5(str(comm_id).encode()).hexdigest()
+
+
+def retention_due(state: Dict, now: float) -> bool:
+    """Check whether a retention pass should run"""
+    if not RETENTION_MAX_AGE_DAYS and not RETENTION_MAX_ENTRIES:
+        return False
+    return now - state.get('last_retention', 0) >= RETENTION_INTERVAL
+
+
+def prune_sent_hashes(state: Dict, communications: List[Dict], now: float) -> int:
+    """
+    Apply the retention policy, keeping every hash in the full listing
+    
+    Args:
+        state: Dictionary containing seen communication hashes
+        communications: Full ncna=0 listing
+        now: Current time
+    
+    Returns:
+        Number of evicted hashes
+    """
+    evicted = ensure_sent_index(state).prune(
+        max_age=RETENTION_MAX_AGE_DAYS * 86400 or None,
+        max_entries=RETENTION_MAX_ENTRIES or None,
+        protected=(comm_hash_for(comm) for comm in communications),
+        now=now
+    )
+    state['last_retention'] = now
+    
+    if evicted:
+        log_colored(f"STATE: Rimossi {len(evicted)} hash dallo storico", Fore.CYAN)
+    return len(evicted)
+
+
+# Active state backend and the settings it was created with
+_state_store = None
+_state_store_config = None
+
+
+def get_state_store():
+    """Return the configured state backend, creating it on first use"""
+    global _state_store, _state_store_config
+    config = (STATE_BACKEND, STATE_FILE, STATE_DB_FILE)
+    if _state_store is None or _state_store_config != config:
+        close_state_store()
+        _state_store = create_state_store(*config)
+        _state_store_config = config
+    return _state_store
+
+
+def close_state_store():
+    """Release the active state backend"""
+    global _state_store
+    if _state_store is not None:
+        _state_store.close()
+        _state_store = None
 
 
 def load_state() -> Dict:
-    """Load state from JSON file"""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            log_colored(f"ERRORE: Caricamento state fallito - {str(e)}", Fore.YELLOW)
+    """Load state from the configured backend (state.json or SQLite)"""
+    close_state_store()
+    
+    try:
+        return get_state_store().load()
+    except Exception as e:
+        log_colored(f"ERRORE: Caricamento state fallito - {str(e)}", Fore.YELLOW)
     
-    return {'sent_hashes': []}
+    return {'sent_hashes': DedupeIndex()}
 
 
 def save_state(state: Dict):
-    """Save state to JSON file"""
+    """Save state to the configured backend, writing only what changed"""
     try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(state, f, indent=2)
+        get_state_store().save(state)
     except Exception as e:
         log_colored(f"ERRORE: Salvataggio state fallito - {str(e)}", Fore.RED)
 
 
+def async_engine_conflicts() -> List[str]:
+    """Settings the asyncio engine (ASYNC_ENGINE) does not support"""
+    conflicts = []
+    if os.path.exists(ACCOUNTS_FILE):
+        conflicts.append(ACCOUNTS_FILE)
+    if os.path.exists(SUBSCRIPTIONS_FILE):
+        conflicts.append(SUBSCRIPTIONS_FILE)
+    if DIGEST_MODE:
+        conflicts.append("DIGEST_MODE")
+    return conflicts
+
+
 def print_banner():
     """Print startup banner"""
     print()
@@ -583,47 +1456,109 @@ def main():
     # Print banner
     print_banner()
     
-    # Initialize monitor
-    monitor = ClasseVivaMonitor(CLASSEVIVA_USERNAME, CLASSEVIVA_PASSWORD)
+    if ASYNC_ENGINE:
+        # One account, one chat, one message per communication: refuse the rest
+        conflicts = async_engine_conflicts()
+        if conflicts:
+            log_colored(f"ERRORE: ASYNC_ENGINE non supporta {', '.join(conflicts)} - "
+                        f"disattivare ASYNC_ENGINE o queste impostazioni", Fore.RED)
+            sys.exit(1)
+        
+        # Imported here so aiohttp is only needed when the engine is enabled
+        import asyncio
+        from async_engine import run_async
+        
+        log_colored("INFO: Motore asyncio attivo (invio diretto, senza outbox né impronta delle risposte)", Fore.CYAN)
+        policy = AdaptiveInterval(CHECK_INTERVAL, ITALIAN_TZ) if ADAPTIVE_POLLING else None
+        asyncio.run(run_async(CLASSEVIVA_USERNAME, CLASSEVIVA_PASSWORD,
+                              TelegramNotifier(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, file_ids=FileIdCache()),
+                              CHECK_INTERVAL, sys.modules[__name__],
+                              session_cache_file=SESSION_CACHE_FILE,
+                              attachment_cache=AttachmentCache(),
+                              detector=ClassDetector(result_cache=PdfResultCache()),
+                              policy=policy))
+        return
     
-    # Load state
-    state = load_state()
+    # Shared by every monitored account
+    attachment_cache = AttachmentCache()
+    detector = ClassDetector(result_cache=PdfResultCache())
+    notifier = TelegramNotifier(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, file_ids=FileIdCache())
+    outbox = Outbox() if OUTBOX_ENABLED else None
+    subscriptions = SubscriptionRegistry(default_chat=TELEGRAM_CHAT_ID)
     
-    # Check if this is first run
-    is_first_run = len(state.get('sent_hashes', [])) == 0
+    # The built-in account keeps the top-level state files
+    default_account = Account("default", CLASSEVIVA_USERNAME, CLASSEVIVA_PASSWORD,
+                              STATE_FILE, STATE_DB_FILE, SESSION_CACHE_FILE)
+    pollers = []
+    for account in load_accounts(ACCOUNTS_FILE, default=default_account):
+        monitor = ClasseVivaMonitor(account.username, account.password,
+                                    session_cache_file=account.session_cache_file,
+                                    attachment_cache=attachment_cache,
+                                    detector=detector,
+                                    notifier=notifier,
+                                    outbox=outbox,
+                                    subscriptions=subscriptions,
+                                    account=account.name)
+        poller = AccountPoller(account, monitor)
+        pollers.append(poller)
+        
+        if poller.first_run:
+            log_colored(f"INFO: [{account.name}] Prima esecuzione - invio ultima comunicazione", Fore.CYAN)
+        else:
+            log_colored(f"INFO: [{account.name}] Ripresa monitoraggio", Fore.CYAN)
     
-    if is_first_run:
-        log_colored("INFO: Prima esecuzione - invio ultima comunicazione", Fore.CYAN)
+    # Deliver queued notifications (including those left from a previous run)
+    outbox_worker = None
+    if outbox is not None:
+        outbox_worker = OutboxWorker(outbox, deliver_via(pollers))
+        outbox_worker.start()
+        pending = outbox.counts().get('pending', 0)
+        if pending:
+            log_colored(f"OUTBOX: {pending} notifiche in attesa di invio", Fore.CYAN)
     else:
-        log_colored("INFO: Ripresa monitoraggio", Fore.CYAN)
+        log_colored("INFO: Outbox disattivato (OUTBOX_ENABLED), invio diretto", Fore.YELLOW)
     
-    # First check
-    log_colored("INFO: Primo controllo...", Fore.CYAN)
-    new_count = monitor.check_updates(state, is_first_run=is_first_run)
-    log_colored(f"INFO: Primo controllo completato ({new_count} nuove)", Fore.GREEN)
+    last_report = [time.monotonic()]
     
-    # Start continuous monitoring loop
-    log_colored(f"INFO: Avvio monitoraggio continuo (ogni {CHECK_INTERVAL} secondi)", Fore.CYAN)
+    def on_result(poller: AccountPoller, new_count: int, error: Optional[Exception]):
+        if outbox_worker is not None:
+            outbox_worker.wake()
+        if error is not None:
+            log_colored(f"ERRORE: [{poller.name}] Errore nel controllo - {str(error)}", Fore.RED)
+        elif new_count > 0:
+            log_colored(f"INFO: [{poller.name}] Trovate e inviate {new_count} nuove comunicazioni", Fore.GREEN)
+        else:
+            log_colored(f"INFO: [{poller.name}] Nessuna nuova comunicazione", Fore.CYAN)
+        
+        if time.monotonic() - last_report[0] >= STATS_INTERVAL:
+            last_report[0] = time.monotonic()
+            hits = sum(poller.monitor.fingerprint_hits for poller in pollers)
+            misses = sum(poller.monitor.fingerprint_misses for poller in pollers)
+            log_colored(f"STATS: {scheduler.polls_per_day():.0f} controlli al giorno, "
+                        f"{hits} risposte invariate, {misses} modificate", Fore.CYAN)
+    
+    # Each account starts CHECK_INTERVAL / accounts apart
+    if ADAPTIVE_POLLING:
+        start, end = ACTIVE_HOURS
+        log_colored(f"INFO: Avvio monitoraggio di {len(pollers)} account (ogni {CHECK_INTERVAL} secondi "
+                    f"dalle {start}:00 alle {end}:00, più lento di notte e nel weekend)", Fore.CYAN)
+        make_policy = lambda: AdaptiveInterval(CHECK_INTERVAL, ITALIAN_TZ)
+    else:
+        log_colored(f"INFO: Avvio monitoraggio di {len(pollers)} account (ogni {CHECK_INTERVAL} secondi)", Fore.CYAN)
+        make_policy = None
     log_colored("INFO: Premi Ctrl+C per arrestare", Fore.YELLOW)
     print()
     
-    while True:
-        try:
-            # Wait for next check
-            time.sleep(CHECK_INTERVAL)
-            
-            # Check for updates
-            new_count = monitor.check_updates(state, is_first_run=False)
-            
-            if new_count > 0:
-                log_colored(f"INFO: Trovate e inviate {new_count} nuove comunicazioni", Fore.GREEN)
-            else:
-                log_colored("INFO: Nessuna nuova comunicazione", Fore.CYAN)
-        
-        except Exception as e:
-            log_colored(f"ERRORE: Errore nel loop principale - {str(e)}", Fore.RED)
-            # Continue monitoring even if there's an error
-            time.sleep(CHECK_INTERVAL)
+    scheduler = PollScheduler(pollers, CHECK_INTERVAL, on_result=on_result, make_policy=make_policy)
+    try:
+        scheduler.run()
+    finally:
+        if outbox_worker is not None:
+            outbox_worker.stop(timeout=5)
+        for poller in pollers:
+            poller.close()
+        attachment_cache.close()
+        detector.extractor.close()
 
 
 if __name__ == "__main__":
@@ -4,22 +4,345 @@ Detects school class mentions in text and PDF files
 Pattern: [1-5][A-Z]{2} (e.g., 1AA, 2BC, 5XY)
 """
 
+import os
 import re
+import json
+import hashlib
 import logging
-from typing import Set, List
+import time
+import threading
+import multiprocessing
+from multiprocessing.connection import Connection
+from typing import Set, List, Optional, Dict, Iterable, NamedTuple, Tuple, Union
 import PyPDF2
 import io
 
-from config import CLASS_PATTERN, MAX_PDF_SIZE_MB, PDF_TIMEOUT
+from config import (
+    CLASS_PATTERN, DETECTION_PATTERNS, MAX_PDF_SIZE_MB, PDF_TIMEOUT, PDF_START_METHOD, MAX_WORKERS,
+    PDF_CACHE_FILE, PDF_CACHE_MAX_ENTRIES
+)
 
 logger = logging.getLogger(__name__)
 
+# Name of CLASS_PATTERN in the results of ClassDetector.scan()
+CLASSES = "classes"
+
+Text = Union[str, bytes]
+
+
+class PdfText(NamedTuple):
+    """Text extracted from a PDF, page by page"""
+    pages: List[str]
+    page_count: int
+    complete: bool
+
+
+def _extract_pages(pdf_content: bytes, conn):
+    """
+    Extract one PDF in a worker process
+    Sends the page count, then the text of each page as soon as it is
+    extracted, so the parent keeps whatever was read before a timeout
+    """
+    try:
+        pdf_reader = PyPDF2.PdfReader(io.BytesIO(pdf_content))
+        conn.send(('pages', len(pdf_reader.pages)))
+        
+        for page_num in range(len(pdf_reader.pages)):
+            try:
+                text = pdf_reader.pages[page_num].extract_text() or ""
+            except Exception as e:
+                conn.send(('page_error', page_num, str(e)))
+                continue
+            conn.send(('page', page_num, text))
+        
+        conn.send(('done',))
+    except Exception as e:
+        conn.send(('failed', str(e)))
+
+
+def _serve(conn):
+    """Worker process entry point: extract PDFs until told to stop (None)"""
+    try:
+        while True:
+            pdf_content = conn.recv()
+            if pdf_content is None:
+                break
+            _extract_pages(pdf_content, conn)
+    except EOFError:
+        pass
+    finally:
+        conn.close()
+
+
+class PdfExtractor:
+    """
+    Runs PDF text extraction in separate worker processes
+    At most max_workers documents are parsed at the same time, and a
+    worker still running after timeout seconds is killed
+    
+    Workers are not forked from the monitor itself: a lock held by one
+    of its threads at fork time would stay locked in the child forever.
+    Starting one re-imports the main module, so workers are kept and
+    reused, and only one that timed out or died is replaced
+    """
+    
+    def __init__(self, max_workers: int = MAX_WORKERS, timeout: float = PDF_TIMEOUT,
+                 start_method: str = PDF_START_METHOD):
+        self.timeout = timeout
+        self.timeouts = 0
+        self.started = 0
+        self._slots = threading.BoundedSemaphore(max(1, max_workers))
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[multiprocessing.Process, Connection]] = []
+        if start_method not in multiprocessing.get_all_start_methods():
+            start_method = 'spawn'
+        self._context = multiprocessing.get_context(start_method)
+        if start_method == 'forkserver':
+            # The server imports PyPDF2 once instead of every worker
+            self._context.set_forkserver_preload([__name__])
+    
+    def _start_worker(self) -> Tuple[multiprocessing.Process, Connection]:
+        """Start a worker process, returning it with the parent end of its pipe"""
+        conn, child = self._context.Pipe()
+        worker = self._context.Process(target=_serve, args=(child,), daemon=True)
+        worker.start()
+        child.close()
+        self.started += 1
+        return worker, conn
+    
+    @staticmethod
+    def _stop_worker(worker: multiprocessing.Process, conn: Connection, kill: bool = False):
+        """Stop a worker, or kill it if it is stuck"""
+        if kill:
+            worker.kill()
+        else:
+            try:
+                conn.send(None)
+            except OSError:
+                worker.kill()
+        conn.close()
+        worker.join(5)
+        if worker.is_alive():
+            worker.kill()
+            worker.join()
+    
+    def extract(self, pdf_content: bytes) -> PdfText:
+        """
+        Extract the text of every page of a PDF
+        
+        Args:
+            pdf_content: PDF file content as bytes
+        
+        Returns:
+            PdfText with the pages read; complete is False if the worker
+            timed out or the document could not be parsed
+        
+        Raises:
+            ValueError: If the document is not a readable PDF
+        """
+        with self._slots:
+            with self._lock:
+                worker, conn = self._idle.pop() if self._idle else (None, None)
+            if worker is None or not worker.is_alive():
+                if worker is not None:
+                    self._stop_worker(worker, conn, kill=True)
+                worker, conn = self._start_worker()
+            
+            reusable = False
+            try:
+                conn.send(bytes(pdf_content))
+                result, reusable = self._collect(conn, worker)
+                return result
+            except ValueError:
+                # The worker reported the failure and is ready for the next PDF
+                reusable = True
+                raise
+            finally:
+                if reusable:
+                    with self._lock:
+                        self._idle.append((worker, conn))
+                else:
+                    self._stop_worker(worker, conn, kill=True)
+    
+    def _collect(self, receiver, worker) -> Tuple[PdfText, bool]:
+        """
+        Read worker messages until it finishes, fails or runs out of time
+        
+        Returns:
+            The PdfText and whether the worker can take another PDF
+        """
+        deadline = time.monotonic() + self.timeout
+        pages: Dict[int, str] = {}
+        page_count = 0
+        
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not receiver.poll(remaining):
+                self.timeouts += 1
+                logger.warning(f"PDF extraction timed out after {self.timeout}s "
+                               f"({len(pages)}/{page_count} pages read)")
+                return PdfText([pages[num] for num in sorted(pages)], page_count, False), False
+            
+            try:
+                message = receiver.recv()
+            except EOFError:
+                # Worker died without reporting (e.g. out of memory)
+                worker.join(1)
+                logger.error(f"PDF worker exited unexpectedly (code {worker.exitcode})")
+                return PdfText([pages[num] for num in sorted(pages)], page_count, False), False
+            
+            kind = message[0]
+            if kind == 'pages':
+                page_count = message[1]
+            elif kind == 'page':
+                pages[message[1]] = message[2]
+            elif kind == 'page_error':
+                logger.error(f"Error extracting text from page {message[1]}: {message[2]}")
+            elif kind == 'done':
+                return PdfText([pages[num] for num in sorted(pages)], page_count, True), True
+            elif kind == 'failed':
+                raise ValueError(message[1])
+    
+    def close(self):
+        """Stop the idle workers"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker, conn in idle:
+            self._stop_worker(worker, conn)
+
+
+class PdfResultCache:
+    """
+    Persistent cache of PDF class detection results
+    Keyed by the SHA-256 of the PDF bytes and of the class pattern,
+    so changing CLASS_PATTERN invalidates old results automatically
+    """
+    
+    def __init__(self, path: str = PDF_CACHE_FILE, max_entries: int = PDF_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = self._load()
+    
+    @staticmethod
+    def make_key(pdf_sha256: str, pattern: str) -> str:
+        """Build the cache key for a PDF hash and a class pattern"""
+        pattern_hash = hashlib.sha256(pattern.encode()).hexdigest()[:16]
+        return f"{pattern_hash}:{pdf_sha256}"
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Look up a cached result
+        
+        Args:
+            key: Key from make_key()
+        
+        Returns:
+            Dictionary with 'classes' and 'pages', or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+    
+    def put(self, key: str, classes: Set[str], pages: int):
+        """Store a detection result and persist the cache"""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = {'classes': sorted(classes), 'pages': pages}
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+            self._save()
+    
+    def purge_other_patterns(self, pattern: str):
+        """Drop results computed with a different class pattern"""
+        prefix = self.make_key("", pattern)
+        with self._lock:
+            stale = [key for key in self._entries if not key.startswith(prefix)]
+            for key in stale:
+                del self._entries[key]
+            if stale:
+                logger.info(f"Dropped {len(stale)} cached PDF results for an old class pattern")
+                self._save()
+    
+    def _load(self) -> Dict[str, Dict]:
+        """Load cached results, ignoring a missing or corrupt file"""
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        
+        try:
+            with open(self.path, 'r') as f:
+                entries = json.load(f)
+            return entries if isinstance(entries, dict) else {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"PDF result cache unreadable, starting empty: {e}")
+            return {}
+    
+    def _save(self):
+        """Atomically rewrite the cache file"""
+        if not self.path:
+            return
+        
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write PDF result cache: {e}")
+
 
 class ClassDetector:
-    """Detects and extracts unique class mentions from text and PDF files"""
+    """
+    Detects and extracts unique class mentions from text and PDF files
+    
+    Args:
+        result_cache: Persistent cache of PDF results
+        extractor: PDF text extractor
+        patterns: Extra named patterns for scan() (default DETECTION_PATTERNS),
+                  each with at most one group, reported like re.findall.
+                  All patterns are compiled with re.ASCII (word boundaries and
+                  character classes ignore accented letters), so str and bytes
+                  input match the same way
+    
+    Raises:
+        ValueError: If an extra pattern is named 'classes'
+    """
     
-    def __init__(self):
-        self.pattern = re.compile(CLASS_PATTERN)
+    def __init__(self, result_cache: Optional[PdfResultCache] = None,
+                 extractor: Optional[PdfExtractor] = None,
+                 patterns: Optional[Dict[str, str]] = None):
+        patterns = DETECTION_PATTERNS if patterns is None else patterns
+        if CLASSES in patterns:
+            raise ValueError(f"'{CLASSES}' is reserved for CLASS_PATTERN")
+        self.patterns = {CLASSES: CLASS_PATTERN, **patterns}
+        # Compiled once for str and bytes input; bytes are decoded first
+        # for patterns that are not plain ASCII
+        self._compiled = {name: (re.compile(pattern, re.ASCII),
+                                 re.compile(pattern.encode()) if pattern.isascii() else None)
+                          for name, pattern in self.patterns.items()}
+        self.pattern = self._compiled[CLASSES][0]
+        self.result_cache = result_cache
+        self.extractor = extractor or PdfExtractor()
+        if result_cache is not None:
+            result_cache.purge_other_patterns(CLASS_PATTERN)
+    
+    @staticmethod
+    def _findall(compiled: Tuple[re.Pattern, Optional[re.Pattern]], item: Optional[Text]) -> Set[str]:
+        """Unique matches of a pattern compiled by __init__, scanning bytes without decoding them"""
+        if not item:
+            return set()
+        if isinstance(item, bytes):
+            if compiled[1] is None:
+                item = item.decode('utf-8', 'replace')
+            else:
+                return {match.decode('utf-8', 'replace') for match in compiled[1].findall(item)}
+        return set(compiled[0].findall(item))
     
     def detect_classes_in_text(self, text: str) -> Set[str]:
         """
@@ -27,7 +350,7 @@ class ClassDetector:
         
         Args:
             text: Text content to search
-            
+        
         Returns:
             Set of unique class codes found
         """
@@ -38,18 +361,62 @@ class ClassDetector:
         unique_classes = set(matches)
         
         if unique_classes:
-            logger.info(f"Detected classes in text: {', '.join(sorted(unique_classes))}")
+            logger.debug(f"Detected classes in text: {', '.join(sorted(unique_classes))}")
         
         return unique_classes
     
+    def detect_classes_batch(self, items: Iterable[Optional[Text]]) -> List[Set[str]]:
+        """
+        Detect class mentions in many texts or PDF pages at once
+        
+        Args:
+            items: Texts (str, or bytes scanned without decoding them first)
+        
+        Returns:
+            Set of class codes for each item, in order
+        """
+        compiled = self._compiled[CLASSES]
+        results = [self._findall(compiled, item) for item in items]
+        
+        logger.debug(f"Detected classes in {sum(1 for found in results if found)} of {len(results)} texts")
+        return results
+    
+    def scan(self, text: Optional[Text]) -> Dict[str, Set[str]]:
+        """
+        Match every named pattern against a text
+        
+        Args:
+            text: Text content (str or bytes)
+        
+        Returns:
+            Set of matches for each pattern name, 'classes' included
+        """
+        return self.scan_batch([text])[0]
+    
+    def scan_batch(self, items: Iterable[Optional[Text]]) -> List[Dict[str, Set[str]]]:
+        """
+        Match every named pattern against many texts
+        
+        Args:
+            items: Texts (str or bytes)
+        
+        Returns:
+            Set of matches for each pattern name, for each item in order
+        """
+        compiled = self._compiled.items()
+        return [{name: self._findall(patterns, item) for name, patterns in compiled} for item in items]
+    
     def detect_classes_in_pdf(self, pdf_content: bytes) -> Set[str]:
         """
         Extract text from PDF and detect class mentions
         Optimized for Raspberry Pi with size limits
+        Text extraction runs in a worker process bounded by PDF_TIMEOUT;
+        on timeout the classes found in the pages read so far are returned
+        Complete results are memoized in the result cache when one is configured
         
         Args:
             pdf_content: PDF file content as bytes
-            
+        
         Returns:
             Set of unique class codes found
         """
@@ -59,32 +426,33 @@ class ClassDetector:
             logger.warning(f"PDF size ({size_mb:.2f}MB) exceeds limit ({MAX_PDF_SIZE_MB}MB)")
             return set()
         
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = PdfResultCache.make_key(hashlib.sha256(pdf_content).hexdigest(), CLASS_PATTERN)
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                logger.debug(f"PDF result cache hit ({cached['pages']} pages)")
+                return set(cached['classes'])
+        
         try:
-            # Use PyPDF2 for lightweight PDF parsing
-            pdf_file = io.BytesIO(pdf_content)
-            pdf_reader = PyPDF2.PdfReader(pdf_file)
+            # Use PyPDF2 for lightweight PDF parsing, off the polling thread
+            pdf_text = self.extractor.extract(pdf_content)
             
             all_classes = set()
             
-            # Extract text from all pages
-            for page_num in range(len(pdf_reader.pages)):
-                try:
-                    page = pdf_reader.pages[page_num]
-                    text = page.extract_text()
-                    
-                    # Detect classes in this page
-                    page_classes = self.detect_classes_in_text(text)
-                    all_classes.update(page_classes)
-                    
-                except Exception as e:
-                    logger.error(f"Error extracting text from page {page_num}: {e}")
-                    continue
+            # Detect classes in every page that was read
+            for page_classes in self.detect_classes_batch(pdf_text.pages):
+                all_classes.update(page_classes)
             
             if all_classes:
                 logger.info(f"Detected classes in PDF: {', '.join(sorted(all_classes))}")
             
-            return all_classes
+            # Partial results are not cached, the next attempt may get further
+            if cache_key is not None and pdf_text.complete:
+                self.result_cache.put(cache_key, all_classes, pdf_text.page_count)
             
+            return all_classes
+        
         except Exception as e:
             logger.error(f"Error processing PDF: {e}")
             return set()
@@ -95,7 +463,7 @@ class ClassDetector:
         
         Args:
             classes: Set of class codes
-            
+        
         Returns:
             Formatted string for display
         """
@@ -112,7 +480,7 @@ class ClassDetector:
         Args:
             text: Optional text content
             pdf_content: Optional PDF content
-            
+        
         Returns:
             Formatted output with detected classes
         """
@@ -140,7 +508,7 @@ def detect_classes(text: str = None, pdf_content: bytes = None) -> str:
     Args:
         text: Optional text content
         pdf_content: Optional PDF content
-        
+    
     Returns:
         Formatted output with detected classes
     """
@@ -4,6 +4,7 @@ Handles authentication and communication monitoring
 Based on exact authentication logic from local_monitor.py
 """
 
+import io
 import requests
 import logging
 from typing import Optional, Dict, List
@@ -11,6 +12,8 @@ from datetime import datetime
 import pytz
 from colorama import Fore, Style, init
 
+from attachments import AttachmentTooLarge, stream_response
+
 # Initialize colorama
 init(autoreset=True)
 
@@ -207,6 +210,7 @@ class ClasseVivaAPI:
     def download_attachment(self, attachment_id: str) -> Optional[bytes]:
         """
         Download attachment (e.g., PDF file)
+        Streamed in chunks and aborted past MAX_ATTACHMENT_SIZE_MB
         
         Args:
             attachment_id: ID of the attachment to download
@@ -233,12 +237,17 @@ class ClasseVivaAPI:
                 'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
             }
             
-            response = self.session.get(url, headers=headers, cookies=cookies)
-            response.raise_for_status()
+            buffer = io.BytesIO()
+            with self.session.get(url, headers=headers, cookies=cookies, stream=True) as response:
+                response.raise_for_status()
+                stream_response(response, buffer)
             
             log_colored(f"INFO: Allegato {attachment_id} scaricato", Fore.GREEN)
-            return response.content
+            return buffer.getvalue()
             
+        except AttachmentTooLarge as e:
+            log_colored(f"ERRORE: Allegato {attachment_id} troppo grande - {str(e)}", Fore.YELLOW)
+            return None
         except Exception as e:
             log_colored(f"ERRORE: Download allegato fallito - {str(e)}", Fore.RED)
             return None
@@ -15,6 +15,10 @@ CLASSEVIVA_API_URL = "https://web.spaggiari.eu/rest/v1"
 
 # Class Detection Settings
 CLASS_PATTERN = r'\b([1-5][A-Z]{2})\b'  # Pattern to match classes like 1AA, 2BC, 5XY
+# Extra named patterns reported by ClassDetector.scan() next to 'classes',
+# e.g. {'rooms': r'\bAula (\d+)\b', 'teachers': r'\bProf\.(?:ssa)? ([A-Z]\.[A-Z]\.)'}
+# Compiled with re.ASCII: \b, \w and \d ignore accented letters, in text and bytes alike
+DETECTION_PATTERNS = {}
 
 # Raspberry Pi Optimization Settings
 MAX_WORKERS = 2  # Limit concurrent workers for memory efficiency
@@ -25,3 +29,83 @@ LOG_FILE = "classeviva_monitor.log"
 # PDF Processing Settings
 MAX_PDF_SIZE_MB = 5  # Maximum PDF size to process (in MB)
 PDF_TIMEOUT = 30  # Timeout for PDF processing in seconds
+PDF_START_METHOD = "forkserver"  # How PDF workers are started ("spawn" where forkserver is unavailable)
+
+# Download Settings
+MAX_ATTACHMENT_SIZE_MB = 20  # Downloads are aborted past this size (Telegram bots can send up to 50MB)
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read per chunk when streaming downloads
+DOWNLOAD_WORKERS = 4  # Attachments of one communication downloaded in parallel
+ATTACHMENT_SPOOL_MB = 5  # Attachments up to this size are kept in memory, larger ones spill to a temp file
+
+# Engine Settings
+ASYNC_ENGINE = False  # Run the monitor on asyncio + aiohttp (async_engine.py) instead of threads
+
+# Poll Pipeline Settings (fetch -> download -> detect -> notify)
+PIPELINE_QUEUE_SIZE = 8  # Communications buffered between two stages
+PIPELINE_DOWNLOAD_WORKERS = 2  # Communications whose attachments download at the same time
+PIPELINE_DETECT_WORKERS = 2  # Communications scanned for classes at the same time
+# Notification is always a single worker so Telegram receives messages in order
+
+# Telegram Connection Settings
+TELEGRAM_POOL_SIZE = 4  # Keep-alive connections kept open to api.telegram.org
+TELEGRAM_MAX_RETRIES = 3  # Retries on connection errors and 5xx responses
+TELEGRAM_GLOBAL_RATE = 30  # Requests per second for the whole bot
+TELEGRAM_CHAT_RATE = 1.0  # Sustained requests per second to a single chat
+TELEGRAM_CHAT_BURST = 3  # Requests a chat may receive back to back before pacing starts
+TELEGRAM_SEND_ATTEMPTS = 5  # A send rejected with 429 is retried after retry_after up to this many times
+FILE_ID_CACHE_FILE = "telegram_file_ids.json"  # file_id of every uploaded attachment, by SHA-256
+FILE_ID_CACHE_MAX_ENTRIES = 2000  # Oldest file_ids are dropped beyond this
+
+# Multi-Account Settings
+ACCOUNTS_FILE = "accounts.json"  # [{"name", "username", "password"}]; the built-in account if missing
+ACCOUNTS_DIR = "accounts"  # State and session cache of each account, one subdirectory per name
+POLL_CONCURRENCY = 4  # Accounts checked at the same time
+
+# Adaptive Polling Settings (hours and weekdays in Europe/Rome)
+ADAPTIVE_POLLING = True  # False = every CHECK_INTERVAL seconds around the clock
+ACTIVE_HOURS = (7, 19)  # Check every CHECK_INTERVAL seconds from 7:00 to 18:59
+ACTIVE_WEEKDAYS = (0, 1, 2, 3, 4)  # Monday = 0; add 5 for schools open on Saturday
+RECENT_ACTIVITY_WINDOW = 1800  # Keep checking fast this long after new communications
+IDLE_MAX_INTERVAL = 1800  # Longest interval at night and on weekends (doubles up to this)
+ERROR_MAX_INTERVAL = 900  # Longest interval after consecutive failed checks
+POLL_JITTER = 0.1  # Random spread of each interval (0.1 = +-10%)
+STATS_INTERVAL = 3600  # Seconds between two polls-per-day reports
+
+# Subscription Settings
+SUBSCRIPTIONS_FILE = "subscriptions.json"  # {chat_id: [class codes]}, "*" = every communication
+FANOUT_WORKERS = 4  # Chats a communication is sent to at the same time
+
+# Digest Settings
+DIGEST_MODE = False  # Send bursts of new communications as a digest instead of one by one
+DIGEST_MIN_ITEMS = 3  # New communications in one check needed to switch to a digest
+
+# Notification Outbox Settings
+OUTBOX_ENABLED = True  # False = send from the poll loop, retrying failed sends on the next check
+OUTBOX_FILE = "outbox.db"  # Notifications waiting for delivery, kept across restarts
+OUTBOX_MAX_ATTEMPTS = 10  # Failed deliveries before a notification is given up
+OUTBOX_RETRY_BASE = 30  # Seconds before the first retry, doubled on each failure
+OUTBOX_RETRY_MAX = 3600  # Longest wait between two retries
+OUTBOX_KEEP_DAYS = 7  # Delivered notifications are remembered this long to avoid duplicates
+
+# ClasseViva Session Settings
+SESSION_TTL = 3600  # Re-authenticate after this many seconds even if the session still works
+SESSION_CACHE_FILE = "session_cache.json"  # PHPSESSID/webidentity kept across restarts
+
+# State Storage Settings
+STATE_BACKEND = "json"  # "json" (state.json), "sqlite" (WAL mode) or "journal" (append-only log)
+STATE_DB_FILE = "state.db"  # Used by the sqlite backend; state.json is migrated on first start
+JOURNAL_COMPACT_THRESHOLD = 500  # Journal lines before the snapshot is rewritten
+
+# Sent History Retention Settings
+RETENTION_MAX_AGE_DAYS = 365  # Forget sent hashes older than this (0 = keep forever)
+RETENTION_MAX_ENTRIES = 5000  # Keep at most this many sent hashes (0 = unlimited)
+RETENTION_INTERVAL = 86400  # Seconds between retention passes (each costs one ncna=0 request)
+
+# Attachment Cache Settings
+ATTACHMENT_CACHE_DIR = "attachment_cache"  # Downloaded attachments, stored by SHA-256
+ATTACHMENT_CACHE_MAX_MB = 50  # Least recently used attachments are evicted beyond this
+ATTACHMENT_INDEX_SAVE_INTERVAL = 300  # Seconds between index writes caused only by cache hits
+
+# PDF Class Detection Cache
+PDF_CACHE_FILE = "pdf_class_cache.json"  # Detected classes per PDF (SHA-256 + CLASS_PATTERN)
+PDF_CACHE_MAX_ENTRIES = 2000  # Oldest results are dropped beyond this
@@ -0,0 +1,233 @@
+"""
+Dedupe Index Module
+Constant-time membership index for sent communication hashes
+Stored on disk as a compact base64 blob of packed MD5 digests
+"""
+
+import re
+import time
+import base64
+import struct
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+# Prefixes marking the packed on-disk forms
+PACKED_PREFIX = "md5b64:"
+TIMED_PREFIX = "md5t64:"
+
+_MD5_HEX = re.compile(r'[0-9a-f]{32}')
+_TIMESTAMP = struct.Struct('<I')
+
+
+def _to_key(item: str) -> Union[bytes, str]:
+    """Store MD5 hex digests as 16 raw bytes, anything else as-is"""
+    if len(item) == 32 and _MD5_HEX.fullmatch(item):
+        return bytes.fromhex(item)
+    return item
+
+
+def _from_key(key: Union[bytes, str]) -> str:
+    """Convert a stored key back to its original string form"""
+    return key.hex() if isinstance(key, bytes) else key
+
+
+class DedupeIndex:
+    """
+    Insertion-ordered set of sent communication hashes
+    Supports the list-style operations the state file used to rely on
+    
+    Each hash keeps the time it was sent (if known) for retention.
+    Hashes added or removed after construction are remembered as pending
+    so that incremental state backends only write what changed
+    """
+    
+    def __init__(self, items: Iterable[str] = ()):
+        self._keys: Dict[Union[bytes, str], Optional[float]] = dict.fromkeys(_to_key(item) for item in items)
+        self._added: Dict[Union[bytes, str], Optional[Dict]] = {}
+        self._removed: Dict[Union[bytes, str], None] = {}
+    
+    def __contains__(self, item) -> bool:
+        return isinstance(item, str) and _to_key(item) in self._keys
+    
+    def __len__(self) -> int:
+        return len(self._keys)
+    
+    def __iter__(self) -> Iterator[str]:
+        return (_from_key(key) for key in self._keys)
+    
+    def __eq__(self, other) -> bool:
+        if isinstance(other, DedupeIndex):
+            return list(self._keys) == list(other._keys)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        if isinstance(other, (set, frozenset)):
+            return set(self) == other
+        return NotImplemented
+    
+    def __repr__(self) -> str:
+        return f"DedupeIndex({len(self)} entries)"
+    
+    @classmethod
+    def from_entries(cls, entries: Iterable[Tuple[str, Optional[float]]]) -> 'DedupeIndex':
+        """
+        Build an index from stored (hash, sent_at) pairs
+        
+        Args:
+            entries: Iterable of (hash, sent_at or None)
+        
+        Returns:
+            DedupeIndex with no pending changes
+        """
+        index = cls()
+        index._keys = {_to_key(item): sent_at for item, sent_at in entries}
+        return index
+    
+    def add(self, item: str, meta: Optional[Dict] = None) -> bool:
+        """
+        Add a hash to the index
+        
+        Args:
+            item: Communication hash
+            meta: Optional metadata (e.g. sent_at, classes) for backends
+        
+        Returns:
+            True if the hash was not already present
+        """
+        key = _to_key(item)
+        if key in self._keys:
+            return False
+        self._keys[key] = meta.get('sent_at') if meta else None
+        self._added[key] = meta
+        self._removed.pop(key, None)
+        return True
+    
+    def update(self, items: Iterable[str]):
+        """Add several hashes at once"""
+        for item in items:
+            self.add(item)
+    
+    def discard(self, item: str):
+        """Remove a hash if present"""
+        self._discard_key(_to_key(item))
+    
+    def sent_at(self, item: str) -> Optional[float]:
+        """Return the recorded send time of a hash, if known"""
+        return self._keys.get(_to_key(item))
+    
+    def prune(self, max_age: Optional[float] = None, max_entries: Optional[int] = None,
+              protected: Iterable[str] = (), now: Optional[float] = None) -> List[str]:
+        """
+        Evict old hashes according to a retention policy
+        
+        Hashes without a recorded send time are only evicted by the entry
+        limit, oldest first. Protected hashes are never evicted.
+        
+        Args:
+            max_age: Evict hashes sent more than this many seconds ago
+            max_entries: Keep at most this many hashes
+            protected: Hashes that must be kept regardless of age
+            now: Current time (defaults to time.time())
+        
+        Returns:
+            List of evicted hashes
+        """
+        now = time.time() if now is None else now
+        protected_keys = {_to_key(item) for item in protected}
+        evicted = []
+        
+        if max_age:
+            cutoff = now - max_age
+            evicted = [key for key, sent_at in self._keys.items()
+                       if sent_at is not None and sent_at < cutoff and key not in protected_keys]
+            for key in evicted:
+                self._discard_key(key)
+        
+        if max_entries is not None and len(self._keys) > max_entries:
+            excess = len(self._keys) - max_entries
+            # Stable sort: unknown times first, then by send time and insertion order
+            candidates = sorted((key for key in self._keys if key not in protected_keys),
+                                key=lambda key: self._keys[key] or 0)
+            for key in candidates[:excess]:
+                self._discard_key(key)
+                evicted.append(key)
+        
+        return [_from_key(key) for key in evicted]
+    
+    def drain_added(self) -> List[Tuple[str, Optional[Dict]]]:
+        """
+        Return hashes added since the last drain and forget them
+        
+        Returns:
+            List of (hash, metadata) tuples in insertion order
+        """
+        added = [(_from_key(key), meta) for key, meta in self._added.items()]
+        self._added = {}
+        return added
+    
+    def drain_removed(self) -> List[str]:
+        """Return hashes removed since the last drain and forget them"""
+        removed = [_from_key(key) for key in self._removed]
+        self._removed = {}
+        return removed
+    
+    def to_json(self) -> Union[str, List]:
+        """
+        Serialize the index for the state file
+        
+        Returns:
+            Packed base64 string when every entry is an MD5 digest,
+            otherwise a list of hashes ([hash, sent_at] when the time is known)
+        """
+        if all(isinstance(key, bytes) for key in self._keys):
+            if any(sent_at is not None for sent_at in self._keys.values()):
+                packed = b''.join(key + _TIMESTAMP.pack(int(sent_at or 0)) for key, sent_at in self._keys.items())
+                return TIMED_PREFIX + base64.b64encode(packed).decode('ascii')
+            packed = b''.join(self._keys)
+            return PACKED_PREFIX + base64.b64encode(packed).decode('ascii')
+        return [_from_key(key) if sent_at is None else [_from_key(key), sent_at]
+                for key, sent_at in self._keys.items()]
+    
+    @classmethod
+    def from_json(cls, data: Union[str, List, None]) -> 'DedupeIndex':
+        """
+        Rebuild an index from its state file form
+        
+        Args:
+            data: Packed string from to_json() or a legacy list of hashes
+        
+        Returns:
+            DedupeIndex with the stored hashes
+        """
+        index = cls()
+        if not data:
+            return index
+        
+        if isinstance(data, str):
+            if data.startswith(TIMED_PREFIX):
+                packed = base64.b64decode(data[len(TIMED_PREFIX):])
+                for i in range(0, len(packed), 20):
+                    sent_at = _TIMESTAMP.unpack_from(packed, i + 16)[0]
+                    index._keys[packed[i:i + 16]] = float(sent_at) if sent_at else None
+                return index
+            if not data.startswith(PACKED_PREFIX):
+                raise ValueError("Unknown dedupe index format")
+            packed = base64.b64decode(data[len(PACKED_PREFIX):])
+            index._keys = dict.fromkeys(packed[i:i + 16] for i in range(0, len(packed), 16))
+            return index
+        
+        for entry in data:
+            if isinstance(entry, list):
+                index._keys.setdefault(_to_key(entry[0]), entry[1])
+            else:
+                index._keys.setdefault(_to_key(entry), None)
+        return index
+    
+    def _discard_key(self, key: Union[bytes, str]):
+        """Remove a stored key and record the removal for backends"""
+        if key not in self._keys:
+            return
+        del self._keys[key]
+        if key in self._added:
+            # Never persisted, nothing to delete on disk
+            del self._added[key]
+        else:
+            self._removed[key] = None
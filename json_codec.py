@@ -0,0 +1,53 @@
+"""
+JSON Codec Module
+JSON encoding and decoding for ClasseViva responses and the state files
+Uses orjson when it is installed and the standard json module otherwise;
+output is compact unless pretty=True
+"""
+
+import json
+from typing import Any, IO, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Name of the codec in use, for logs and benchmarks
+BACKEND = "orjson" if orjson is not None else "json"
+
+
+def loads(data: Union[str, bytes, bytearray]) -> Any:
+    """
+    Decode a JSON document
+    
+    Raises:
+        ValueError: If the document is not valid JSON
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj: Any, pretty: bool = False) -> str:
+    """
+    Encode an object as JSON text
+    
+    Args:
+        obj: Object to encode
+        pretty: Indent by two spaces instead of writing compact output
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if pretty else 0).decode()
+        except TypeError:
+            # Integers beyond 64 bits, non-string keys, ...: leave them to the json module
+            pass
+    if pretty:
+        return json.dumps(obj, indent=2)
+    return json.dumps(obj, separators=(',', ':'))
+
+
+def load(f: IO) -> Any:
+    """Decode the JSON document in a file"""
+    return loads(f.read())
@@ -0,0 +1,300 @@
+"""
+Outbox Module
+Durable queue of rendered Telegram notifications (SQLite, WAL mode)
+The poll loop enqueues, a background worker delivers with retries,
+so Telegram latency and outages never block or lose a notification
+"""
+
+import json
+import time
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from config import (
+    FANOUT_WORKERS, OUTBOX_FILE, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE, OUTBOX_RETRY_MAX, OUTBOX_KEEP_DAYS
+)
+
+logger = logging.getLogger(__name__)
+
+# Notification kinds, matching the TelegramNotifier send methods
+MESSAGE = "message"
+DOCUMENT = "document"
+MEDIA_GROUP = "media_group"
+
+
+class OutboxEntry(NamedTuple):
+    """A notification waiting in the outbox"""
+    id: int
+    chat_id: str
+    comm_hash: str
+    kind: str
+    text: str
+    attachments: List[Dict]
+    attempts: int
+
+
+class Outbox:
+    """
+    Persistent FIFO of notifications, one queue per chat
+    Each (chat, communication, part) is stored once, so enqueueing the same
+    communication again after a crash does not send it twice
+    """
+    
+    def __init__(self, path: str = OUTBOX_FILE, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 retry_base: float = OUTBOX_RETRY_BASE, retry_max: float = OUTBOX_RETRY_MAX):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                comm_hash TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                text TEXT NOT NULL,
+                attachments TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                created_at REAL NOT NULL,
+                delivered_at REAL,
+                last_error TEXT,
+                UNIQUE (chat_id, comm_hash, part)
+            );
+            CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, id);
+            CREATE INDEX IF NOT EXISTS outbox_chat ON outbox (status, chat_id, id);
+        """)
+        self.conn.commit()
+    
+    def enqueue(self, chat_id: str, comm_hash: str, parts: List[Dict]) -> int:
+        """
+        Queue the notifications for one communication
+        
+        Args:
+            chat_id: Telegram chat to deliver to
+            comm_hash: Hash of the communication (see comm_hash_for)
+            parts: Dicts with kind, text and attachments (list of {id, filename}),
+                   delivered in this order
+        
+        Returns:
+            Number of parts newly queued
+        """
+        now = time.time()
+        rows = [(str(chat_id), comm_hash, index, part['kind'], part.get('text', ''),
+                 json.dumps(part.get('attachments', [])), now, now)
+                for index, part in enumerate(parts)]
+        
+        with self._lock, self.conn:
+            before = self.conn.total_changes
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO outbox (chat_id, comm_hash, part, kind, text, attachments, "
+                "next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            return self.conn.total_changes - before
+    
+    # Oldest pending entry of each chat: later entries of a chat wait behind it
+    HEADS = ("SELECT o.id, o.chat_id, o.comm_hash, o.kind, o.text, o.attachments, o.attempts, o.next_attempt_at "
+             "FROM outbox o JOIN (SELECT MIN(id) AS id FROM outbox WHERE status = 'pending' GROUP BY chat_id) h "
+             "ON o.id = h.id")
+    
+    def due(self, now: Optional[float] = None) -> List[OutboxEntry]:
+        """
+        Head of each chat's queue, for the chats whose head may be attempted now
+        A chat waiting for a retry holds back only its own notifications
+        
+        Returns:
+            OutboxEntry list, oldest first
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            rows = self.conn.execute(
+                self.HEADS + " WHERE o.next_attempt_at <= ? ORDER BY o.id", (now,)
+            ).fetchall()
+        return [OutboxEntry(row[0], row[1], row[2], row[3], row[4], json.loads(row[5]), row[6]) for row in rows]
+    
+    def next_due(self, now: Optional[float] = None) -> Optional[OutboxEntry]:
+        """
+        Oldest notification that may be attempted now, see due()
+        
+        Returns:
+            OutboxEntry or None
+        """
+        entries = self.due(now)
+        return entries[0] if entries else None
+    
+    def next_attempt_in(self, now: Optional[float] = None) -> Optional[float]:
+        """Seconds until the first chat's queue is due, None if the outbox is empty"""
+        now = time.time() if now is None else now
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT MIN(next_attempt_at) FROM (" + self.HEADS + ")"
+            ).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - now)
+    
+    def mark_delivered(self, entry_id: int):
+        """Record a successful delivery"""
+        with self._lock, self.conn:
+            self.conn.execute(
+                "UPDATE outbox SET status = 'delivered', delivered_at = ?, attempts = attempts + 1 WHERE id = ?",
+                (time.time(), entry_id)
+            )
+    
+    def mark_failed(self, entry_id: int, error: str) -> bool:
+        """
+        Record a failed attempt and schedule the next one with exponential backoff
+        
+        Returns:
+            True if the entry will be retried, False if it was given up
+        """
+        with self._lock, self.conn:
+            attempts = self.conn.execute("SELECT attempts FROM outbox WHERE id = ?", (entry_id,)).fetchone()[0] + 1
+            if attempts >= self.max_attempts:
+                self.conn.execute(
+                    "UPDATE outbox SET status = 'failed', attempts = ?, last_error = ? WHERE id = ?",
+                    (attempts, error, entry_id)
+                )
+                return False
+            
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            self.conn.execute(
+                "UPDATE outbox SET attempts = ?, last_error = ?, next_attempt_at = ? WHERE id = ?",
+                (attempts, error, time.time() + delay, entry_id)
+            )
+            return True
+    
+    def purge(self, keep_days: float = OUTBOX_KEEP_DAYS) -> int:
+        """Forget delivered notifications older than keep_days"""
+        cutoff = time.time() - keep_days * 86400
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM outbox WHERE status = 'delivered' AND delivered_at < ?", (cutoff,)
+            ).rowcount
+    
+    def counts(self) -> Dict[str, int]:
+        """Number of notifications per status"""
+        with self._lock:
+            return dict(self.conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status"))
+    
+    def close(self):
+        """Close the database"""
+        with self._lock:
+            self.conn.close()
+
+
+class OutboxWorker:
+    """
+    Background thread delivering outbox entries, in order within each chat
+    Different chats are delivered at the same time, and a chat whose
+    delivery fails waits for its retry without holding back the others
+    
+    Args:
+        outbox: Outbox to drain
+        send: Callable delivering an OutboxEntry, returns True on success
+        idle_interval: Longest sleep when nothing is due
+        max_workers: Chats delivered at the same time
+    """
+    
+    def __init__(self, outbox: Outbox, send: Callable[[OutboxEntry], bool], idle_interval: float = 60,
+                 max_workers: int = FANOUT_WORKERS):
+        self.outbox = outbox
+        self.send = send
+        self.idle_interval = idle_interval
+        self.max_workers = max(1, max_workers)
+        self.delivered = 0
+        self.failed = 0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+    
+    def start(self):
+        """Start delivering in a daemon thread"""
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+    
+    def wake(self):
+        """Signal that new entries were queued"""
+        self._wake.set()
+    
+    def stop(self, timeout: Optional[float] = None):
+        """Stop after the deliveries in progress, if any"""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout)
+    
+    def _attempt(self, entry: OutboxEntry):
+        """Send one entry, returning (ok, error)"""
+        try:
+            ok = self.send(entry)
+            return ok, "" if ok else "send failed"
+        except Exception as e:
+            return False, str(e)
+    
+    def drain(self) -> int:
+        """
+        Deliver every entry that is due now
+        Each round sends the head of every due chat; a chat that fails
+        is not due again until its retry, so the next round skips it
+        
+        Returns:
+            Number of entries delivered
+        """
+        delivered = 0
+        # Communications whose attachments reached one chat in this drain,
+        # so the others can reuse the cached file_ids instead of uploading again
+        uploaded = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="outbox") as pool:
+            while not self._stop.is_set():
+                batch, deferred = [], False
+                uploading = set()
+                for entry in self.outbox.due():
+                    if entry.attachments and entry.comm_hash not in uploaded:
+                        if entry.comm_hash in uploading:
+                            deferred = True
+                            continue
+                        uploading.add(entry.comm_hash)
+                    batch.append(entry)
+                if not batch:
+                    break
+                
+                progress = False
+                for entry, (ok, error) in zip(batch, pool.map(self._attempt, batch)):
+                    if ok:
+                        self.outbox.mark_delivered(entry.id)
+                        self.delivered += 1
+                        delivered += 1
+                        progress = True
+                        if entry.attachments:
+                            uploaded.add(entry.comm_hash)
+                    else:
+                        self.failed += 1
+                        if not self.outbox.mark_failed(entry.id, error):
+                            logger.error(f"Giving up on outbox entry {entry.id} after {entry.attempts + 1} attempts: {error}")
+                            # The chat's next entry is due now
+                            progress = True
+                if not progress and not deferred:
+                    break
+        return delivered
+    
+    def _run(self):
+        """Worker loop"""
+        while not self._stop.is_set():
+            try:
+                self.drain()
+                self.outbox.purge()
+            except Exception as e:
+                logger.error(f"Outbox delivery failed: {e}")
+            
+            wait = self.outbox.next_attempt_in()
+            self._wake.wait(self.idle_interval if wait is None else min(wait, self.idle_interval))
+            self._wake.clear()
@@ -0,0 +1,153 @@
+"""
+Pipeline Module
+Runs work items through a chain of stages connected by bounded queues
+Each stage has its own worker threads; the final sink sees items in
+their original order, one at a time
+"""
+
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from config import PIPELINE_QUEUE_SIZE
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the input on a queue
+_DONE = object()
+
+
+class Stage(NamedTuple):
+    """A pipeline stage: func(item) -> item, run by a number of workers"""
+    name: str
+    func: Callable[[Any], Any]
+    workers: int = 1
+
+
+class _Slot(NamedTuple):
+    """An item in flight with its input position (error set if a stage failed)"""
+    seq: int
+    item: Any
+    error: Optional[BaseException] = None
+
+
+class Pipeline:
+    """
+    Fixed chain of stages with bounded queues between them
+    A full queue blocks the stage feeding it, so a slow stage holds back
+    its producers instead of letting work pile up in memory
+    """
+    
+    def __init__(self, stages: List[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.stages = stages
+        self.queue_size = queue_size
+        self.processed: Dict[str, int] = {stage.name: 0 for stage in stages}
+        self.failed: Dict[str, int] = {stage.name: 0 for stage in stages}
+    
+    def run(self, items: Iterable[Any], sink: Callable[[Any], None],
+            on_error: Optional[Callable[[Any, BaseException], None]] = None) -> int:
+        """
+        Push items through every stage and hand the results to sink in input order
+        
+        A failing stage drops its item: later stages skip it, on_error is
+        called with the item and the exception, and the sink moves on.
+        
+        Args:
+            items: Work items (consumed in a feeder thread)
+            sink: Called from the calling thread with each finished item
+            on_error: Optional cleanup callback for dropped items
+        
+        Returns:
+            Number of items delivered to sink
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]),
+                                    name="pipeline-feed", daemon=True)]
+        
+        for index, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            for n in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[index], queues[index + 1], remaining, lock,
+                          self.stages[index + 1].workers if index + 1 < len(self.stages) else 1),
+                    name=f"pipeline-{stage.name}-{n}", daemon=True))
+        
+        for thread in threads:
+            thread.start()
+        
+        delivered = self._drain(queues[-1], sink, on_error)
+        
+        for thread in threads:
+            thread.join()
+        return delivered
+    
+    def _feed(self, items: Iterable[Any], out: queue.Queue):
+        """Number the input items and queue them for the first stage"""
+        try:
+            for seq, item in enumerate(items):
+                out.put(_Slot(seq, item))
+        except Exception as e:
+            logger.error(f"Pipeline input failed: {e}")
+        finally:
+            for _ in range(self.stages[0].workers if self.stages else 1):
+                out.put(_DONE)
+    
+    def _work(self, stage: Stage, inbox: queue.Queue, out: queue.Queue,
+              remaining: List[int], lock: threading.Lock, downstream_workers: int):
+        """Worker loop for one stage; the last worker to finish closes the next queue"""
+        while True:
+            slot = inbox.get()
+            if slot is _DONE:
+                break
+            
+            if slot.error is None:
+                try:
+                    slot = _Slot(slot.seq, stage.func(slot.item))
+                    with lock:
+                        self.processed[stage.name] += 1
+                except Exception as e:
+                    logger.error(f"Pipeline stage {stage.name} failed: {e}")
+                    with lock:
+                        self.failed[stage.name] += 1
+                    slot = _Slot(slot.seq, slot.item, e)
+            out.put(slot)
+        
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            for _ in range(downstream_workers):
+                out.put(_DONE)
+    
+    def _drain(self, inbox: queue.Queue, sink: Callable[[Any], None],
+               on_error: Optional[Callable[[Any, BaseException], None]]) -> int:
+        """Deliver finished items in input order, buffering those that arrive early"""
+        pending: Dict[int, _Slot] = {}
+        next_seq = 0
+        delivered = 0
+        
+        while True:
+            slot = inbox.get()
+            if slot is _DONE:
+                break
+            pending[slot.seq] = slot
+            
+            while next_seq in pending:
+                ready = pending.pop(next_seq)
+                next_seq += 1
+                if ready.error is not None:
+                    if on_error:
+                        on_error(ready.item, ready.error)
+                    continue
+                try:
+                    sink(ready.item)
+                    delivered += 1
+                except Exception as e:
+                    logger.error(f"Pipeline sink failed: {e}")
+                    if on_error:
+                        on_error(ready.item, e)
+        
+        return delivered
@@ -0,0 +1,105 @@
+"""
+Polling Module
+Adaptive interval between two checks of an account
+Fast during school hours and right after new communications, exponentially
+slower at night, on weekends and after consecutive errors, with jitter so
+many accounts do not drift into lockstep
+"""
+
+import time
+import random
+from datetime import datetime, timedelta
+from typing import Callable, Optional, Sequence, Tuple
+
+from config import (
+    ACTIVE_HOURS, ACTIVE_WEEKDAYS, RECENT_ACTIVITY_WINDOW,
+    IDLE_MAX_INTERVAL, ERROR_MAX_INTERVAL, POLL_JITTER
+)
+
+
+class AdaptiveInterval:
+    """
+    Interval policy for one account
+    
+    Args:
+        base: Interval while active (CHECK_INTERVAL)
+        tz: Timezone the active hours refer to (ITALIAN_TZ)
+        active_hours: (start, end) hour of fast polling, end excluded
+        active_weekdays: Days with fast polling, Monday = 0
+        recent_window: Seconds of fast polling after new communications
+        idle_max: Longest interval outside active hours
+        error_max: Longest interval after consecutive errors
+        jitter: Random spread as a fraction of the interval (0.1 = +-10%)
+        clock: Wall clock time source
+        rand: Random number in [0, 1)
+    """
+    
+    def __init__(self, base: float, tz, active_hours: Tuple[int, int] = ACTIVE_HOURS,
+                 active_weekdays: Sequence[int] = ACTIVE_WEEKDAYS,
+                 recent_window: float = RECENT_ACTIVITY_WINDOW, idle_max: float = IDLE_MAX_INTERVAL,
+                 error_max: float = ERROR_MAX_INTERVAL, jitter: float = POLL_JITTER,
+                 clock: Callable[[], float] = time.time, rand: Callable[[], float] = random.random):
+        self.base = base
+        self.tz = tz
+        self.active_hours = active_hours
+        self.active_weekdays = set(active_weekdays)
+        self.recent_window = recent_window
+        self.idle_max = idle_max
+        self.error_max = error_max
+        self.jitter = jitter
+        self.clock = clock
+        self.rand = rand
+        self.errors = 0
+        self.idle_polls = 0
+        self.last_activity: Optional[float] = None
+    
+    def is_active(self, now: float) -> bool:
+        """True during active hours on an active weekday"""
+        local = datetime.fromtimestamp(now, self.tz)
+        start, end = self.active_hours
+        return local.weekday() in self.active_weekdays and start <= local.hour < end
+    
+    def until_active(self, now: float) -> float:
+        """Seconds until the next active period starts (0 if it already has)"""
+        if self.is_active(now):
+            return 0.0
+        
+        local = datetime.fromtimestamp(now, self.tz)
+        for days in range(8):
+            day = (local + timedelta(days=days)).date()
+            if day.weekday() not in self.active_weekdays:
+                continue
+            start = self.tz.localize(datetime(day.year, day.month, day.day, self.active_hours[0]))
+            if start.timestamp() > now:
+                return start.timestamp() - now
+        return float(self.idle_max)
+    
+    def next_interval(self, new_count: int = 0, error: Optional[Exception] = None) -> float:
+        """
+        Interval to wait after a poll
+        
+        Args:
+            new_count: New communications the poll found
+            error: Exception the poll raised, if any
+        
+        Returns:
+            Seconds until the next poll
+        """
+        now = self.clock()
+        self.errors = self.errors + 1 if error is not None else 0
+        if new_count:
+            self.last_activity = now
+        recent = self.last_activity is not None and now - self.last_activity < self.recent_window
+        
+        if self.errors:
+            interval = min(self.base * 2 ** self.errors, self.error_max)
+        elif recent or self.is_active(now):
+            self.idle_polls = 0
+            interval = self.base
+        else:
+            # Slow down step by step, but be back on time for the next school day
+            self.idle_polls += 1
+            interval = min(self.base * 2 ** self.idle_polls, self.idle_max)
+            interval = min(interval, max(self.base, self.until_active(now)))
+        
+        return interval * (1 + self.jitter * (2 * self.rand() - 1))
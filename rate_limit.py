@@ -0,0 +1,108 @@
+"""
+Rate Limit Module
+Token buckets pacing outgoing Telegram requests
+A global bucket caps the bot as a whole, one bucket per chat caps each
+conversation, and a 429 retry_after pauses the chat it was returned for
+"""
+
+import time
+import threading
+from typing import Callable, Dict
+
+from config import TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket
+    Callers reserve a token and sleep until it is theirs, so concurrent
+    senders are served in arrival order at the configured rate
+    """
+    
+    def __init__(self, rate: float, capacity: float, clock: Callable[[], float] = time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        # Time the token count refers to; in the future while paused
+        self._updated = clock()
+        self._lock = threading.Lock()
+    
+    def reserve(self) -> float:
+        """
+        Take a token, possibly one that only becomes available later
+        
+        Returns:
+            Seconds the caller has to wait before using it
+        """
+        with self._lock:
+            now = self.clock()
+            if now > self._updated:
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+            self.tokens -= 1
+            
+            wait = self._updated - now
+            if self.tokens < 0:
+                wait += -self.tokens / self.rate
+            return wait
+    
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next seconds (e.g. after a 429)"""
+        with self._lock:
+            resume_at = self.clock() + seconds
+            if resume_at > self._updated:
+                self._updated = resume_at
+                # Resume with a single token, then refill at the normal rate
+                self.tokens = min(self.tokens, 1.0)
+
+
+class RateLimiter:
+    """Global and per-chat token buckets for the Telegram Bot API"""
+    
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: float = TELEGRAM_CHAT_BURST, clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.clock = clock
+        self.sleep = sleep
+        self.global_bucket = TokenBucket(global_rate, global_rate, clock)
+        self.throttled = 0
+        self.waited = 0.0
+        self._chats: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+    
+    def _chat_bucket(self, chat_id: str) -> TokenBucket:
+        """Bucket of a chat, created on first use"""
+        with self._lock:
+            bucket = self._chats.get(str(chat_id))
+            if bucket is None:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst, self.clock)
+                self._chats[str(chat_id)] = bucket
+            return bucket
+    
+    def reserve(self, chat_id: str) -> float:
+        """
+        Take a chat and a global token without sleeping (for asyncio callers)
+        
+        Returns:
+            Seconds to wait before sending
+        """
+        wait = max(self._chat_bucket(chat_id).reserve(), self.global_bucket.reserve())
+        self.waited += max(wait, 0.0)
+        return wait
+    
+    def acquire(self, chat_id: str):
+        """Block until a request to chat_id may be sent"""
+        # Wait for the chat first so a paused chat does not hold global tokens
+        for bucket in (self._chat_bucket(chat_id), self.global_bucket):
+            wait = bucket.reserve()
+            if wait > 0:
+                self.waited += wait
+                self.sleep(wait)
+    
+    def pause(self, chat_id: str, seconds: float):
+        """Apply a retry_after returned by Telegram for chat_id"""
+        self.throttled += 1
+        self._chat_bucket(chat_id).pause(seconds)
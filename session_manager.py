@@ -0,0 +1,230 @@
+"""
+Session Manager Module
+Keeps the authenticated ClasseViva session alive across polls
+Re-authenticates only when the session expires or is rejected
+Optionally persists the session cookies across process restarts
+"""
+
+import os
+import re
+import json
+import time
+import logging
+from typing import Dict, Optional
+
+from config import SESSION_TTL
+
+logger = logging.getLogger(__name__)
+
+# Markers of the ClasseViva login page served in place of the requested data
+LOGIN_PAGE = re.compile(rb"auth-p7|type=[\"']?password", re.IGNORECASE)
+# Bytes of an HTML answer to a download read to look for the login page
+LOGIN_PAGE_PEEK = 64 * 1024
+
+
+def is_auth_failure(response, body: Optional[bytes] = None) -> bool:
+    """
+    Detect responses meaning the ClasseViva session is no longer valid
+    
+    Args:
+        response: requests.Response (or aiohttp.ClientResponse) returned
+                  by a ClasseViva endpoint
+        body: Response body (or its start), checked for the login page
+        
+    Returns:
+        True if the server rejected the session, redirected to login
+        or answered with the login page
+    """
+    status = getattr(response, 'status_code', None) or getattr(response, 'status', None)
+    if status in (401, 403):
+        return True
+    
+    # Expired sessions are redirected to the login page
+    if 'auth-p7' in str(response.url) or any('auth-p7' in str(r.url) for r in response.history):
+        return True
+    
+    # The Content-Type alone proves nothing: error pages are HTML too
+    if not body or body.lstrip()[:1] in (b'{', b'['):
+        return False
+    return LOGIN_PAGE.search(body) is not None
+
+
+class SessionManager:
+    """Tracks session lifetime and login statistics for a ClasseViva client"""
+    
+    def __init__(self, ttl: int = SESSION_TTL, cache_file: Optional[str] = None):
+        self.ttl = ttl
+        self.cache_file = cache_file
+        self.logged_in_at: Optional[float] = None
+        self.login_count = 0
+        self.relogin_count = 0
+        self.failed_logins = 0
+        self.reuse_count = 0
+        self.restored_count = 0
+        self.last_login_latency = 0.0
+        self.total_login_latency = 0.0
+        self.relogin_reasons: Dict[str, int] = {}
+        self._pending_reason: Optional[str] = None
+    
+    def is_valid(self) -> bool:
+        """Check whether the current session can be reused"""
+        if self.logged_in_at is None:
+            return False
+        
+        if self.ttl and time.monotonic() - self.logged_in_at >= self.ttl:
+            self.invalidate("ttl")
+            return False
+        
+        return True
+    
+    def invalidate(self, reason: str = "auth"):
+        """
+        Mark the current session as unusable
+        
+        Args:
+            reason: Why the session was dropped (e.g. 'ttl', 'auth')
+        """
+        if self.logged_in_at is not None:
+            logger.info(f"Session invalidated ({reason})")
+            self._pending_reason = reason
+        self.logged_in_at = None
+    
+    def ensure(self, client) -> bool:
+        """
+        Make sure the client holds a valid session, logging in if needed
+        
+        Args:
+            client: Object exposing a login() -> bool method
+            
+        Returns:
+            True if a usable session is available
+        """
+        if self.is_valid():
+            self.reuse_count += 1
+            return True
+        
+        return self.login(client)
+    
+    def login(self, client) -> bool:
+        """Run client.login() and record its latency"""
+        started = time.monotonic()
+        success = client.login()
+        return self._record_login(client, success, time.monotonic() - started)
+    
+    async def ensure_async(self, client) -> bool:
+        """Same as ensure() for clients with a coroutine login()"""
+        if self.is_valid():
+            self.reuse_count += 1
+            return True
+        
+        return await self.login_async(client)
+    
+    async def login_async(self, client) -> bool:
+        """Await client.login() and record its latency"""
+        started = time.monotonic()
+        success = await client.login()
+        return self._record_login(client, success, time.monotonic() - started)
+    
+    def _record_login(self, client, success: bool, latency: float) -> bool:
+        """Update login statistics and the session cache after a login attempt"""
+        self.last_login_latency = latency
+        self.total_login_latency += latency
+        
+        if not success:
+            self.failed_logins += 1
+            return False
+        
+        if self.login_count > 0:
+            self.relogin_count += 1
+            reason = self._pending_reason or "manual"
+            self.relogin_reasons[reason] = self.relogin_reasons.get(reason, 0) + 1
+        
+        self.login_count += 1
+        self._pending_reason = None
+        self.logged_in_at = time.monotonic()
+        self.save_cache(client)
+        return True
+    
+    def restore(self, client) -> bool:
+        """
+        Restore PHPSESSID/webidentity from the on-disk session cache
+        The restored session still has to be confirmed by a request
+        
+        Args:
+            client: Object with username, phpsessid and webidentity attributes
+            
+        Returns:
+            True if unexpired cookies were loaded into the client
+        """
+        entry = self._read_cache().get(client.username)
+        if not entry:
+            return False
+        
+        now = time.time()
+        expires_at = entry.get('expires_at', 0)
+        if expires_at <= now or not entry.get('phpsessid') or not entry.get('webidentity'):
+            return False
+        
+        client.phpsessid = entry['phpsessid']
+        client.webidentity = entry['webidentity']
+        
+        # Carry over the age of the cached session so the TTL still applies
+        age = max(0.0, now - entry.get('logged_in_at', now))
+        self.logged_in_at = time.monotonic() - age
+        self.restored_count += 1
+        return True
+    
+    def save_cache(self, client):
+        """Persist the client's session cookies with their expiry"""
+        if not self.cache_file or not client.phpsessid or not client.webidentity:
+            return
+        
+        now = time.time()
+        cache = self._read_cache()
+        cache[client.username] = {
+            'phpsessid': client.phpsessid,
+            'webidentity': client.webidentity,
+            'logged_in_at': now,
+            'expires_at': now + (self.ttl or SESSION_TTL),
+        }
+        
+        try:
+            tmp_path = f"{self.cache_file}.tmp"
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, self.cache_file)
+        except OSError as e:
+            logger.warning(f"Could not write session cache: {e}")
+    
+    def _read_cache(self) -> Dict:
+        """Read the session cache, ignoring missing or corrupt files"""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Could not read session cache: {e}")
+            return {}
+    
+    def stats(self) -> Dict:
+        """
+        Summarize session reuse for monitoring
+        
+        Returns:
+            Dictionary with login counts and latency figures
+        """
+        attempts = self.login_count + self.failed_logins
+        return {
+            'logins': self.login_count,
+            'relogins': self.relogin_count,
+            'failed_logins': self.failed_logins,
+            'reused': self.reuse_count,
+            'restored': self.restored_count,
+            'relogin_reasons': dict(self.relogin_reasons),
+            'last_login_latency': self.last_login_latency,
+            'avg_login_latency': self.total_login_latency / attempts if attempts else 0.0,
+        }
@@ -0,0 +1,408 @@
+"""
+State Store Module
+Persistence backends for the monitor state (sent communication hashes)
+JSON file (default), SQLite or an append-only journal with incremental writes
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from config import JOURNAL_COMPACT_THRESHOLD
+
+import json_codec
+from dedupe_index import DedupeIndex
+
+logger = logging.getLogger(__name__)
+
+
+def atomic_write(path: str, payload: str):
+    """Write a file via a fsync'd temporary file and an atomic rename"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def ensure_sent_index(state: Dict) -> DedupeIndex:
+    """Return state['sent_hashes'] as a DedupeIndex, converting legacy lists"""
+    sent_hashes = state.get('sent_hashes')
+    if not isinstance(sent_hashes, DedupeIndex):
+        sent_hashes = DedupeIndex(sent_hashes or [])
+        state['sent_hashes'] = sent_hashes
+    return sent_hashes
+
+
+class JsonStateStore:
+    """Stores the whole state in a single JSON file"""
+    
+    def __init__(self, path: str):
+        self.path = path
+        self._last_written: Optional[str] = None
+    
+    def load(self) -> Dict:
+        """Load state from the JSON file"""
+        if not os.path.exists(self.path):
+            return {'sent_hashes': DedupeIndex()}
+        
+        with open(self.path, 'r') as f:
+            state = json_codec.load(f)
+        state['sent_hashes'] = DedupeIndex.from_json(state.get('sent_hashes'))
+        return state
+    
+    def save(self, state: Dict):
+        """Rewrite the JSON file, skipping the write if nothing changed"""
+        sent_hashes = ensure_sent_index(state)
+        sent_hashes.drain_added()
+        sent_hashes.drain_removed()
+        
+        data = dict(state)
+        data['sent_hashes'] = sent_hashes.to_json()
+        payload = json_codec.dumps(data)
+        
+        if payload == self._last_written:
+            return
+        
+        atomic_write(self.path, payload)
+        self._last_written = payload
+    
+    def close(self):
+        """Nothing to release for the JSON backend"""
+
+
+class SqliteStateStore:
+    """
+    Stores the state in SQLite (WAL mode)
+    Each poll inserts only the newly sent hashes with their metadata
+    """
+    
+    def __init__(self, path: str, json_path: Optional[str] = None):
+        self.path = path
+        self.json_path = json_path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS sent (
+                hash TEXT PRIMARY KEY,
+                comm_id TEXT,
+                sent_at REAL,
+                classes TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+        self.conn.commit()
+        self._meta_cache: Dict[str, str] = {}
+    
+    def load(self) -> Dict:
+        """Load state from SQLite, migrating the JSON file on first use"""
+        self._migrate_json()
+        
+        sent_hashes = DedupeIndex.from_entries(self.conn.execute("SELECT hash, sent_at FROM sent ORDER BY rowid"))
+        
+        state = {}
+        self._meta_cache = {}
+        for key, value in self.conn.execute("SELECT key, value FROM meta"):
+            if key.startswith('_'):
+                continue
+            self._meta_cache[key] = value
+            state[key] = json_codec.loads(value)
+        
+        state['sent_hashes'] = sent_hashes
+        return state
+    
+    def save(self, state: Dict):
+        """Insert new hashes, delete evicted ones and update changed state keys"""
+        sent_hashes = ensure_sent_index(state)
+        added = sent_hashes.drain_added()
+        evicted = sent_hashes.drain_removed()
+        
+        meta_updates = {}
+        for key, value in state.items():
+            if key == 'sent_hashes':
+                continue
+            encoded = json_codec.dumps(value)
+            if self._meta_cache.get(key) != encoded:
+                meta_updates[key] = encoded
+        removed = [key for key in self._meta_cache if key not in state]
+        
+        if not added and not evicted and not meta_updates and not removed:
+            return
+        
+        with self.conn:
+            self.conn.executemany("DELETE FROM sent WHERE hash = ?", [(comm_hash,) for comm_hash in evicted])
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO sent (hash, comm_id, sent_at, classes) VALUES (?, ?, ?, ?)",
+                [self._sent_row(comm_hash, meta) for comm_hash, meta in added]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                meta_updates.items()
+            )
+            self.conn.executemany("DELETE FROM meta WHERE key = ?", [(key,) for key in removed])
+        
+        self._meta_cache.update(meta_updates)
+        for key in removed:
+            del self._meta_cache[key]
+    
+    def get_sent(self, comm_hash: str) -> Optional[Dict]:
+        """
+        Look up the stored metadata for a sent communication
+        
+        Args:
+            comm_hash: Communication hash
+        
+        Returns:
+            Dictionary with comm_id, sent_at and classes, or None
+        """
+        row = self.conn.execute(
+            "SELECT comm_id, sent_at, classes FROM sent WHERE hash = ?", (comm_hash,)
+        ).fetchone()
+        if row is None:
+            return None
+        return {
+            'comm_id': row[0],
+            'sent_at': row[1],
+            'classes': json_codec.loads(row[2]) if row[2] else [],
+        }
+    
+    def close(self):
+        """Close the database connection"""
+        self.conn.close()
+    
+    def _sent_row(self, comm_hash: str, meta: Optional[Dict]):
+        """Build a row for the sent table from index metadata"""
+        meta = meta or {}
+        classes = meta.get('classes')
+        return (
+            comm_hash,
+            meta.get('comm_id'),
+            meta.get('sent_at', time.time()),
+            json_codec.dumps(sorted(classes)) if classes else None,
+        )
+    
+    def _migrate_json(self):
+        """One-shot import of an existing state.json"""
+        migrated = self.conn.execute("SELECT 1 FROM meta WHERE key = '_migrated'").fetchone()
+        if migrated or not self.json_path or not os.path.exists(self.json_path):
+            return
+        
+        state = JsonStateStore(self.json_path).load()
+        sent_hashes = state.pop('sent_hashes')
+        
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO sent (hash, sent_at) VALUES (?, ?)",
+                [(comm_hash, sent_hashes.sent_at(comm_hash)) for comm_hash in sent_hashes]
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                [(key, json_codec.dumps(value)) for key, value in state.items()]
+            )
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('_migrated', ?)",
+                              (json_codec.dumps(time.time()),))
+        
+        os.replace(self.json_path, f"{self.json_path}.migrated")
+        logger.info(f"Migrated {len(sent_hashes)} hashes from {self.json_path}")
+
+
+class JournalStateStore:
+    """
+    Stores the state as a JSON snapshot plus an append-only journal
+    Each save appends one fsync'd line per change; once the journal grows
+    past the threshold a background thread rewrites the snapshot
+    
+    Files:
+        <path>              snapshot (same format as the JSON backend)
+        <path>.journal      changes since the snapshot
+        <path>.journal.old  changes being folded into a new snapshot
+    """
+    
+    def __init__(self, path: str, compact_threshold: int = JOURNAL_COMPACT_THRESHOLD):
+        self.path = path
+        self.journal_path = f"{path}.journal"
+        self.old_journal_path = f"{path}.journal.old"
+        self.compact_threshold = compact_threshold
+        self._lock = threading.Lock()
+        self._compactor: Optional[threading.Thread] = None
+        self._journal = None
+        self._journal_lines = 0
+        self._meta_cache: Dict[str, str] = {}
+    
+    def load(self) -> Dict:
+        """Load the snapshot and replay the journal on top of it"""
+        state = JsonStateStore(self.path).load()
+        sent_hashes = state['sent_hashes']
+        
+        self._journal_lines = 0
+        for journal_path in (self.old_journal_path, self.journal_path):
+            self._drop_torn_line(journal_path)
+            for entry in self._read_journal(journal_path):
+                op = entry.get('op')
+                if op == 'add':
+                    sent_hashes.add(entry['hash'], entry)
+                elif op == 'discard':
+                    sent_hashes.discard(entry['hash'])
+                elif op == 'set':
+                    state[entry['key']] = entry['value']
+                elif op == 'del':
+                    state.pop(entry['key'], None)
+                if journal_path == self.journal_path:
+                    self._journal_lines += 1
+        
+        # Replayed entries are already on disk
+        sent_hashes.drain_added()
+        sent_hashes.drain_removed()
+        self._meta_cache = {key: json_codec.dumps(value) for key, value in state.items() if key != 'sent_hashes'}
+        return state
+    
+    def save(self, state: Dict):
+        """Append the changes since the last save to the journal"""
+        sent_hashes = ensure_sent_index(state)
+        lines = []
+        
+        for comm_hash, meta in sent_hashes.drain_added():
+            entry = {'op': 'add', 'hash': comm_hash}
+            if meta and meta.get('sent_at') is not None:
+                entry['sent_at'] = meta['sent_at']
+            lines.append(json_codec.dumps(entry))
+        for comm_hash in sent_hashes.drain_removed():
+            lines.append(json_codec.dumps({'op': 'discard', 'hash': comm_hash}))
+        
+        for key, value in state.items():
+            if key == 'sent_hashes':
+                continue
+            encoded = json_codec.dumps(value)
+            if self._meta_cache.get(key) != encoded:
+                lines.append(json_codec.dumps({'op': 'set', 'key': key, 'value': value}))
+                self._meta_cache[key] = encoded
+        for key in [key for key in self._meta_cache if key not in state]:
+            lines.append(json_codec.dumps({'op': 'del', 'key': key}))
+            del self._meta_cache[key]
+        
+        if not lines:
+            return
+        
+        with self._lock:
+            if self._journal is None:
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write('\n'.join(lines) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_lines += len(lines)
+        
+        if self._journal_lines >= self.compact_threshold:
+            self.compact(state)
+    
+    def compact(self, state: Dict, background: bool = True):
+        """
+        Fold the journal into a new snapshot
+        
+        Args:
+            state: Current state (already fully journaled)
+            background: Write the snapshot in a background thread
+        """
+        with self._lock:
+            if self._compactor is not None and self._compactor.is_alive():
+                return
+            
+            data = dict(state)
+            data['sent_hashes'] = ensure_sent_index(state).to_json()
+            payload = json_codec.dumps(data)
+            
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            if os.path.exists(self.journal_path):
+                if os.path.exists(self.old_journal_path):
+                    # Merge into the pending old journal so nothing is lost
+                    with open(self.journal_path, 'r') as src, open(self.old_journal_path, 'a') as dst:
+                        dst.write(src.read())
+                        dst.flush()
+                        os.fsync(dst.fileno())
+                    os.remove(self.journal_path)
+                else:
+                    os.replace(self.journal_path, self.old_journal_path)
+            self._journal_lines = 0
+        
+        if background:
+            self._compactor = threading.Thread(target=self._write_snapshot, args=(payload,), daemon=True)
+            self._compactor.start()
+        else:
+            self._write_snapshot(payload)
+    
+    def close(self):
+        """Wait for a running compaction and close the journal"""
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+    
+    def _write_snapshot(self, payload: str):
+        """Replace the snapshot, then drop the folded journal"""
+        try:
+            atomic_write(self.path, payload)
+            os.remove(self.old_journal_path)
+            logger.info("State journal compacted")
+        except OSError as e:
+            logger.error(f"State journal compaction failed: {e}")
+    
+    def _drop_torn_line(self, path: str):
+        """Cut a partially written last line, so the next append starts on a line of its own"""
+        if not os.path.exists(path):
+            return
+        
+        with open(path, 'rb+') as f:
+            data = f.read()
+            if not data or data.endswith(b'\n'):
+                return
+            f.truncate(data.rfind(b'\n') + 1)
+            f.flush()
+            os.fsync(f.fileno())
+        logger.warning(f"Dropped a torn last line from {path}")
+    
+    def _read_journal(self, path: str) -> List[Dict]:
+        """Read journal entries, skipping a torn last line after a crash"""
+        if not os.path.exists(path):
+            return []
+        
+        entries = []
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    entries.append(json_codec.loads(line))
+                except ValueError:
+                    logger.warning(f"Skipping corrupt journal line in {path}")
+        return entries
+
+
+def create_state_store(backend: str, json_path: str, db_path: str):
+    """
+    Create the configured state backend
+    
+    Args:
+        backend: 'json', 'sqlite' or 'journal'
+        json_path: Path of the JSON state file
+        db_path: Path of the SQLite database
+    
+    Returns:
+        State store instance
+    """
+    if backend == 'sqlite':
+        return SqliteStateStore(db_path, json_path=json_path)
+    if backend == 'journal':
+        return JournalStateStore(json_path)
+    if backend == 'json':
+        return JsonStateStore(json_path)
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -0,0 +1,122 @@
+"""
+Subscriptions Module
+Registry of which Telegram chats receive which classes
+Kept in subscriptions.json as {chat_id: [class codes]}; an inverted index
+(class -> chats) makes routing cost proportional to the detected classes
+"""
+
+import os
+import json
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Set
+
+from config import SUBSCRIPTIONS_FILE
+
+logger = logging.getLogger(__name__)
+
+# Subscribes a chat to every communication, including those without classes
+ALL_CLASSES = "*"
+
+
+class SubscriptionRegistry:
+    """
+    Class code -> chat ID routing table
+    
+    Args:
+        path: JSON file with the subscriptions (None keeps them in memory only)
+        default_chat: Chat subscribed to everything when the file does not exist yet,
+                      or cannot be read
+    """
+    
+    def __init__(self, path: Optional[str] = SUBSCRIPTIONS_FILE, default_chat: Optional[str] = None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chats: Dict[str, Set[str]] = {}
+        self._by_class: Dict[str, Set[str]] = {}
+        
+        if path and os.path.exists(path) and self._load():
+            return
+        if default_chat:
+            self._add(str(default_chat), [ALL_CLASSES])
+    
+    def subscribe(self, chat_id: str, classes: Iterable[str]):
+        """Add classes (or ALL_CLASSES) to a chat's subscriptions"""
+        with self._lock:
+            self._add(str(chat_id), classes)
+            self._save()
+    
+    def unsubscribe(self, chat_id: str, classes: Optional[Iterable[str]] = None):
+        """Remove some classes from a chat, or the whole chat if classes is None"""
+        chat_id = str(chat_id)
+        with self._lock:
+            current = self._chats.get(chat_id, set())
+            for class_code in list(current if classes is None else classes):
+                class_code = class_code.upper()
+                current.discard(class_code)
+                subscribers = self._by_class.get(class_code)
+                if subscribers is not None:
+                    subscribers.discard(chat_id)
+                    if not subscribers:
+                        del self._by_class[class_code]
+            if not current:
+                self._chats.pop(chat_id, None)
+            self._save()
+    
+    def chats_for(self, classes: Iterable[str]) -> Set[str]:
+        """
+        Chats that should receive a communication
+        
+        Args:
+            classes: Classes detected in the communication
+        
+        Returns:
+            Chats subscribed to any of the classes, plus those subscribed to everything
+        """
+        with self._lock:
+            chats = set(self._by_class.get(ALL_CLASSES, ()))
+            for class_code in classes:
+                chats.update(self._by_class.get(class_code.upper(), ()))
+            return chats
+    
+    def classes_of(self, chat_id: str) -> Set[str]:
+        """Classes a chat is subscribed to"""
+        with self._lock:
+            return set(self._chats.get(str(chat_id), ()))
+    
+    def __len__(self) -> int:
+        return len(self._chats)
+    
+    def _add(self, chat_id: str, classes: Iterable[str]):
+        """Update both indexes (lock held by the caller)"""
+        for class_code in classes:
+            class_code = class_code.upper()
+            self._chats.setdefault(chat_id, set()).add(class_code)
+            self._by_class.setdefault(class_code, set()).add(chat_id)
+    
+    def _load(self) -> bool:
+        """Build the indexes from the subscriptions file, returning False if it is unreadable"""
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+            for chat_id, classes in data.items():
+                self._add(str(chat_id), classes)
+            return True
+        except (OSError, ValueError, AttributeError, TypeError) as e:
+            logger.warning(f"Subscriptions file unreadable, falling back to the default chat: {e}")
+            self._chats.clear()
+            self._by_class.clear()
+            return False
+    
+    def _save(self):
+        """Atomically rewrite the subscriptions file (lock held by the caller)"""
+        if not self.path:
+            return
+        
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({chat: sorted(classes) for chat, classes in self._chats.items()}, f, indent=2)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logger.warning(f"Could not write subscriptions file: {e}")
@@ -0,0 +1,240 @@
+"""
+Unit tests for multi-account monitoring
+"""
+
+import os
+import json
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import requests
+
+from accounts import (
+    Account, AccountPoller, PollFailed, PollScheduler, account_for, load_accounts, deliver_via
+)
+from monitor import ClasseVivaMonitor
+from outbox import OutboxEntry, DOCUMENT
+
+
+class FakeClock:
+    """Manually advanced monotonic clock"""
+    
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+def offline_monitor(account: Account, login: bool = True) -> ClasseVivaMonitor:
+    """Monitor whose requests to ClasseViva fail (or whose login is refused)"""
+    monitor = ClasseVivaMonitor(account.username, account.password,
+                                session_cache_file=account.session_cache_file, notifier=mock.Mock())
+    monitor.login = mock.Mock(return_value=login)
+    monitor.phpsessid, monitor.webidentity = "sess", "S123W"
+    monitor.session = mock.Mock(**{'post.side_effect': requests.ConnectionError("ClasseViva offline")})
+    return monitor
+
+
+class FakePoller:
+    """Poller that records when it ran and how many polls overlapped"""
+    
+    def __init__(self, name: str, duration: float = 0.0):
+        self.name = name
+        self.duration = duration
+        self.started = []
+        self.active = False
+        self.overlapped = False
+    
+    def poll(self) -> int:
+        if self.active:
+            self.overlapped = True
+        self.active = True
+        self.started.append(time.monotonic())
+        time.sleep(self.duration)
+        self.active = False
+        return 1
+
+
+class TestLoadAccounts(unittest.TestCase):
+    """Test cases for the accounts file"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "accounts.json")
+        self.root = os.path.join(self.tmpdir.name, "accounts")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_missing_file_uses_default(self):
+        """Test that without a file only the built-in account is monitored"""
+        default = Account("default", "u", "p", "state.json", "state.db", "session_cache.json")
+        self.assertEqual(load_accounts(self.path, default=default), [default])
+    
+    def test_accounts_get_own_files(self):
+        """Test that every account keeps its state in its own directory"""
+        with open(self.path, 'w') as f:
+            json.dump([{'name': 'anna', 'username': 'a@x.it', 'password': '1'},
+                       {'name': 'papà', 'username': 'b@x.it', 'password': '2'}], f)
+        
+        accounts = load_accounts(self.path, root=self.root)
+        self.assertEqual([a.name for a in accounts], ['anna', 'papà'])
+        self.assertEqual(accounts[0].state_file, os.path.join(self.root, 'anna', 'state.json'))
+        self.assertNotEqual(accounts[0].session_cache_file, accounts[1].session_cache_file)
+    
+    def test_invalid_entries(self):
+        """Test that missing fields and duplicate names are rejected"""
+        for entries in ([{'name': 'anna'}],
+                        [{'name': 'a', 'username': 'x', 'password': 'y'}] * 2):
+            with open(self.path, 'w') as f:
+                json.dump(entries, f)
+            with self.assertRaises(ValueError):
+                load_accounts(self.path, root=self.root)
+
+
+class TestAccountPoller(unittest.TestCase):
+    """Test cases for AccountPoller"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.account = account_for("anna", "a@x.it", "1", root=self.tmpdir.name)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_state_per_account(self):
+        """Test that each account saves to and resumes from its own state"""
+        monitor = mock.Mock()
+        
+        def check_updates(state, is_first_run):
+            state['sent_hashes'].add("0" * 32)
+            monitor.state_store.save(state)
+            return 1
+        monitor.check_updates.side_effect = check_updates
+        
+        poller = AccountPoller(self.account, monitor)
+        self.assertTrue(poller.first_run)
+        self.assertEqual(poller.poll(), 1)
+        monitor.check_updates.assert_called_once_with(poller.state, is_first_run=True)
+        self.assertFalse(poller.first_run)
+        poller.close()
+        
+        self.assertTrue(os.path.exists(self.account.state_file))
+        resumed = AccountPoller(self.account, mock.Mock())
+        self.assertFalse(resumed.first_run)
+        resumed.close()
+    
+    def test_failed_login_is_an_error(self):
+        """Test that a refused login fails the poll instead of reporting nothing new"""
+        poller = AccountPoller(self.account, offline_monitor(self.account, login=False))
+        with self.assertRaises(PollFailed):
+            poller.poll()
+        self.assertEqual(poller.errors, 1)
+        self.assertTrue(poller.first_run)
+        poller.close()
+
+
+class TestPollScheduler(unittest.TestCase):
+    """Test cases for PollScheduler"""
+    
+    def test_staggered_start(self):
+        """Test that accounts start spread over the interval, in order"""
+        pollers = [FakePoller(str(i)) for i in range(4)]
+        scheduler = PollScheduler(pollers, interval=0.4, max_concurrent=4)
+        
+        start = time.monotonic()
+        scheduler.run(max_polls=4)
+        
+        offsets = [p.started[0] - start for p in pollers]
+        self.assertEqual(offsets, sorted(offsets))
+        for index, offset in enumerate(offsets):
+            self.assertAlmostEqual(offset, index * 0.1, delta=0.05)
+    
+    def test_concurrency_cap(self):
+        """Test that no more than max_concurrent polls run together"""
+        pollers = [FakePoller(str(i), duration=0.1) for i in range(6)]
+        scheduler = PollScheduler(pollers, interval=0.01, max_concurrent=2)
+        scheduler.run(max_polls=12)
+        
+        self.assertEqual(scheduler.max_running, 2)
+        self.assertFalse(any(p.overlapped for p in pollers))
+    
+    def test_errors_reported(self):
+        """Test that an account whose requests fail is reported, backed off and polled again"""
+        results = []
+        policy = mock.Mock(**{'next_interval.return_value': 0.01})
+        with tempfile.TemporaryDirectory() as tmpdir:
+            account = account_for("rotto", "a@x.it", "1", root=tmpdir)
+            poller = AccountPoller(account, offline_monitor(account))
+            scheduler = PollScheduler([poller], interval=0.01, make_policy=lambda: policy,
+                                      on_result=lambda p, count, error: results.append(error))
+            scheduler.run(max_polls=2)
+            poller.close()
+        
+        self.assertEqual(len(results), 2)
+        self.assertIsInstance(results[0], PollFailed)
+        self.assertEqual(poller.errors, 2)
+        self.assertIsInstance(policy.next_interval.call_args[0][1], PollFailed)
+    
+    def test_adaptive_policy(self):
+        """Test that each account gets its own interval policy"""
+        policies = []
+        
+        def make_policy():
+            policy = mock.Mock()
+            policy.next_interval.return_value = 0.01 * (len(policies) + 1)
+            policies.append(policy)
+            return policy
+        
+        pollers = [FakePoller("a"), FakePoller("b")]
+        scheduler = PollScheduler(pollers, interval=0.02, make_policy=make_policy)
+        scheduler.run(max_polls=4)
+        
+        self.assertEqual(len(policies), 2)
+        policies[0].next_interval.assert_called_with(1, None)
+        policies[1].next_interval.assert_called_with(1, None)
+        # The account with the shorter interval is polled more often
+        self.assertGreater(len(pollers[0].started), len(pollers[1].started))
+    
+    def test_polls_per_day(self):
+        """Test the polls-per-day figure over a simulated hour"""
+        clock = FakeClock()
+        scheduler = PollScheduler([FakePoller("a")], interval=60, clock=clock)
+        scheduler._started_at = clock.now
+        for _ in range(30):
+            scheduler._poll(0, clock.now)
+            clock.now += 120
+        self.assertAlmostEqual(scheduler.polls_per_day(), 30 * 86400 / 3600)
+    
+    def test_stop(self):
+        """Test that stop() ends run() while it waits"""
+        scheduler = PollScheduler([FakePoller("a")], interval=60)
+        thread = threading.Thread(target=scheduler.run)
+        thread.start()
+        time.sleep(0.05)
+        scheduler.stop()
+        thread.join(timeout=2)
+        self.assertFalse(thread.is_alive())
+
+
+class TestDeliverVia(unittest.TestCase):
+    """Test cases for outbox delivery with several accounts"""
+    
+    def test_routed_to_account(self):
+        """Test that queued attachments are fetched by the account that saw them"""
+        pollers = [mock.Mock(monitor=mock.Mock()), mock.Mock(monitor=mock.Mock())]
+        pollers[0].name, pollers[1].name = "anna", "papà"
+        deliver = deliver_via(pollers)
+        
+        entry = OutboxEntry(1, "42", "h", DOCUMENT, "", [{'id': '5', 'filename': 'a.pdf', 'account': 'papà'}], 0)
+        deliver(entry)
+        pollers[1].monitor.deliver.assert_called_once_with(entry)
+        pollers[0].monitor.deliver.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,309 @@
+"""
+Unit tests for the asyncio engine
+Run against local stand-in ClasseViva and Telegram servers
+"""
+
+import os
+import json
+import tempfile
+import functools
+import unittest
+from unittest import mock
+
+try:
+    from aiohttp import ClientSession, web
+    from aiohttp.test_utils import TestServer
+    import async_engine
+    from async_engine import AsyncClasseVivaClient, AsyncTelegramNotifier, AsyncMonitor
+    from attachments import Attachment, FileIdCache, stream_response_async
+    import monitor
+    from monitor import TelegramNotifier
+    HAS_AIOHTTP = True
+except ImportError:
+    HAS_AIOHTTP = False
+
+
+class FakeClasseViva:
+    """Stand-in for the ClasseViva endpoints used by the monitor"""
+    
+    def __init__(self):
+        self.communications = []
+        self.attachments = {}
+        self.sessions = set()
+        self.logins = 0
+    
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/auth-p7/app/default/AuthApi4.php', self.login)
+        app.router.add_post('/sif/app/default/bacheca_personale.php', self.list_communications)
+        app.router.add_get('/sif/app/default/bacheca_personale.php', self.download)
+        return app
+    
+    def authorized(self, request):
+        cookies = request.cookies
+        return cookies.get('PHPSESSID') in self.sessions and cookies.get('webidentity') == 'S123W'
+    
+    async def login(self, request):
+        form = await request.post()
+        if form['pwd'] != 'secret':
+            return web.json_response({'error': 'credenziali errate'})
+        
+        self.logins += 1
+        sid = f"sid{self.logins}"
+        self.sessions.add(sid)
+        response = web.json_response({'data': {'auth': {'accountInfo': {'type': 'S', 'id': '123'}}}})
+        response.set_cookie('PHPSESSID', sid)
+        return response
+    
+    async def list_communications(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        return web.json_response({'data': self.communications})
+    
+    async def download(self, request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        return web.Response(body=self.attachments[request.query['id']])
+
+
+class FakeTelegram:
+    """Stand-in for the Bot API that records every call"""
+    
+    def __init__(self):
+        self.calls = []
+        self.statuses = []
+        self.description = "Bad Request"
+    
+    def app(self):
+        app = web.Application()
+        app.router.add_post('/bottoken/{method}', self.handle)
+        return app
+    
+    async def handle(self, request):
+        method = request.match_info['method']
+        if request.content_type == 'application/json':
+            fields = await request.json()
+        else:
+            fields = {}
+            for name, value in (await request.post()).items():
+                fields[name] = value.file.read() if hasattr(value, 'file') else value
+        self.calls.append((method, fields))
+        
+        if self.statuses:
+            status = self.statuses.pop(0)
+            return web.json_response({'ok': False, 'parameters': {'retry_after': 0.05},
+                                      'description': self.description}, status=status)
+        
+        file_id = f"F{len(self.calls)}"
+        if method == 'sendDocument':
+            return web.json_response({'ok': True, 'result': {'document': {'file_id': file_id}}})
+        if method == 'sendMediaGroup':
+            count = len(json.loads(fields['media']))
+            return web.json_response({'ok': True, 'result': [{'document': {'file_id': f"{file_id}_{i}"}}
+                                                             for i in range(count)]})
+        return web.json_response({'ok': True})
+
+
+@unittest.skipUnless(HAS_AIOHTTP, "aiohttp not installed")
+class TestAsyncEngine(unittest.IsolatedAsyncioTestCase):
+    """Test cases for the asyncio engine"""
+    
+    async def asyncSetUp(self):
+        self.classeviva = FakeClasseViva()
+        self.telegram = FakeTelegram()
+        self.classeviva_server = TestServer(self.classeviva.app())
+        self.telegram_server = TestServer(self.telegram.app())
+        await self.classeviva_server.start_server()
+        await self.telegram_server.start_server()
+        
+        self.http = ClientSession()
+        self.client = AsyncClasseVivaClient("test@example.com", "secret", self.http,
+                                            base_url=str(self.classeviva_server.make_url('/')))
+        self.notifier = AsyncTelegramNotifier(TelegramNotifier("token", "42"), self.http,
+                                              api_url=str(self.telegram_server.make_url('/')))
+    
+    async def asyncTearDown(self):
+        self.notifier.close()
+        await self.http.close()
+        await self.classeviva_server.close()
+        await self.telegram_server.close()
+    
+    async def test_login_and_fetch(self):
+        """Test login followed by a communications request"""
+        self.classeviva.communications = [{'evtId': '1', 'evtText': 'Circolare'}]
+        
+        self.assertEqual(await self.client.fetch_communications(), self.classeviva.communications)
+        self.assertEqual(self.client.phpsessid, 'sid1')
+        self.assertEqual(self.client.webidentity, 'S123W')
+        
+        # Second poll reuses the session
+        await self.client.fetch_communications()
+        self.assertEqual(self.classeviva.logins, 1)
+    
+    async def test_wrong_password(self):
+        """Test that a rejected login returns no communications"""
+        self.client.password = "wrong"
+        self.assertEqual(await self.client.fetch_communications(), [])
+        self.assertEqual(self.client.session_manager.stats()['failed_logins'], 1)
+    
+    async def test_expired_session_relogin(self):
+        """Test that a 401 triggers one re-login and a retry"""
+        self.classeviva.communications = [{'evtId': '1'}]
+        await self.client.fetch_communications()
+        self.classeviva.sessions.clear()
+        
+        self.assertEqual(await self.client.fetch_communications(), [{'evtId': '1'}])
+        self.assertEqual(self.classeviva.logins, 2)
+        self.assertEqual(self.client.session_manager.stats()['relogin_reasons'], {'auth': 1})
+    
+    async def test_download_attachment(self):
+        """Test streaming an attachment and enforcing the size cap"""
+        self.classeviva.attachments['7'] = b"%PDF-1.4 test"
+        await self.client.login()
+        
+        with await self.client.download_attachment('7', 'circolare.pdf') as attachment:
+            self.assertEqual(attachment.read(), b"%PDF-1.4 test")
+        
+        capped = functools.partial(stream_response_async, max_bytes=4)
+        with mock.patch.object(async_engine, 'stream_response_async', capped):
+            self.assertIsNone(await self.client.download_attachment('7', 'circolare.pdf'))
+    
+    async def test_check_updates_order(self):
+        """Test a full cycle: messages and documents reach Telegram in order"""
+        self.classeviva.communications = [
+            {'evtId': '1', 'evtText': 'Prima'},
+            {'evtId': '2', 'evtText': 'Seconda',
+             'allegati': [{'allegato_id': '9', 'filename': 'orario.pdf'}]},
+            {'evtId': '3', 'evtText': 'Terza'},
+        ]
+        self.classeviva.attachments['9'] = b"%PDF orario"
+        
+        detector = mock.Mock()
+        detector.detect_classes_in_text.return_value = set()
+        detector.detect_classes_in_pdf.return_value = {'3BC'}
+        engine = AsyncMonitor(self.client, self.notifier, monitor, detector)
+        
+        state = {'sent_hashes': []}
+        with mock.patch.object(monitor, 'save_state') as save_state:
+            self.assertEqual(await engine.check_updates(state), 3)
+            save_state.assert_called_once_with(state)
+        
+        methods = [method for method, _ in self.telegram.calls]
+        self.assertEqual(methods, ['sendMessage', 'sendDocument', 'sendMessage'])
+        self.assertIn('Prima', self.telegram.calls[0][1]['text'])
+        self.assertIn('3BC', self.telegram.calls[1][1]['caption'])
+        self.assertEqual(self.telegram.calls[1][1]['document'], b"%PDF orario")
+        self.assertIn('Terza', self.telegram.calls[2][1]['text'])
+        self.assertEqual(len(state['sent_hashes']), 3)
+        
+        # Nothing is sent twice
+        with mock.patch.object(monitor, 'save_state'):
+            self.assertEqual(await engine.check_updates(state), 0)
+    
+    async def test_media_group(self):
+        """Test sending several documents as a media group"""
+        documents = [Attachment.from_bytes("a.pdf", b"A"), Attachment.from_bytes("b.pdf", b"B")]
+        
+        self.assertTrue(await self.notifier.send_media_group(documents, caption="x"))
+        method, fields = self.telegram.calls[0]
+        self.assertEqual(method, 'sendMediaGroup')
+        self.assertEqual([m['media'] for m in json.loads(fields['media'])], ['attach://attach_0', 'attach://attach_1'])
+        self.assertEqual(fields['attach_1'], b"B")
+    
+    
+    async def test_429_rescheduled(self):
+        """Test that a throttled upload is sent again after retry_after"""
+        self.telegram.statuses = [429]
+        document = Attachment.from_bytes("a.pdf", b"%PDF")
+        
+        self.assertTrue(await self.notifier.send_document(document, caption="x"))
+        self.assertEqual([method for method, _ in self.telegram.calls], ['sendDocument'] * 2)
+        self.assertEqual(self.telegram.calls[1][1]['document'], b"%PDF")
+        self.assertEqual(self.notifier.rate_limiter.throttled, 1)
+    
+    async def test_file_id_reused(self):
+        """Test that a document already uploaded is sent by file_id"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.notifier.notifier.file_ids = FileIdCache(os.path.join(tmpdir, "file_ids.json"))
+            first = Attachment.from_bytes("a.pdf", b"%PDF")
+            second = Attachment.from_bytes("b.pdf", b"%PDF altro")
+            
+            self.assertTrue(await self.notifier.send_document(first))
+            self.assertTrue(await self.notifier.send_media_group([first, second]))
+        
+        fields = self.telegram.calls[1][1]
+        self.assertEqual([m['media'] for m in json.loads(fields['media'])], ['F1', 'attach://attach_1'])
+        self.assertNotIn('attach_0', fields)
+        self.assertEqual(fields['attach_1'], b"%PDF altro")
+    
+    async def test_stale_file_id(self):
+        """Test that only a file identifier error drops the cached file_id"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.notifier.notifier.file_ids = FileIdCache(os.path.join(tmpdir, "file_ids.json"))
+            document = Attachment.from_bytes("a.pdf", b"%PDF")
+            self.notifier.remember_file_ids([document], {'document': {'file_id': "OLD"}})
+            
+            self.telegram.statuses = [400]
+            self.telegram.description = "Bad Request: message caption is too long"
+            self.assertFalse(await self.notifier.send_document(document))
+            self.assertEqual(self.notifier.cached_file_id(document), "OLD")
+            
+            self.telegram.statuses = [400]
+            self.telegram.description = "Bad Request: wrong file identifier/HTTP URL specified"
+            self.assertTrue(await self.notifier.send_document(document))
+        
+        self.assertEqual(len(self.telegram.calls), 3)
+        self.assertEqual(self.telegram.calls[2][1]['document'], b"%PDF")
+    
+    async def test_adaptive_interval(self):
+        """Test that the interval policy decides the wait between checks"""
+        policy = mock.Mock(**{'next_interval.return_value': 0.01})
+        engine = AsyncMonitor(self.client, self.notifier, monitor,
+                              mock.Mock(**{'detect_classes_in_text.return_value': set()}))
+        
+        with mock.patch.object(monitor, 'load_state', return_value={'sent_hashes': []}), \
+                mock.patch.object(monitor, 'save_state'):
+            await engine.run(3600, cycles=2, policy=policy)
+        self.assertEqual(policy.next_interval.call_count, 2)
+        self.assertIsNone(policy.next_interval.call_args.args[1])
+    
+    async def test_failed_login_backs_off(self):
+        """Test that a failed login reaches the interval policy as an error"""
+        self.client.password = "wrong"
+        policy = mock.Mock(**{'next_interval.return_value': 0.01})
+        engine = AsyncMonitor(self.client, self.notifier, monitor)
+        
+        with mock.patch.object(monitor, 'load_state', return_value={'sent_hashes': []}), \
+                mock.patch.object(monitor, 'save_state'):
+            await engine.run(3600, cycles=1, policy=policy)
+        self.assertIsInstance(policy.next_interval.call_args.args[1], async_engine.PollFailed)
+    
+    def test_unsupported_settings(self):
+        """Test that settings the engine would silently ignore are reported"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            accounts = os.path.join(tmpdir, "accounts.json")
+            subscriptions = os.path.join(tmpdir, "subscriptions.json")
+            with mock.patch.multiple(monitor, ACCOUNTS_FILE=accounts, SUBSCRIPTIONS_FILE=subscriptions,
+                                     DIGEST_MODE=False):
+                self.assertEqual(monitor.async_engine_conflicts(), [])
+                
+                open(accounts, 'w').close()
+                monitor.DIGEST_MODE = True
+                self.assertEqual(monitor.async_engine_conflicts(), [accounts, "DIGEST_MODE"])
+    
+    async def test_failed_send_not_marked(self):
+        """Test that a communication Telegram keeps refusing stays unsent"""
+        self.classeviva.communications = [{'evtId': '1', 'evtText': 'Prima'}]
+        self.telegram.statuses = [500]
+        engine = AsyncMonitor(self.client, self.notifier, monitor,
+                              mock.Mock(**{'detect_classes_in_text.return_value': set()}))
+        
+        state = {'sent_hashes': []}
+        with mock.patch.object(monitor, 'save_state'):
+            self.assertEqual(await engine.check_updates(state), 0)
+            self.assertEqual(len(state['sent_hashes']), 0)
+            self.assertEqual(await engine.check_updates(state), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,347 @@
+"""
+Unit tests for attachment handling
+"""
+
+import io
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from attachments import Attachment, AttachmentCache, AttachmentTooLarge, FileIdCache, stream_response
+from monitor import ClasseVivaMonitor
+
+
+class TestAttachmentCache(unittest.TestCase):
+    """Test cases for AttachmentCache"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.directory = os.path.join(self.tmpdir.name, "cache")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_put_and_get(self):
+        """Test storing and retrieving an attachment"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        self.assertIsNone(cache.get("123"))
+        
+        sha256 = cache.put("123", b"%PDF-1.4 content")
+        self.assertEqual(sha256, hashlib.sha256(b"%PDF-1.4 content").hexdigest())
+        self.assertEqual(cache.get("123"), b"%PDF-1.4 content")
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        
+        # Survives a restart
+        self.assertEqual(AttachmentCache(self.directory, max_mb=1).get("123"), b"%PDF-1.4 content")
+    
+    def test_content_addressed(self):
+        """Test that identical content is stored once"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        cache.put("1", b"same circular")
+        cache.put("2", b"same circular")
+        
+        self.assertEqual(len(os.listdir(cache.blob_dir)), 1)
+        self.assertEqual(cache.get("2"), b"same circular")
+    
+    def test_lru_eviction(self):
+        """Test that least recently used blobs are evicted beyond the cap"""
+        cache = AttachmentCache(self.directory, max_mb=2500 / (1024 * 1024))
+        with mock.patch('attachments.time.time', side_effect=[1.0, 2.0, 3.0, 4.0]):
+            cache.put("a", b"a" * 1000)
+            cache.put("b", b"b" * 1000)
+            cache.get("a")
+            cache.put("c", b"c" * 1000)
+        
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), b"a" * 1000)
+        self.assertEqual(cache.get("c"), b"c" * 1000)
+        self.assertLessEqual(cache.total_size(), 2500)
+    
+    def test_hits_do_not_rewrite_index(self):
+        """Test that last use from cache hits is saved on close, not on every hit"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        sha256 = cache.put("123", b"content")
+        mtime = os.stat(cache.index_path).st_mtime_ns
+        
+        with mock.patch('attachments.time.time', return_value=5e9):
+            for _ in range(3):
+                cache.get("123")
+        self.assertEqual(os.stat(cache.index_path).st_mtime_ns, mtime)
+        
+        cache.close()
+        with open(cache.index_path) as f:
+            self.assertEqual(json.load(f)['blobs'][sha256]['last_used'], 5e9)
+    
+    def test_missing_blob(self):
+        """Test that a blob deleted from disk is treated as a miss"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        sha256 = cache.put("123", b"content")
+        os.remove(os.path.join(cache.blob_dir, sha256))
+        self.assertIsNone(cache.get("123"))
+    
+    def test_download_uses_cache(self):
+        """Test that a cached attachment is not downloaded again"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        cache.put("123", b"cached bytes")
+        
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", attachment_cache=cache)
+        monitor.session = mock.Mock()
+        
+        with monitor.download_attachment("123", "circolare.pdf") as attachment:
+            self.assertEqual(attachment.filename, "circolare.pdf")
+            self.assertEqual(attachment.read(), b"cached bytes")
+        monitor.session.get.assert_not_called()
+    
+    def test_put_from_file(self):
+        """Test storing an attachment from an open file"""
+        cache = AttachmentCache(self.directory, max_mb=1)
+        source = io.BytesIO(b"streamed content")
+        
+        sha256 = cache.put("123", source)
+        self.assertEqual(sha256, hashlib.sha256(b"streamed content").hexdigest())
+        self.assertEqual(cache.get("123"), b"streamed content")
+        self.assertEqual(source.tell(), 0)
+    
+    def test_put_over_cap_not_cached(self):
+        """Test that an attachment larger than the cache is skipped"""
+        cache = AttachmentCache(self.directory, max_mb=0.001)
+        self.assertIsNone(cache.put("123", b"x" * 2048))
+        self.assertIsNone(cache.get("123"))
+        self.assertEqual(os.listdir(cache.blob_dir), [])
+
+
+def fake_response(chunks, content_length=None):
+    """Build a mock streamed response"""
+    response = mock.MagicMock()
+    response.headers = {} if content_length is None else {'Content-Length': str(content_length)}
+    response.iter_content.return_value = iter(chunks)
+    response.__enter__.return_value = response
+    return response
+
+
+class TestStreamResponse(unittest.TestCase):
+    """Test cases for streamed downloads with a size cap"""
+    
+    def test_copies_chunks(self):
+        """Test that the body is copied chunk by chunk"""
+        dest = io.BytesIO()
+        written = stream_response(fake_response([b"abc", b"def"]), dest, max_bytes=10)
+        self.assertEqual(written, 6)
+        self.assertEqual(dest.getvalue(), b"abcdef")
+    
+    def test_content_length_over_cap(self):
+        """Test that an oversized Content-Length aborts before reading"""
+        response = fake_response([b"x" * 100], content_length=100)
+        with self.assertRaises(AttachmentTooLarge):
+            stream_response(response, io.BytesIO(), max_bytes=10)
+        response.iter_content.assert_not_called()
+    
+    def test_body_over_cap(self):
+        """Test that a body larger than announced is cut off"""
+        dest = io.BytesIO()
+        response = fake_response([b"x" * 8, b"x" * 8, b"x" * 8], content_length=5)
+        with self.assertRaises(AttachmentTooLarge):
+            stream_response(response, dest, max_bytes=10)
+        self.assertEqual(len(dest.getvalue()), 8)
+    
+    def test_download_too_large_removes_file(self):
+        """Test that an aborted download leaves no partial file"""
+        monitor = ClasseVivaMonitor("test@example.com", "testpass")
+        monitor.session = mock.Mock()
+        monitor.session.get.return_value = fake_response([b"x"], content_length=10 ** 12)
+        
+        self.assertIsNone(monitor.download_attachment("123", "test_download_too_large.pdf"))
+
+
+class TestAttachment(unittest.TestCase):
+    """Test cases for spooled attachment buffers"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_small_stays_in_memory(self):
+        """Test that small attachments are not written to disk"""
+        with Attachment("small.pdf", max_memory=1024) as attachment:
+            attachment.file.write(b"x" * 100)
+            self.assertFalse(attachment.file._rolled)
+            self.assertEqual(attachment.size, 100)
+            self.assertEqual(attachment.read(), b"x" * 100)
+    
+    def test_large_spills_to_disk(self):
+        """Test that large attachments roll over to a temporary file"""
+        with Attachment("large.pdf", max_memory=1024) as attachment:
+            attachment.file.write(b"x" * 4096)
+            self.assertTrue(attachment.file._rolled)
+            self.assertEqual(attachment.read(), b"x" * 4096)
+    
+    def test_open_rewinds(self):
+        """Test that every reader starts from the beginning"""
+        attachment = Attachment.from_bytes("a.pdf", b"content")
+        self.assertEqual(attachment.open().read(), b"content")
+        self.assertEqual(attachment.open().read(), b"content")
+        attachment.close()
+        self.assertTrue(attachment.file.closed)
+    
+    def test_download_streams_into_buffer(self):
+        """Test that a fresh download ends up in the buffer and the cache"""
+        cache = AttachmentCache(os.path.join(self.tmpdir.name, "cache"), max_mb=1)
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", attachment_cache=cache)
+        monitor.phpsessid = "sid"
+        monitor.webidentity = "wid"
+        monitor.session = mock.Mock()
+        monitor.session.get.return_value = fake_response([b"%PDF", b"-1.4"])
+        
+        with monitor.download_attachment("123", "circolare.pdf") as attachment:
+            self.assertEqual(attachment.read(), b"%PDF-1.4")
+        self.assertEqual(cache.get("123"), b"%PDF-1.4")
+    
+    def test_download_expired_session(self):
+        """Test that a login page is never cached and the download is retried after logging in"""
+        cache = AttachmentCache(os.path.join(self.tmpdir.name, "cache"), max_mb=1)
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", attachment_cache=cache)
+        monitor.phpsessid = "old"
+        monitor.webidentity = "wid"
+        def login_page():
+            response = fake_response([b'<html><form action="/auth-p7/app/default/AuthApi4.php">'
+                                      b'<input type="password" name="pass"></form></html>'])
+            response.headers['Content-Type'] = "text/html; charset=UTF-8"
+            return response
+        
+        monitor.session = mock.Mock()
+        monitor.session.get.side_effect = [login_page(), fake_response([b"%PDF-1.4"])]
+        
+        def login():
+            monitor.phpsessid = "new"
+            return True
+        
+        with mock.patch.object(monitor, 'login', side_effect=login) as relogin:
+            with monitor.download_attachment("123", "circolare.pdf") as attachment:
+                self.assertEqual(attachment.read(), b"%PDF-1.4")
+        relogin.assert_called_once()
+        self.assertEqual(monitor.session.get.call_args.kwargs['cookies']['PHPSESSID'], "new")
+        self.assertEqual(cache.get("123"), b"%PDF-1.4")
+        
+        # Still the login page after logging in: nothing is cached or returned
+        monitor.session.get.side_effect = [login_page(), login_page()]
+        with mock.patch.object(monitor, 'login', side_effect=login):
+            self.assertIsNone(monitor.download_attachment("456", "altro.pdf"))
+        self.assertIsNone(cache.get("456"))
+    
+    def test_download_html_error_page(self):
+        """Test that an HTML error page is not cached and does not log in again"""
+        cache = AttachmentCache(os.path.join(self.tmpdir.name, "cache"), max_mb=1)
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", attachment_cache=cache)
+        monitor.phpsessid = "sid"
+        monitor.webidentity = "wid"
+        error_page = fake_response([b"<html><body>Servizio non disponibile</body></html>"])
+        error_page.headers['Content-Type'] = "text/html"
+        monitor.session = mock.Mock(**{'get.return_value': error_page})
+        
+        with mock.patch.object(monitor, 'login') as relogin:
+            self.assertIsNone(monitor.download_attachment("123", "circolare.pdf"))
+        relogin.assert_not_called()
+        self.assertIsNone(cache.get("123"))
+    
+    def test_sha256(self):
+        """Test that the content hash matches hashlib"""
+        with Attachment.from_bytes("a.pdf", b"%PDF" * 50000) as attachment:
+            self.assertEqual(attachment.sha256, hashlib.sha256(b"%PDF" * 50000).hexdigest())
+
+
+class TestFileIdCache(unittest.TestCase):
+    """Test cases for FileIdCache"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "file_ids.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_persisted(self):
+        """Test that file_ids survive a restart and can be forgotten"""
+        FileIdCache(self.path).put("abc", "F1")
+        
+        cache = FileIdCache(self.path)
+        self.assertEqual(cache.get("abc"), "F1")
+        self.assertIsNone(cache.get("def"))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        
+        cache.forget("abc")
+        self.assertIsNone(FileIdCache(self.path).get("abc"))
+    
+    def test_max_entries(self):
+        """Test that the oldest file_ids are dropped beyond max_entries"""
+        cache = FileIdCache(self.path, max_entries=2)
+        for i in range(3):
+            cache.put(str(i), f"F{i}")
+        self.assertIsNone(cache.get("0"))
+        self.assertEqual(cache.get("2"), "F2")
+
+
+class TestFetchAttachments(unittest.TestCase):
+    """Test cases for concurrent attachment downloads"""
+    
+    def setUp(self):
+        self.monitor = ClasseVivaMonitor("test@example.com", "testpass", detector=mock.Mock())
+    
+    def test_order_preserved(self):
+        """Test that results follow the attachment order, not completion order"""
+        delays = {'1': 0.2, '2': 0.1, '3': 0.0}
+        
+        def download(attachment_id, filename):
+            time.sleep(delays[attachment_id])
+            return Attachment.from_bytes(filename, f"1A{attachment_id}".encode())
+        
+        self.monitor.download_attachment = download
+        attachments = [{'id': aid, 'filename': f"{aid}.pdf"} for aid in ('1', '2', '3')]
+        
+        downloaded = self.monitor.fetch_attachments(attachments)
+        self.assertEqual([a.filename for a in downloaded], ['1.pdf', '2.pdf', '3.pdf'])
+        self.monitor.detector.detect_classes_in_pdf.assert_not_called()
+    
+    def test_downloads_overlap(self):
+        """Test that downloads run at the same time"""
+        barrier = threading.Barrier(3, timeout=5)
+        
+        def download(attachment_id, filename):
+            barrier.wait()
+            return Attachment.from_bytes(filename, b"x")
+        
+        self.monitor.download_attachment = download
+        attachments = [{'id': str(i), 'filename': f"{i}.pdf"} for i in range(3)]
+        downloaded = self.monitor.fetch_attachments(attachments)
+        self.assertEqual(len(downloaded), 3)
+    
+    def test_failed_download_in_place(self):
+        """Test that a failed download is None at its own position"""
+        self.monitor.download_attachment = lambda aid, filename: (
+            None if aid == '2' else Attachment.from_bytes(filename, b"x"))
+        attachments = [{'id': aid, 'filename': f"{aid}.pdf"} for aid in ('1', '2', '3')]
+        
+        downloaded = self.monitor.fetch_attachments(attachments)
+        self.assertEqual([a and a.filename for a in downloaded], ['1.pdf', None, '3.pdf'])
+    
+    def test_download_stage_same_filename(self):
+        """Test that only the attachments actually downloaded are queued, even with equal filenames"""
+        self.monitor.download_attachment = lambda aid, filename: (
+            None if aid == '2' else Attachment.from_bytes(filename, aid.encode()))
+        comm = {'evtId': '1'}
+        attachments = [{'id': aid, 'filename': "circolare.pdf"} for aid in ('1', '2')]
+        
+        with mock.patch.object(self.monitor, 'parse_attachments', return_value=attachments):
+            job = self.monitor.download_stage({'comm': comm})
+        self.assertEqual([a['id'] for a in job['attachments']], ['1'])
+        self.assertEqual([document.read() for document in job['documents']], [b"1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,8 +2,43 @@
 Unit tests for ClassDetector module
 """
 
+import os
+import time
+import hashlib
+import tempfile
 import unittest
-from class_detector import ClassDetector
+from unittest import mock
+
+import PyPDF2
+
+from class_detector import ClassDetector, PdfExtractor, PdfResultCache
+from config import CLASS_PATTERN
+
+
+def make_pdf(pages):
+    """Build a minimal PDF with one text line per page (for tests)"""
+    objects = []
+    page_ids = [3 + 2 * i for i in range(len(pages))]
+    font_id = 3 + 2 * len(pages)
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{pid} 0 R" for pid in page_ids)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    for i, text in enumerate(pages):
+        content = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode()
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Contents {page_ids[i] + 1} 0 R /Resources << /Font << /F1 {font_id} 0 R >> >> >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % o for o in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return out
 
 
 class TestClassDetector(unittest.TestCase):
@@ -109,6 +144,157 @@ class TestClassDetector(unittest.TestCase):
         classes = self.detector.detect_classes_in_text(text)
         self.assertEqual(classes, {'1AA'})
 
+    
+    def test_detect_classes_in_pdf(self):
+        """Test detection across all PDF pages"""
+        pdf = make_pdf(["Classi 1AA e 3BC", "Anche 5XY"])
+        self.assertEqual(self.detector.detect_classes_in_pdf(pdf), {'1AA', '3BC', '5XY'})
+
+
+class TestPdfResultCache(unittest.TestCase):
+    """Test cases for the persistent PDF result cache"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "pdf_cache.json")
+        self.pdf = make_pdf(["Circolare per 2BC", "e 4DD"])
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_pdf_parsed_once(self):
+        """Test that a cached PDF is not parsed again, even after a restart"""
+        detector = ClassDetector(result_cache=PdfResultCache(self.path))
+        self.assertEqual(detector.detect_classes_in_pdf(self.pdf), {'2BC', '4DD'})
+        
+        restarted = ClassDetector(result_cache=PdfResultCache(self.path))
+        with mock.patch('class_detector.PyPDF2.PdfReader', side_effect=AssertionError("parsed again")):
+            self.assertEqual(restarted.detect_classes_in_pdf(self.pdf), {'2BC', '4DD'})
+        self.assertEqual(restarted.result_cache.hits, 1)
+        
+        key = PdfResultCache.make_key(hashlib.sha256(self.pdf).hexdigest(), CLASS_PATTERN)
+        self.assertEqual(restarted.result_cache.get(key)['pages'], 2)
+    
+    def test_pattern_change_invalidates(self):
+        """Test that results for another pattern are dropped"""
+        cache = PdfResultCache(self.path)
+        cache.put(PdfResultCache.make_key("abc", r'\b([1-3][A-Z])\b'), {'1A'}, 1)
+        cache.put(PdfResultCache.make_key("def", CLASS_PATTERN), {'1AA'}, 1)
+        
+        ClassDetector(result_cache=cache)
+        self.assertIsNone(cache.get(PdfResultCache.make_key("abc", r'\b([1-3][A-Z])\b')))
+        self.assertIsNotNone(PdfResultCache(self.path).get(PdfResultCache.make_key("def", CLASS_PATTERN)))
+    
+    def test_max_entries(self):
+        """Test that the oldest results are dropped beyond the limit"""
+        cache = PdfResultCache(self.path, max_entries=2)
+        for key in ("a", "b", "c"):
+            cache.put(key, set(), 1)
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNotNone(cache.get("c"))
+
+
+ORIGINAL_EXTRACT_TEXT = PyPDF2.PageObject.extract_text
+
+
+def slow_extract_text(page, *args, **kwargs):
+    """Stand-in for PageObject.extract_text that hangs on pages saying 'hang'"""
+    text = ORIGINAL_EXTRACT_TEXT(page, *args, **kwargs)
+    if "hang" in text:
+        time.sleep(60)
+    return text
+
+
+class TestPdfExtractor(unittest.TestCase):
+    """Test cases for process-based PDF extraction"""
+    
+    def test_extract_pages(self):
+        """Test that every page is returned in order"""
+        result = PdfExtractor(timeout=10).extract(make_pdf(["first 1AA", "second 2BB"]))
+        self.assertTrue(result.complete)
+        self.assertEqual(result.page_count, 2)
+        self.assertIn("1AA", result.pages[0])
+        self.assertIn("2BB", result.pages[1])
+    
+    def test_workers_reused(self):
+        """Test that one worker process serves several PDFs, even after a failure"""
+        extractor = PdfExtractor(max_workers=1, timeout=10)
+        try:
+            for _ in range(3):
+                self.assertTrue(extractor.extract(make_pdf(["Classe 1AA"])).complete)
+            with self.assertRaises(ValueError):
+                extractor.extract(b"not a pdf")
+            self.assertTrue(extractor.extract(make_pdf(["Classe 2BB"])).complete)
+        finally:
+            extractor.close()
+        self.assertEqual(extractor.started, 1)
+    
+    def test_timeout_returns_partial_result(self):
+        """Test that a stuck worker is killed and earlier pages are kept"""
+        # The patch below only reaches a forked worker
+        extractor = PdfExtractor(timeout=1, start_method='fork')
+        detector = ClassDetector(extractor=extractor)
+        pdf = make_pdf(["Classe 1AA", "hang 2BB", "Classe 3CC"])
+        
+        start = time.monotonic()
+        with mock.patch('PyPDF2.PageObject.extract_text', slow_extract_text):
+            classes = detector.detect_classes_in_pdf(pdf)
+        
+        self.assertLess(time.monotonic() - start, 10)
+        self.assertEqual(classes, {'1AA'})
+        self.assertEqual(extractor.timeouts, 1)
+        
+        # Only the stuck worker is replaced
+        self.assertEqual(extractor.extract(make_pdf(["Classe 4DD"])).pages, ["Classe 4DD"])
+        self.assertEqual(extractor.started, 2)
+        extractor.close()
+    
+    def test_invalid_pdf(self):
+        """Test that an unreadable document yields no classes"""
+        self.assertEqual(ClassDetector().detect_classes_in_pdf(b"not a pdf"), set())
+
+
+class TestBatchDetection(unittest.TestCase):
+    """Test cases for the batch and multi-pattern API"""
+    
+    def setUp(self):
+        self.detector = ClassDetector(extractor=mock.Mock(), patterns={
+            'rooms': r'\bAula (\d+)\b',
+            'teachers': r'\bProf\.(?:ssa)? ([A-Z]\.[A-Z]\.)',
+        })
+        self.text = "Le classi 3AB e 4CD in Aula 12 con la Prof.ssa M.R."
+    
+    def test_detect_classes_batch(self):
+        """Test per-item class sets, in order"""
+        results = self.detector.detect_classes_batch(["Classe 1AA", None, "", "2BB e 1AA"])
+        self.assertEqual(results, [{'1AA'}, set(), set(), {'1AA', '2BB'}])
+    
+    def test_bytes_input(self):
+        """Test that bytes are scanned like the decoded text"""
+        self.assertEqual(self.detector.detect_classes_batch([self.text.encode()]), [{'3AB', '4CD'}])
+        self.assertEqual(self.detector.scan(self.text.encode()), self.detector.scan(self.text))
+        
+        # Accented letters are not word characters for either input
+        detector = ClassDetector(extractor=mock.Mock(), patterns={'days': r'\b(lunedì|martedì)'})
+        text = "martedì è1AA, città 2BB"
+        self.assertEqual(detector.scan(text), {'classes': {'1AA', '2BB'}, 'days': {'martedì'}})
+        self.assertEqual(detector.scan(text.encode()), detector.scan(text))
+    
+    def test_named_patterns(self):
+        """Test that every named pattern is reported in one call"""
+        self.assertEqual(self.detector.scan(self.text), {
+            'classes': {'3AB', '4CD'},
+            'rooms': {'12'},
+            'teachers': {'M.R.'},
+        })
+        self.assertEqual(self.detector.scan_batch(["Aula 3", None])[1],
+                         {'classes': set(), 'rooms': set(), 'teachers': set()})
+    
+    def test_classes_name_reserved(self):
+        """Test that CLASS_PATTERN cannot be shadowed by an extra pattern"""
+        with self.assertRaises(ValueError):
+            ClassDetector(extractor=mock.Mock(), patterns={'classes': r'\d'})
+
 
 if __name__ == '__main__':
     unittest.main()
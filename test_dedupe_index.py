@@ -0,0 +1,206 @@
+"""
+Unit tests for DedupeIndex module
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import unittest
+from unittest import mock
+
+import monitor
+from dedupe_index import DedupeIndex, PACKED_PREFIX, TIMED_PREFIX
+
+
+def md5(value) -> str:
+    return hashlib.md5(str(value).encode()).hexdigest()
+
+
+class TestDedupeIndex(unittest.TestCase):
+    """Test cases for DedupeIndex"""
+    
+    def test_set_semantics(self):
+        """Test membership, duplicates and insertion order"""
+        index = DedupeIndex()
+        self.assertTrue(index.add(md5(1)))
+        self.assertTrue(index.add("custom-id"))
+        self.assertFalse(index.add(md5(1)))
+        
+        self.assertIn(md5(1), index)
+        self.assertIn("custom-id", index)
+        self.assertNotIn(md5(2), index)
+        self.assertNotIn(None, index)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(list(index), [md5(1), "custom-id"])
+    
+    def test_discard(self):
+        """Test removing hashes"""
+        index = DedupeIndex([md5(1), md5(2)])
+        index.discard(md5(1))
+        index.discard(md5(3))
+        self.assertEqual(list(index), [md5(2)])
+    
+    def test_uppercase_hex_kept_verbatim(self):
+        """Test that non-canonical hex strings round-trip unchanged"""
+        upper = md5(1).upper()
+        index = DedupeIndex([upper])
+        self.assertIn(upper, index)
+        self.assertEqual(list(index), [upper])
+    
+    def test_packed_roundtrip(self):
+        """Test that MD5 digests are stored in the packed form"""
+        hashes = [md5(i) for i in range(100)]
+        data = DedupeIndex(hashes).to_json()
+        
+        self.assertIsInstance(data, str)
+        self.assertTrue(data.startswith(PACKED_PREFIX))
+        self.assertLess(len(data), sum(len(h) for h in hashes))
+        self.assertEqual(list(DedupeIndex.from_json(data)), hashes)
+    
+    def test_legacy_list_roundtrip(self):
+        """Test that legacy lists load and non-MD5 entries stay a list"""
+        legacy = ['hash1', 'hash2', md5(3)]
+        index = DedupeIndex.from_json(legacy)
+        self.assertEqual(index, legacy)
+        self.assertEqual(index.to_json(), legacy)
+    
+    def test_empty_and_invalid(self):
+        """Test empty data and unknown string formats"""
+        self.assertEqual(len(DedupeIndex.from_json(None)), 0)
+        self.assertEqual(len(DedupeIndex.from_json([])), 0)
+        with self.assertRaises(ValueError):
+            DedupeIndex.from_json("not-packed")
+    
+    
+    def test_timed_roundtrip(self):
+        """Test that send times survive serialization"""
+        index = DedupeIndex()
+        index.add(md5(1), {'sent_at': 1700000000.0})
+        index.add(md5(2))
+        
+        data = index.to_json()
+        self.assertTrue(data.startswith(TIMED_PREFIX))
+        reloaded = DedupeIndex.from_json(data)
+        self.assertEqual(list(reloaded), [md5(1), md5(2)])
+        self.assertEqual(reloaded.sent_at(md5(1)), 1700000000.0)
+        self.assertIsNone(reloaded.sent_at(md5(2)))
+        
+        mixed = DedupeIndex()
+        mixed.add("custom-id", {'sent_at': 5.0})
+        mixed.add("other")
+        self.assertEqual(mixed.to_json(), [["custom-id", 5.0], "other"])
+        self.assertEqual(DedupeIndex.from_json(mixed.to_json()).sent_at("custom-id"), 5.0)
+    
+    def test_prune_by_age(self):
+        """Test that old hashes are evicted unless protected or undated"""
+        index = DedupeIndex([md5(0)])
+        for i in range(1, 4):
+            index.add(md5(i), {'sent_at': i * 100.0})
+        index.drain_added()
+        
+        evicted = index.prune(max_age=150, protected=[md5(1)], now=400.0)
+        self.assertEqual(evicted, [md5(2)])
+        self.assertEqual(list(index), [md5(0), md5(1), md5(3)])
+        self.assertEqual(index.drain_removed(), [md5(2)])
+    
+    def test_prune_by_count(self):
+        """Test that the oldest hashes are evicted beyond the entry limit"""
+        index = DedupeIndex()
+        for i in range(10):
+            index.add(md5(i), {'sent_at': 1000.0 - i})
+        
+        evicted = index.prune(max_entries=6, protected=[md5(9)], now=1000.0)
+        self.assertEqual(len(index), 6)
+        self.assertEqual(set(evicted), {md5(5), md5(6), md5(7), md5(8)})
+        self.assertIn(md5(9), index)
+        
+        # Never persisted, so nothing to delete on disk
+        self.assertEqual(index.drain_removed(), [])
+        self.assertEqual(len(index.drain_added()), 6)
+    
+    def test_state_file_conversion(self):
+        """Test that load_state/save_state convert transparently"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            state_file = os.path.join(tmpdir, "state.json")
+            with open(state_file, 'w') as f:
+                json.dump({'sent_hashes': [md5(1), md5(2)], 'last_check': 'x'}, f)
+            
+            with mock.patch.object(monitor, 'STATE_FILE', state_file):
+                state = monitor.load_state()
+                self.assertIsInstance(state['sent_hashes'], DedupeIndex)
+                self.assertIn(md5(2), state['sent_hashes'])
+                
+                state['sent_hashes'].add(md5(3))
+                monitor.save_state(state)
+                
+                with open(state_file) as f:
+                    self.assertTrue(json.load(f)['sent_hashes'].startswith(PACKED_PREFIX))
+                
+                reloaded = monitor.load_state()
+                self.assertEqual(reloaded['sent_hashes'], [md5(1), md5(2), md5(3)])
+                self.assertEqual(reloaded['last_check'], 'x')
+
+
+
+class TestRetention(unittest.TestCase):
+    """Test ClasseVivaMonitor.apply_retention"""
+    
+    def setUp(self):
+        self.monitor = monitor.ClasseVivaMonitor("test@example.com", "testpass")
+        index = DedupeIndex()
+        for i in range(5):
+            index.add(md5(i), {'sent_at': 1000.0})
+        self.state = {'sent_hashes': index}
+    
+    def listing(self, ids, ok=True):
+        def fetch(ncna=1):
+            self.assertEqual(ncna, 0)
+            self.monitor.last_fetch_ok = ok
+            return [{'evtId': i} for i in ids] if ok else []
+        return fetch
+    
+    def test_listed_communications_protected(self):
+        """Test that hashes still returned by ncna=0 are never evicted"""
+        self.monitor.fetch_communications = self.listing([3, 4])
+        with mock.patch.object(monitor, 'RETENTION_MAX_AGE_DAYS', 1), \
+                mock.patch.object(monitor, 'RETENTION_MAX_ENTRIES', 0):
+            evicted = self.monitor.apply_retention(self.state)
+        
+        self.assertEqual(evicted, 3)
+        self.assertEqual(self.state['sent_hashes'], [md5(3), md5(4)])
+        self.assertIn('last_retention', self.state)
+        
+        # Interval not elapsed: no further request
+        self.monitor.fetch_communications = mock.Mock()
+        self.assertEqual(self.monitor.apply_retention(self.state), 0)
+        self.monitor.fetch_communications.assert_not_called()
+    
+    def test_skipped_when_listing_unavailable(self):
+        """Test that nothing is evicted if the full listing cannot be fetched"""
+        self.monitor.fetch_communications = self.listing([], ok=False)
+        with mock.patch.object(monitor, 'RETENTION_MAX_AGE_DAYS', 1):
+            self.assertEqual(self.monitor.apply_retention(self.state), 0)
+        self.assertEqual(len(self.state['sent_hashes']), 5)
+        self.assertNotIn('last_retention', self.state)
+    
+    def test_runs_on_quiet_polls(self):
+        """Test that a poll finding nothing new still applies retention"""
+        listing = self.listing([4])
+        
+        def fetch(ncna=1):
+            if ncna == 0:
+                return listing(ncna)
+            self.monitor.last_fetch_ok = True
+            return []
+        self.monitor.fetch_communications = fetch
+        with mock.patch.object(monitor, 'RETENTION_MAX_AGE_DAYS', 1), \
+                mock.patch.object(monitor, 'save_state') as save:
+            self.assertEqual(self.monitor.check_updates(self.state), 0)
+        
+        self.assertEqual(self.state['sent_hashes'], [md5(4)])
+        save.assert_called_once_with(self.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""
+Unit tests for json_codec module
+"""
+
+import json
+import unittest
+from unittest import mock
+
+import json_codec
+
+
+class TestJsonCodec(unittest.TestCase):
+    """Test cases for the JSON codec, with and without orjson"""
+    
+    PAYLOAD = {'data': [{'evtId': 1, 'evtText': "Circolare – 3A", 'letta': False, 'allegati': []}],
+               'last_retention': 1760000000.5}
+    
+    def backends(self):
+        """Run a test with the installed codec and with the json fallback"""
+        yield
+        with mock.patch.object(json_codec, 'orjson', None):
+            yield
+    
+    def test_round_trip(self):
+        """Test that encoding then decoding gives the same object back"""
+        for _ in self.backends():
+            encoded = json_codec.dumps(self.PAYLOAD)
+            self.assertIsInstance(encoded, str)
+            self.assertEqual(json_codec.loads(encoded), self.PAYLOAD)
+            self.assertEqual(json_codec.loads(encoded.encode()), self.PAYLOAD)
+    
+    def test_compact_and_pretty(self):
+        """Test that output is compact unless pretty is requested"""
+        for _ in self.backends():
+            self.assertNotIn(' ', json_codec.dumps({'a': [1, 2]}))
+            self.assertIn('\n  "a"', json_codec.dumps({'a': [1, 2]}, pretty=True))
+    
+    def test_readable_by_json(self):
+        """Test that the output stays readable by the json module"""
+        for _ in self.backends():
+            self.assertEqual(json.loads(json_codec.dumps(self.PAYLOAD)), self.PAYLOAD)
+    
+    def test_unsupported_by_orjson(self):
+        """Test that values orjson rejects are still encoded"""
+        self.assertEqual(json_codec.loads(json_codec.dumps({'n': 2 ** 70})), {'n': 2 ** 70})
+        self.assertEqual(json_codec.dumps({1: 'a'}), '{"1":"a"}')
+    
+    def test_invalid_document(self):
+        """Test that malformed JSON raises ValueError"""
+        for _ in self.backends():
+            with self.assertRaises(ValueError):
+                json_codec.loads('{"data": [')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+"""
+Unit tests for the notification outbox
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from outbox import Outbox, OutboxWorker, MESSAGE, DOCUMENT, MEDIA_GROUP
+from monitor import ClasseVivaMonitor, TelegramNotifier
+
+
+class TestOutbox(unittest.TestCase):
+    """Test cases for Outbox"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, "outbox.db")
+        self.outbox = Outbox(self.path, max_attempts=3, retry_base=10, retry_max=15)
+    
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.temp_dir)
+    
+    def test_fifo(self):
+        """Test that entries come out in the order they were queued"""
+        self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "uno"},
+                                        {'kind': MEDIA_GROUP, 'attachments': [{'id': '1', 'filename': 'a.pdf'}]}])
+        self.outbox.enqueue("42", "b", [{'kind': MESSAGE, 'text': "due"}])
+        
+        seen = []
+        while True:
+            entry = self.outbox.next_due()
+            if entry is None:
+                break
+            seen.append((entry.comm_hash, entry.kind))
+            self.outbox.mark_delivered(entry.id)
+        
+        self.assertEqual(seen, [('a', MESSAGE), ('a', MEDIA_GROUP), ('b', MESSAGE)])
+    
+    def test_survives_reopen(self):
+        """Test that pending entries are still there after a restart"""
+        self.outbox.enqueue("42", "a", [{'kind': DOCUMENT, 'text': "x",
+                                         'attachments': [{'id': '7', 'filename': 'c.pdf'}]}])
+        self.outbox.close()
+        
+        self.outbox = Outbox(self.path)
+        entry = self.outbox.next_due()
+        self.assertEqual(entry.kind, DOCUMENT)
+        self.assertEqual(entry.attachments, [{'id': '7', 'filename': 'c.pdf'}])
+    
+    def test_enqueue_once(self):
+        """Test that queueing the same communication twice keeps one copy"""
+        parts = [{'kind': MESSAGE, 'text': "x"}]
+        self.assertEqual(self.outbox.enqueue("42", "a", parts), 1)
+        self.outbox.mark_delivered(self.outbox.next_due().id)
+        
+        self.assertEqual(self.outbox.enqueue("42", "a", parts), 0)
+        self.assertIsNone(self.outbox.next_due())
+    
+    def test_backoff(self):
+        """Test that a failed entry waits, holding back the ones behind it"""
+        self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "x"}])
+        self.outbox.enqueue("42", "b", [{'kind': MESSAGE, 'text': "y"}])
+        entry = self.outbox.next_due()
+        
+        self.assertTrue(self.outbox.mark_failed(entry.id, "503"))
+        self.assertIsNone(self.outbox.next_due())
+        self.assertAlmostEqual(self.outbox.next_attempt_in(), 10, delta=1)
+        
+        retry = self.outbox.next_due(now=time.time() + 11)
+        self.assertEqual((retry.id, retry.attempts), (entry.id, 1))
+        
+        # Second failure doubles the wait, capped at retry_max
+        self.outbox.mark_failed(entry.id, "503")
+        self.assertAlmostEqual(self.outbox.next_attempt_in(), 15, delta=1)
+    
+    def test_gives_up(self):
+        """Test that an entry is dropped after max_attempts failures"""
+        self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "x"}])
+        self.outbox.enqueue("42", "b", [{'kind': MESSAGE, 'text': "y"}])
+        entry = self.outbox.next_due()
+        
+        self.assertTrue(self.outbox.mark_failed(entry.id, "e"))
+        self.assertTrue(self.outbox.mark_failed(entry.id, "e"))
+        self.assertFalse(self.outbox.mark_failed(entry.id, "e"))
+        
+        self.assertEqual(self.outbox.next_due().comm_hash, "b")
+        self.assertEqual(self.outbox.counts(), {'failed': 1, 'pending': 1})
+    
+    def test_purge(self):
+        """Test that only old delivered entries are forgotten"""
+        self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "x"}])
+        self.outbox.enqueue("42", "b", [{'kind': MESSAGE, 'text': "y"}])
+        self.outbox.mark_delivered(self.outbox.next_due().id)
+        
+        self.assertEqual(self.outbox.purge(keep_days=1), 0)
+        with mock.patch('outbox.time.time', return_value=time.time() + 2 * 86400):
+            self.assertEqual(self.outbox.purge(keep_days=1), 1)
+        self.assertEqual(self.outbox.counts(), {'pending': 1})
+
+
+class TestOutboxWorker(unittest.TestCase):
+    """Test cases for OutboxWorker"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.temp_dir, "outbox.db"))
+    
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.temp_dir)
+    
+    def test_drain_stops_on_failure(self):
+        """Test that a chat's delivery stops at its first failure to keep the order"""
+        for name in "abc":
+            self.outbox.enqueue("42", name, [{'kind': MESSAGE, 'text': name}])
+        send = mock.Mock(side_effect=[True, False])
+        worker = OutboxWorker(self.outbox, send)
+        
+        self.assertEqual(worker.drain(), 1)
+        self.assertEqual((worker.delivered, worker.failed), (1, 1))
+        self.assertEqual(self.outbox.counts(), {'delivered': 1, 'pending': 2})
+    
+    def test_failing_chat_skipped(self):
+        """Test that a chat failing does not hold back the other chats"""
+        for name in "abc":
+            self.outbox.enqueue("A", name, [{'kind': MESSAGE, 'text': name}])
+            self.outbox.enqueue("B", name, [{'kind': MESSAGE, 'text': name}])
+        sent = []
+        
+        def send(entry):
+            if entry.chat_id == "A":
+                return False
+            sent.append(entry.text)
+            return True
+        
+        worker = OutboxWorker(self.outbox, send)
+        self.assertEqual(worker.drain(), 3)
+        self.assertEqual(sent, ["a", "b", "c"])
+        self.assertEqual(worker.failed, 1)
+        self.assertEqual(self.outbox.counts(), {'delivered': 3, 'pending': 3})
+        self.assertEqual(self.outbox.due(), [])
+        self.assertEqual([e.chat_id for e in self.outbox.due(now=time.time() + 3600)], ["A"])
+    
+    def test_chats_concurrent(self):
+        """Test that different chats are delivered at the same time"""
+        self.outbox.enqueue("A", "a", [{'kind': MESSAGE, 'text': "x"}])
+        self.outbox.enqueue("B", "a", [{'kind': MESSAGE, 'text': "x"}])
+        barrier = threading.Barrier(2, timeout=5)
+        
+        def send(entry):
+            # Both chats must be in flight for the barrier to open
+            barrier.wait()
+            return True
+        
+        worker = OutboxWorker(self.outbox, send, max_workers=2)
+        self.assertEqual(worker.drain(), 2)
+    
+    def test_attachments_uploaded_once(self):
+        """Test that one chat uploads a communication's attachments before the others"""
+        attachments = [{'id': '1', 'filename': 'a.pdf'}]
+        for chat in "ABC":
+            self.outbox.enqueue(chat, "a", [{'kind': DOCUMENT, 'text': "x", 'attachments': attachments}])
+        done = []
+        
+        def send(entry):
+            # The other chats only start once the first one is through
+            self.assertEqual(done[:1], [] if entry.chat_id == "A" else ["A"])
+            time.sleep(0.05)
+            done.append(entry.chat_id)
+            return True
+        
+        worker = OutboxWorker(self.outbox, send, max_workers=3)
+        self.assertEqual(worker.drain(), 3)
+        self.assertEqual(sorted(done), ["A", "B", "C"])
+    
+    def test_send_exception(self):
+        """Test that an exception from send counts as a failed attempt"""
+        self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "x"}])
+        worker = OutboxWorker(self.outbox, mock.Mock(side_effect=ConnectionError("down")))
+        
+        self.assertEqual(worker.drain(), 0)
+        row = self.outbox.conn.execute("SELECT attempts, last_error FROM outbox").fetchone()
+        self.assertEqual(row, (1, "down"))
+    
+    def test_thread_delivers(self):
+        """Test that the background thread delivers entries queued after start"""
+        sent = []
+        worker = OutboxWorker(self.outbox, lambda entry: sent.append(entry.text) or True, idle_interval=5)
+        worker.start()
+        try:
+            self.outbox.enqueue("42", "a", [{'kind': MESSAGE, 'text': "ciao"}])
+            worker.wake()
+            deadline = time.time() + 5
+            while not sent and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            worker.stop(timeout=5)
+        
+        self.assertEqual(sent, ["ciao"])
+
+
+class TestMonitorOutbox(unittest.TestCase):
+    """Test cases for the monitor writing to the outbox"""
+    
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.outbox = Outbox(os.path.join(self.temp_dir, "outbox.db"))
+        self.notifier = mock.Mock(spec=TelegramNotifier, chat_id="42")
+        self.notifier.format_communication.return_value = "testo"
+        detector = mock.Mock(**{'detect_classes_in_text.return_value': set(),
+                                'detect_classes_in_pdf.return_value': set()})
+        self.monitor = ClasseVivaMonitor("test@example.com", "testpass", detector=detector,
+                                         notifier=self.notifier, outbox=self.outbox)
+    
+    def tearDown(self):
+        self.outbox.close()
+        shutil.rmtree(self.temp_dir)
+    
+    def test_check_updates_enqueues(self):
+        """Test that a poll queues notifications instead of sending them"""
+        self.monitor.fetch_communications = mock.Mock(return_value=[
+            {'evtId': '1', 'evtText': 'x'},
+            {'evtId': '2', 'evtText': 'y', 'allegati': [{'allegato_id': '5', 'filename': 'a.pdf'},
+                                                       {'allegato_id': '6', 'filename': 'b.pdf'}]},
+        ])
+        self.monitor.download_attachment = mock.Mock(side_effect=lambda i, name: mock.Mock(filename=name))
+        state = {'sent_hashes': []}
+        
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 2)
+        
+        self.notifier.send_message.assert_not_called()
+        self.assertEqual(len(state['sent_hashes']), 2)
+        kinds = [row[0] for row in self.outbox.conn.execute("SELECT kind FROM outbox ORDER BY id")]
+        self.assertEqual(kinds, [MESSAGE, MESSAGE, MEDIA_GROUP])
+    
+    def test_digest_enqueued(self):
+        """Test that a digest is queued as packed messages and grouped attachments"""
+        self.notifier.pack_messages = TelegramNotifier.pack_messages
+        self.notifier.chunk_documents = TelegramNotifier.chunk_documents
+        self.monitor.fetch_communications = mock.Mock(return_value=[
+            {'evtId': str(i), 'allegati': [{'allegato_id': str(i), 'filename': f"{i}.pdf"}]} for i in range(3)
+        ])
+        self.monitor.download_attachment = mock.Mock(side_effect=lambda i, name: mock.Mock(filename=name))
+        state = {'sent_hashes': []}
+        
+        with mock.patch('monitor.DIGEST_MODE', True), mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 3)
+        
+        rows = list(self.outbox.conn.execute("SELECT kind, attachments FROM outbox ORDER BY id"))
+        self.assertEqual([kind for kind, _ in rows], [MESSAGE, MEDIA_GROUP])
+        self.assertEqual(len(state['sent_hashes']), 3)
+    
+    def test_deliver_document(self):
+        """Test that delivery loads the attachment and sends it with the caption"""
+        self.outbox.enqueue("42", "a", [{'kind': DOCUMENT, 'text': "testo",
+                                         'attachments': [{'id': '5', 'filename': 'a.pdf'}]}])
+        document = mock.Mock()
+        self.monitor.download_attachment = mock.Mock(return_value=document)
+        self.notifier.send_document.return_value = True
+        
+        self.assertTrue(self.monitor.deliver(self.outbox.next_due()))
+        self.monitor.download_attachment.assert_called_once_with('5', 'a.pdf')
+        self.notifier.send_document.assert_called_once_with(document, caption="testo", chat_id="42")
+        document.close.assert_called_once()
+    
+    def test_deliver_missing_attachment(self):
+        """Test that an attachment that cannot be loaded is retried later"""
+        self.outbox.enqueue("42", "a", [{'kind': DOCUMENT, 'text': "testo",
+                                         'attachments': [{'id': '5', 'filename': 'a.pdf'}]}])
+        self.monitor.download_attachment = mock.Mock(return_value=None)
+        
+        self.assertFalse(self.monitor.deliver(self.outbox.next_due()))
+        self.notifier.send_document.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
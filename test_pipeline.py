@@ -0,0 +1,119 @@
+"""
+Unit tests for the staged poll pipeline
+"""
+
+import time
+import threading
+import unittest
+from unittest import mock
+
+import monitor
+from pipeline import Pipeline, Stage
+from monitor import ClasseVivaMonitor
+
+
+class TestPipeline(unittest.TestCase):
+    """Test cases for Pipeline"""
+    
+    def test_order_preserved(self):
+        """Test that the sink sees items in input order"""
+        def jitter(item):
+            time.sleep(0.01 * (5 - item % 5))
+            return item
+        
+        received = []
+        pipeline = Pipeline([Stage("a", jitter, 4), Stage("b", lambda x: x * 10, 3)], queue_size=2)
+        delivered = pipeline.run(range(20), received.append)
+        
+        self.assertEqual(delivered, 20)
+        self.assertEqual(received, [i * 10 for i in range(20)])
+        self.assertEqual(pipeline.processed, {'a': 20, 'b': 20})
+    
+    def test_stages_overlap(self):
+        """Test that latency follows the slowest stage, not the sum of stages"""
+        def slow(item):
+            time.sleep(0.05)
+            return item
+        
+        def sink(item):
+            time.sleep(0.05)
+        
+        start = time.monotonic()
+        Pipeline([Stage("a", slow), Stage("b", slow)]).run(range(10), sink)
+        elapsed = time.monotonic() - start
+        
+        # Serial processing would take 10 * 3 * 0.05 = 1.5s
+        self.assertLess(elapsed, 1.0)
+    
+    def test_failed_item_dropped(self):
+        """Test that a failing item is skipped and reported, the rest continue"""
+        def fail_on_two(item):
+            if item == 2:
+                raise ValueError("boom")
+            return item
+        
+        received = []
+        errors = []
+        pipeline = Pipeline([Stage("a", fail_on_two, 2), Stage("b", lambda x: x, 1)])
+        pipeline.run(range(5), received.append, on_error=lambda item, e: errors.append(item))
+        
+        self.assertEqual(received, [0, 1, 3, 4])
+        self.assertEqual(errors, [2])
+        self.assertEqual(pipeline.failed['a'], 1)
+        self.assertEqual(pipeline.processed['b'], 4)
+    
+    def test_queue_bounded(self):
+        """Test that a slow sink holds back the earlier stages"""
+        in_flight = []
+        lock = threading.Lock()
+        started = [0]
+        
+        def count(item):
+            with lock:
+                started[0] += 1
+            return item
+        
+        def sink(item):
+            in_flight.append(started[0] - item)
+            time.sleep(0.01)
+        
+        Pipeline([Stage("a", count)], queue_size=2).run(range(30), sink)
+        
+        # Items ahead of the sink: at most the queue, the worker and the sink's own
+        self.assertLessEqual(max(in_flight), 5)
+    
+    def test_empty_input(self):
+        """Test that an empty input finishes immediately"""
+        self.assertEqual(Pipeline([Stage("a", lambda x: x, 2)]).run([], mock.Mock()), 0)
+
+
+class TestCheckUpdatesPipeline(unittest.TestCase):
+    """Test cases for check_updates running through the pipeline"""
+    
+    def test_delivery_order(self):
+        """Test that a slow early download does not reorder Telegram messages"""
+        comms = [{'evtId': str(i), 'evtText': f"Circolare {i}"} for i in range(6)]
+        
+        mon = ClasseVivaMonitor("test@example.com", "testpass", detector=mock.Mock())
+        mon.detector.detect_classes_in_text.return_value = set()
+        mon.fetch_communications = mock.Mock(return_value=comms)
+        
+        def download(job):
+            time.sleep(0.1 if job['comm']['evtId'] == '0' else 0.0)
+            job['documents'] = []
+            return job
+        mon.download_stage = download
+        
+        sent = []
+        with mock.patch.object(monitor.TelegramNotifier, 'send_message',
+                               lambda self, text, chat_id=None: sent.append(text) or True), \
+                mock.patch.object(monitor, 'save_state'):
+            state = {'sent_hashes': []}
+            self.assertEqual(mon.check_updates(state), 6)
+        
+        self.assertEqual([text.count(f"Circolare {i}") for i, text in enumerate(sent)], [1] * 6)
+        self.assertEqual(len(state['sent_hashes']), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Unit tests for the adaptive polling interval
+"""
+
+import unittest
+from datetime import datetime
+
+import pytz
+
+from polling import AdaptiveInterval
+
+ROME = pytz.timezone('Europe/Rome')
+
+
+def rome(day: int, hour: int, minute: int = 0) -> float:
+    """Timestamp of a time in October 2026, Europe/Rome"""
+    return ROME.localize(datetime(2026, 10, day, hour, minute)).timestamp()
+
+
+class FakeClock:
+    """Settable wall clock"""
+    
+    def __init__(self, now: float):
+        self.now = now
+    
+    def __call__(self) -> float:
+        return self.now
+
+
+class TestAdaptiveInterval(unittest.TestCase):
+    """Test cases for AdaptiveInterval"""
+    
+    def make(self, now: float, **kwargs) -> AdaptiveInterval:
+        self.clock = FakeClock(now)
+        kwargs.setdefault('rand', lambda: 0.5)
+        return AdaptiveInterval(60, ROME, active_hours=(7, 19), active_weekdays=range(5),
+                                recent_window=1800, idle_max=1800, error_max=900,
+                                clock=self.clock, **kwargs)
+    
+    def test_school_hours_fast(self):
+        """Test that a weekday morning keeps the base interval"""
+        policy = self.make(rome(14, 10))
+        self.assertEqual([policy.next_interval() for _ in range(3)], [60, 60, 60])
+    
+    def test_night_backoff(self):
+        """Test that the interval doubles at night up to idle_max"""
+        policy = self.make(rome(14, 21))
+        intervals = [policy.next_interval() for _ in range(7)]
+        self.assertEqual(intervals, [120, 240, 480, 960, 1800, 1800, 1800])
+    
+    def test_back_on_time_in_the_morning(self):
+        """Test that the backoff never sleeps past the start of school hours"""
+        policy = self.make(rome(15, 6, 55))
+        policy.idle_polls = 10
+        self.assertEqual(policy.next_interval(), 300)
+    
+    def test_weekend_slow(self):
+        """Test that Saturday counts as idle and Monday morning is the next active time"""
+        policy = self.make(rome(17, 10))
+        self.assertFalse(policy.is_active(self.clock.now))
+        self.assertEqual(policy.until_active(rome(16, 20)), rome(19, 7) - rome(16, 20))
+        self.assertEqual(policy.next_interval(), 120)
+    
+    def test_recent_activity_fast(self):
+        """Test that new communications keep polling fast outside school hours"""
+        policy = self.make(rome(14, 22))
+        policy.idle_polls = 5
+        self.assertEqual(policy.next_interval(new_count=2), 60)
+        
+        self.clock.now += 1200
+        self.assertEqual(policy.next_interval(), 60)
+        self.clock.now += 1200
+        self.assertEqual(policy.next_interval(), 120)
+    
+    def test_error_backoff(self):
+        """Test that consecutive errors back off up to error_max and reset on success"""
+        policy = self.make(rome(14, 10))
+        intervals = [policy.next_interval(error=RuntimeError()) for _ in range(5)]
+        self.assertEqual(intervals, [120, 240, 480, 900, 900])
+        self.assertEqual(policy.next_interval(), 60)
+    
+    def test_jitter(self):
+        """Test that jitter spreads the interval by the configured fraction"""
+        low = self.make(rome(14, 10), rand=lambda: 0.0, jitter=0.1).next_interval()
+        high = self.make(rome(14, 10), rand=lambda: 0.999, jitter=0.1).next_interval()
+        self.assertAlmostEqual(low, 54)
+        self.assertAlmostEqual(high, 66, places=1)
+
+
+if __name__ == '__main__':
+    unittest.main()
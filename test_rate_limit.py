@@ -0,0 +1,102 @@
+"""
+Unit tests for Telegram rate limiting
+"""
+
+import unittest
+
+from rate_limit import TokenBucket, RateLimiter
+
+
+class FakeClock:
+    """Manually advanced clock; sleeping just moves time forward"""
+    
+    def __init__(self):
+        self.now = 100.0
+    
+    def __call__(self) -> float:
+        return self.now
+    
+    def sleep(self, seconds: float):
+        self.now += seconds
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test cases for TokenBucket"""
+    
+    def setUp(self):
+        self.clock = FakeClock()
+    
+    def test_burst_then_rate(self):
+        """Test that the capacity is free and later tokens follow the rate"""
+        bucket = TokenBucket(rate=2, capacity=3, clock=self.clock)
+        waits = [bucket.reserve() for _ in range(5)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 0.5)
+        self.assertAlmostEqual(waits[4], 1.0)
+    
+    def test_refill(self):
+        """Test that tokens come back over time, up to the capacity"""
+        bucket = TokenBucket(rate=1, capacity=2, clock=self.clock)
+        bucket.reserve()
+        bucket.reserve()
+        self.clock.now += 10
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertAlmostEqual(bucket.reserve(), 1.0)
+    
+    def test_pause(self):
+        """Test that a pause holds every token until it ends"""
+        bucket = TokenBucket(rate=1, capacity=5, clock=self.clock)
+        bucket.pause(7)
+        self.assertAlmostEqual(bucket.reserve(), 7.0)
+        self.assertAlmostEqual(bucket.reserve(), 8.0)
+        
+        self.clock.now += 20
+        self.assertEqual(bucket.reserve(), 0)
+
+
+class TestRateLimiter(unittest.TestCase):
+    """Test cases for RateLimiter"""
+    
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = RateLimiter(global_rate=10, chat_rate=1, chat_burst=2,
+                                   clock=self.clock, sleep=self.clock.sleep)
+    
+    def test_chat_paced(self):
+        """Test that one chat is held to its own rate"""
+        start = self.clock.now
+        for _ in range(5):
+            self.limiter.acquire("42")
+        # Two burst tokens, then one per second
+        self.assertAlmostEqual(self.clock.now - start, 3.0)
+    
+    def test_chats_independent(self):
+        """Test that a busy chat does not slow down another one"""
+        self.limiter.acquire("1")
+        self.limiter.acquire("1")
+        start = self.clock.now
+        self.limiter.acquire("2")
+        self.assertEqual(self.clock.now, start)
+    
+    def test_global_cap(self):
+        """Test that many chats together stay under the global rate"""
+        start = self.clock.now
+        for chat in range(30):
+            self.limiter.acquire(str(chat))
+        self.assertAlmostEqual(self.clock.now - start, 2.0)
+    
+    def test_retry_after(self):
+        """Test that a 429 pauses only the chat it was returned for"""
+        self.limiter.pause("42", 5)
+        start = self.clock.now
+        self.limiter.acquire("7")
+        self.assertEqual(self.clock.now, start)
+        
+        self.limiter.acquire("42")
+        self.assertAlmostEqual(self.clock.now - start, 5.0)
+        self.assertEqual(self.limiter.throttled, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,276 @@
+"""
+Unit tests for SessionManager module
+"""
+
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+
+import monitor as monitor_module
+from session_manager import SessionManager, is_auth_failure
+from monitor import ClasseVivaMonitor
+
+
+class FakeClient:
+    """Minimal client exposing login() and session cookies"""
+    
+    def __init__(self, results=None):
+        self.results = list(results or [True])
+        self.calls = 0
+        self.username = "test@example.com"
+        self.phpsessid = None
+        self.webidentity = None
+    
+    def login(self):
+        self.calls += 1
+        success = self.results.pop(0) if self.results else True
+        if success:
+            self.phpsessid = f"sess{self.calls}"
+            self.webidentity = "S123W"
+        return success
+
+
+class TestSessionManager(unittest.TestCase):
+    """Test cases for SessionManager"""
+    
+    def test_session_reused_until_invalidated(self):
+        """Test that a valid session is reused without logging in again"""
+        manager = SessionManager(ttl=3600)
+        client = FakeClient()
+        
+        self.assertTrue(manager.ensure(client))
+        self.assertTrue(manager.ensure(client))
+        self.assertTrue(manager.ensure(client))
+        self.assertEqual(client.calls, 1)
+        self.assertEqual(manager.stats()['reused'], 2)
+        
+        manager.invalidate("auth")
+        self.assertTrue(manager.ensure(client))
+        self.assertEqual(client.calls, 2)
+        self.assertEqual(manager.stats()['relogins'], 1)
+        self.assertEqual(manager.stats()['relogin_reasons'], {'auth': 1})
+    
+    def test_ttl_expiry(self):
+        """Test that the session is refreshed once the TTL elapses"""
+        manager = SessionManager(ttl=10)
+        client = FakeClient()
+        
+        with mock.patch('session_manager.time.monotonic', return_value=100.0):
+            manager.ensure(client)
+        with mock.patch('session_manager.time.monotonic', return_value=105.0):
+            manager.ensure(client)
+        self.assertEqual(client.calls, 1)
+        
+        with mock.patch('session_manager.time.monotonic', return_value=111.0):
+            manager.ensure(client)
+        self.assertEqual(client.calls, 2)
+        self.assertEqual(manager.stats()['relogin_reasons'], {'ttl': 1})
+    
+    def test_failed_login(self):
+        """Test that failed logins are counted and not treated as valid"""
+        manager = SessionManager()
+        client = FakeClient([False, True])
+        
+        self.assertFalse(manager.ensure(client))
+        self.assertFalse(manager.is_valid())
+        self.assertTrue(manager.ensure(client))
+        
+        stats = manager.stats()
+        self.assertEqual(stats['failed_logins'], 1)
+        self.assertEqual(stats['logins'], 1)
+        self.assertEqual(stats['relogins'], 0)
+    
+    def test_session_cache_roundtrip(self):
+        """Test that cookies survive a restart through the session cache"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, "session_cache.json")
+            
+            SessionManager(cache_file=cache_file).ensure(FakeClient())
+            
+            restarted = FakeClient()
+            manager = SessionManager(cache_file=cache_file)
+            self.assertTrue(manager.restore(restarted))
+            self.assertEqual(restarted.phpsessid, "sess1")
+            self.assertEqual(restarted.webidentity, "S123W")
+            self.assertTrue(manager.ensure(restarted))
+            self.assertEqual(restarted.calls, 0)
+    
+    def test_session_cache_expired(self):
+        """Test that expired cached cookies are ignored"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, "session_cache.json")
+            SessionManager(ttl=10, cache_file=cache_file).ensure(FakeClient())
+            
+            client = FakeClient()
+            with mock.patch('session_manager.time.time', return_value=4102444800.0):
+                self.assertFalse(SessionManager(cache_file=cache_file).restore(client))
+            self.assertIsNone(client.phpsessid)
+    
+    def test_session_cache_missing_or_corrupt(self):
+        """Test that a missing or corrupt cache falls back to login"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, "session_cache.json")
+            self.assertFalse(SessionManager(cache_file=cache_file).restore(FakeClient()))
+            
+            with open(cache_file, 'w') as f:
+                f.write("{not json")
+            self.assertFalse(SessionManager(cache_file=cache_file).restore(FakeClient()))
+    
+    def test_is_auth_failure(self):
+        """Test detection of expired session responses"""
+        def response(status=200, url="https://web.spaggiari.eu/sif/app/default/bacheca_personale.php",
+                     content_type="application/json"):
+            return mock.Mock(status_code=status, url=url, history=[],
+                             headers={'Content-Type': content_type})
+        
+        self.assertFalse(is_auth_failure(response()))
+        self.assertTrue(is_auth_failure(response(status=401)))
+        self.assertTrue(is_auth_failure(response(status=403)))
+        self.assertTrue(is_auth_failure(response(url="https://web.spaggiari.eu/auth-p7/app/default/login.php")))
+        
+        # An HTML Content-Type alone is not enough, the body must be the login page
+        html = "text/html; charset=UTF-8"
+        self.assertFalse(is_auth_failure(response(content_type=html)))
+        self.assertFalse(is_auth_failure(response(content_type=html), b"<html>Errore interno</html>"))
+        self.assertTrue(is_auth_failure(response(content_type=html),
+                                        b'<form action="/auth-p7/app/default/AuthApi4.php">'))
+        self.assertTrue(is_auth_failure(response(), b'<input TYPE="password" name="pass">'))
+        self.assertFalse(is_auth_failure(response(), b'{"data": [{"evtText": "vedi auth-p7"}]}'))
+
+
+class TestFetchCommunications(unittest.TestCase):
+    """Test session reuse in ClasseVivaMonitor.fetch_communications"""
+    
+    def setUp(self):
+        self.monitor = ClasseVivaMonitor("test@example.com", "testpass")
+        self.monitor.login = mock.Mock(return_value=True)
+    
+    def test_login_once_across_polls(self):
+        """Test that consecutive polls share one login"""
+        self.monitor.get_communications = mock.Mock(return_value=[{'evtId': 1}])
+        
+        for _ in range(5):
+            self.assertEqual(self.monitor.fetch_communications(), [{'evtId': 1}])
+        
+        self.assertEqual(self.monitor.login.call_count, 1)
+        self.assertEqual(self.monitor.get_communications.call_count, 5)
+    
+    def test_relogin_on_auth_failure(self):
+        """Test that an expired session triggers a single re-login and retry"""
+        self.monitor.fetch_communications()
+        
+        def expired_then_ok(ncna=1):
+            if not expired_then_ok.done:
+                expired_then_ok.done = True
+                self.monitor.auth_expired = True
+                return []
+            self.monitor.auth_expired = False
+            return [{'evtId': 2}]
+        expired_then_ok.done = False
+        self.monitor.get_communications = expired_then_ok
+        
+        self.assertEqual(self.monitor.fetch_communications(), [{'evtId': 2}])
+        self.assertEqual(self.monitor.login.call_count, 2)
+        self.assertEqual(self.monitor.session_manager.stats()['relogin_reasons'], {'auth': 1})
+    
+    def test_cached_session_probe(self):
+        """Test that a restored session is probed before logging in"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache_file = os.path.join(tmpdir, "session_cache.json")
+            client = FakeClient()
+            SessionManager(cache_file=cache_file).ensure(client)
+            
+            monitor = ClasseVivaMonitor(client.username, "testpass", session_cache_file=cache_file)
+            monitor.login = mock.Mock(return_value=True)
+            monitor.get_communications = mock.Mock(return_value=[{'evtId': 3}])
+            
+            self.assertEqual(monitor.fetch_communications(), [{'evtId': 3}])
+            self.assertEqual(monitor.phpsessid, "sess1")
+            monitor.login.assert_not_called()
+            self.assertEqual(monitor.session_manager.stats()['restored'], 1)
+
+
+class TestResponseFingerprint(unittest.TestCase):
+    """Test that check_updates skips responses identical to the last processed one"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.monitor = ClasseVivaMonitor("test@example.com", "testpass", detector=mock.Mock(),
+                                         notifier=mock.Mock(),
+                                         session_cache_file=os.path.join(self.tmpdir.name, "session.json"))
+        self.monitor.detector.detect_classes_in_text.return_value = set()
+        self.monitor.login = mock.Mock(return_value=True)
+        self.monitor.phpsessid, self.monitor.webidentity = "sess", "S123W"
+        self.monitor.session = mock.Mock()
+        self.monitor.notify_communication = mock.Mock(return_value=True)
+        self.state = {'sent_hashes': []}
+        
+        patches = [mock.patch.object(monitor_module, 'save_state'),
+                   mock.patch.object(monitor_module, 'RETENTION_MAX_AGE_DAYS', 0),
+                   mock.patch.object(monitor_module, 'RETENTION_MAX_ENTRIES', 0)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def respond(self, data):
+        body = json.dumps(data).encode()
+        self.monitor.session.post.return_value = mock.Mock(
+            status_code=200, history=[], content=body,
+            url="https://web.spaggiari.eu/sif/app/default/bacheca_personale.php",
+            headers={'Content-Type': 'application/json'})
+    
+    def test_identical_body_not_parsed(self):
+        """Test that an unchanged response costs one request and one hash"""
+        self.respond({'data': [{'evtId': 1}, {'evtId': 2}]})
+        self.assertEqual(self.monitor.check_updates(self.state), 2)
+        
+        self.respond({'data': [{'evtId': 1}, {'evtId': 2}]})
+        with mock.patch('json_codec.loads') as loads:
+            self.assertEqual(self.monitor.check_updates(self.state), 0)
+        
+        loads.assert_not_called()
+        self.assertEqual(self.monitor.notify_communication.call_count, 2)
+        self.assertEqual((self.monitor.fingerprint_hits, self.monitor.fingerprint_misses), (1, 1))
+    
+    def test_same_ids_new_body(self):
+        """Test that a body differing only outside the IDs counts as unchanged"""
+        self.respond({'data': [{'evtId': 1}], 'ts': 1})
+        self.monitor.check_updates(self.state)
+        self.respond({'data': [{'evtId': 1}], 'ts': 2})
+        self.assertEqual(self.monitor.check_updates(self.state), 0)
+        self.assertEqual(self.monitor.fingerprint_hits, 1)
+        
+        self.respond({'data': [{'evtId': 1}, {'evtId': 3}], 'ts': 2})
+        self.assertEqual(self.monitor.check_updates(self.state), 1)
+        self.assertEqual(self.monitor.fingerprint_misses, 2)
+    
+    def test_login_page_expires_session(self):
+        """Test that a login page or a body that is not JSON forces a new login"""
+        for body in (b'<html><input type="password" name="pass"></html>', b"<html>Manutenzione</html>"):
+            self.monitor.session.post.return_value = mock.Mock(
+                status_code=200, history=[], content=body,
+                url="https://web.spaggiari.eu/sif/app/default/bacheca_personale.php",
+                headers={'Content-Type': 'text/html'})
+            self.monitor.auth_expired = False
+            self.assertEqual(self.monitor.get_communications(), [])
+            self.assertTrue(self.monitor.auth_expired)
+    
+    def test_not_committed_after_failure(self):
+        """Test that a response is processed again until every send succeeds"""
+        self.monitor.notify_communication.return_value = False
+        self.respond({'data': [{'evtId': 1}]})
+        self.assertEqual(self.monitor.check_updates(self.state), 0)
+        
+        self.monitor.notify_communication.return_value = True
+        self.respond({'data': [{'evtId': 1}]})
+        self.assertEqual(self.monitor.check_updates(self.state), 1)
+        self.assertEqual(self.monitor.fingerprint_hits, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,266 @@
+"""
+Unit tests for state store backends
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+import unittest
+
+from dedupe_index import DedupeIndex
+from state_store import JsonStateStore, SqliteStateStore, JournalStateStore, create_state_store
+
+
+def md5(value) -> str:
+    return hashlib.md5(str(value).encode()).hexdigest()
+
+
+class TestJsonStateStore(unittest.TestCase):
+    """Test cases for JsonStateStore"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "state.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_roundtrip(self):
+        """Test saving and loading state"""
+        store = JsonStateStore(self.path)
+        self.assertEqual(len(store.load()['sent_hashes']), 0)
+        
+        store.save({'sent_hashes': DedupeIndex([md5(1)]), 'last_check': 'x'})
+        state = JsonStateStore(self.path).load()
+        self.assertEqual(state['sent_hashes'], [md5(1)])
+        self.assertEqual(state['last_check'], 'x')
+    
+    def test_unchanged_state_not_rewritten(self):
+        """Test that saving an unchanged state skips the write"""
+        store = JsonStateStore(self.path)
+        state = {'sent_hashes': DedupeIndex([md5(1)])}
+        store.save(state)
+        
+        os.remove(self.path)
+        store.save(state)
+        self.assertFalse(os.path.exists(self.path))
+        
+        state['sent_hashes'].add(md5(2))
+        store.save(state)
+        self.assertTrue(os.path.exists(self.path))
+
+
+class TestSqliteStateStore(unittest.TestCase):
+    """Test cases for SqliteStateStore"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmpdir.name, "state.db")
+        self.json_path = os.path.join(self.tmpdir.name, "state.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_wal_mode(self):
+        """Test that the database runs in WAL mode"""
+        store = SqliteStateStore(self.db_path)
+        mode = store.conn.execute("PRAGMA journal_mode").fetchone()[0]
+        self.assertEqual(mode, 'wal')
+        store.close()
+    
+    def test_incremental_save(self):
+        """Test that only new hashes are written, with their metadata"""
+        store = SqliteStateStore(self.db_path)
+        state = store.load()
+        state['sent_hashes'].add(md5(1), {'comm_id': '1', 'sent_at': 100.0, 'classes': ['3AB', '1AA']})
+        store.save(state)
+        
+        statements = []
+        store.conn.set_trace_callback(statements.append)
+        store.save(state)
+        self.assertEqual(statements, [])
+        
+        state['sent_hashes'].add(md5(2), {'comm_id': '2', 'sent_at': 200.0})
+        store.save(state)
+        inserts = [s for s in statements if s.startswith("INSERT OR IGNORE INTO sent")]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn(md5(2), inserts[0])
+        store.conn.set_trace_callback(None)
+        
+        self.assertEqual(store.get_sent(md5(1)), {'comm_id': '1', 'sent_at': 100.0, 'classes': ['1AA', '3AB']})
+        self.assertIsNone(store.get_sent(md5(3)))
+        store.close()
+        
+        reloaded = SqliteStateStore(self.db_path).load()
+        self.assertEqual(reloaded['sent_hashes'], [md5(1), md5(2)])
+    
+    def test_evicted_hashes_deleted(self):
+        """Test that pruned hashes are removed from the database"""
+        store = SqliteStateStore(self.db_path)
+        state = store.load()
+        state['sent_hashes'].add(md5(1), {'sent_at': 100.0})
+        state['sent_hashes'].add(md5(2), {'sent_at': 900.0})
+        store.save(state)
+        
+        state = store.load()
+        self.assertEqual(state['sent_hashes'].sent_at(md5(1)), 100.0)
+        state['sent_hashes'].prune(max_age=500, now=1000.0)
+        store.save(state)
+        store.close()
+        
+        self.assertEqual(SqliteStateStore(self.db_path).load()['sent_hashes'], [md5(2)])
+    
+    def test_extra_keys(self):
+        """Test that other state keys are stored and removed"""
+        store = SqliteStateStore(self.db_path)
+        state = store.load()
+        state['last_check'] = '2025-01-15 10:00:00'
+        store.save(state)
+        self.assertEqual(SqliteStateStore(self.db_path).load()['last_check'], '2025-01-15 10:00:00')
+        
+        del state['last_check']
+        store.save(state)
+        self.assertNotIn('last_check', SqliteStateStore(self.db_path).load())
+    
+    def test_json_migration(self):
+        """Test the one-shot migration from state.json"""
+        with open(self.json_path, 'w') as f:
+            json.dump({'sent_hashes': [md5(1), md5(2)], 'last_check': 'x'}, f)
+        
+        state = create_state_store('sqlite', self.json_path, self.db_path).load()
+        self.assertEqual(state['sent_hashes'], [md5(1), md5(2)])
+        self.assertEqual(state['last_check'], 'x')
+        self.assertFalse(os.path.exists(self.json_path))
+        self.assertTrue(os.path.exists(self.json_path + ".migrated"))
+        
+        # A state.json appearing later is not imported again
+        with open(self.json_path, 'w') as f:
+            json.dump({'sent_hashes': [md5(3)]}, f)
+        state = SqliteStateStore(self.db_path, json_path=self.json_path).load()
+        self.assertNotIn(md5(3), state['sent_hashes'])
+    
+    def test_unknown_backend(self):
+        """Test that an unknown backend name is rejected"""
+        with self.assertRaises(ValueError):
+            create_state_store('redis', self.json_path, self.db_path)
+
+
+
+class TestJournalStateStore(unittest.TestCase):
+    """Test cases for JournalStateStore"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "state.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def journal_lines(self):
+        with open(self.path + ".journal") as f:
+            return f.read().splitlines()
+    
+    def test_appends_only_new_items(self):
+        """Test that each save appends one line per new hash"""
+        store = JournalStateStore(self.path)
+        state = store.load()
+        state['sent_hashes'].add(md5(1), {'sent_at': 100.0})
+        state['sent_hashes'].add(md5(2))
+        store.save(state)
+        store.save(state)
+        self.assertEqual(len(self.journal_lines()), 2)
+        self.assertEqual(json.loads(self.journal_lines()[0]), {'op': 'add', 'hash': md5(1), 'sent_at': 100.0})
+        
+        state['sent_hashes'].add(md5(3))
+        state['last_check'] = 'x'
+        store.save(state)
+        self.assertEqual(len(self.journal_lines()), 4)
+        self.assertFalse(os.path.exists(self.path))
+        store.close()
+        
+        state = JournalStateStore(self.path).load()
+        self.assertEqual(state['sent_hashes'], [md5(1), md5(2), md5(3)])
+        self.assertEqual(state['last_check'], 'x')
+    
+    def test_evictions_replayed(self):
+        """Test that pruned hashes stay evicted after replaying the journal"""
+        store = JournalStateStore(self.path)
+        state = store.load()
+        state['sent_hashes'].add(md5(1), {'sent_at': 100.0})
+        state['sent_hashes'].add(md5(2), {'sent_at': 900.0})
+        store.save(state)
+        state['sent_hashes'].prune(max_age=500, now=1000.0)
+        store.save(state)
+        store.close()
+        
+        state = JournalStateStore(self.path).load()
+        self.assertEqual(state['sent_hashes'], [md5(2)])
+        self.assertEqual(state['sent_hashes'].sent_at(md5(2)), 900.0)
+    
+    def test_compaction(self):
+        """Test that the journal is folded into the snapshot"""
+        store = JournalStateStore(self.path, compact_threshold=3)
+        state = store.load()
+        for i in range(5):
+            state['sent_hashes'].add(md5(i))
+            store.save(state)
+        store.close()
+        
+        self.assertTrue(os.path.exists(self.path))
+        self.assertFalse(os.path.exists(self.path + ".journal.old"))
+        self.assertLess(len(self.journal_lines()), 3)
+        
+        reloaded = JournalStateStore(self.path).load()
+        self.assertEqual(reloaded['sent_hashes'], [md5(i) for i in range(5)])
+    
+    def test_torn_line_ignored(self):
+        """Test that a partially written last line does not break loading"""
+        store = JournalStateStore(self.path)
+        state = store.load()
+        state['sent_hashes'].add(md5(1))
+        store.save(state)
+        store.close()
+        
+        with open(self.path + ".journal", 'a') as f:
+            f.write('{"op":"add","ha')
+        
+        state = JournalStateStore(self.path).load()
+        self.assertEqual(state['sent_hashes'], [md5(1)])
+    
+    def test_append_after_torn_line(self):
+        """Test that entries saved after a torn line survive the next load"""
+        with open(self.path + ".journal", 'w') as f:
+            f.write('{"op":"add","hash":"%s"}\n{"torn' % md5(1))
+        
+        store = JournalStateStore(self.path)
+        state = store.load()
+        state['y'] = 2
+        store.save(state)
+        store.close()
+        
+        state = JournalStateStore(self.path).load()
+        self.assertEqual(state['y'], 2)
+        self.assertEqual(state['sent_hashes'], [md5(1)])
+    
+    def test_interrupted_compaction_recovered(self):
+        """Test that an old journal left by a crash is replayed and folded"""
+        with open(self.path, 'w') as f:
+            json.dump({'sent_hashes': [md5(1)]}, f)
+        with open(self.path + ".journal.old", 'w') as f:
+            f.write(json.dumps({'op': 'add', 'hash': md5(2)}) + "\n")
+        with open(self.path + ".journal", 'w') as f:
+            f.write(json.dumps({'op': 'add', 'hash': md5(3)}) + "\n")
+        
+        store = JournalStateStore(self.path)
+        state = store.load()
+        self.assertEqual(state['sent_hashes'], [md5(1), md5(2), md5(3)])
+        
+        store.compact(state, background=False)
+        store.close()
+        self.assertFalse(os.path.exists(self.path + ".journal.old"))
+        self.assertEqual(JournalStateStore(self.path).load()['sent_hashes'], [md5(1), md5(2), md5(3)])
+
+
+if __name__ == '__main__':
+    unittest.main()
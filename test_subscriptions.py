@@ -0,0 +1,71 @@
+"""
+Unit tests for the class -> chat subscription registry
+"""
+
+import os
+import json
+import tempfile
+import unittest
+
+from subscriptions import SubscriptionRegistry, ALL_CLASSES
+
+
+class TestSubscriptionRegistry(unittest.TestCase):
+    """Test cases for SubscriptionRegistry"""
+    
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "subscriptions.json")
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def test_routing(self):
+        """Test that a communication reaches the chats of its classes and the catch-all ones"""
+        registry = SubscriptionRegistry(self.path)
+        registry.subscribe("1", ["3AB", "4CD"])
+        registry.subscribe("2", ["4cd"])
+        registry.subscribe("3", [ALL_CLASSES])
+        
+        self.assertEqual(registry.chats_for({"3AB"}), {"1", "3"})
+        self.assertEqual(registry.chats_for({"4CD", "5EF"}), {"1", "2", "3"})
+        self.assertEqual(registry.chats_for(set()), {"3"})
+    
+    def test_persisted(self):
+        """Test that subscriptions survive a restart"""
+        SubscriptionRegistry(self.path).subscribe(42, ["1AA"])
+        
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {"42": ["1AA"]})
+        self.assertEqual(SubscriptionRegistry(self.path).chats_for({"1AA"}), {"42"})
+    
+    def test_default_chat(self):
+        """Test that the default chat gets everything only while no file exists"""
+        self.assertEqual(SubscriptionRegistry(self.path, default_chat="9").chats_for(set()), {"9"})
+        
+        SubscriptionRegistry(self.path).subscribe("1", ["1AA"])
+        self.assertEqual(SubscriptionRegistry(self.path, default_chat="9").chats_for(set()), set())
+    
+    def test_corrupt_file_uses_default_chat(self):
+        """Test that an unreadable file routes everything to the default chat instead of nobody"""
+        with open(self.path, 'w') as f:
+            f.write('{"1": ["3AB"')
+        self.assertEqual(SubscriptionRegistry(self.path, default_chat="9").chats_for({"3AB"}), {"9"})
+    
+    def test_unsubscribe(self):
+        """Test removing single classes and whole chats"""
+        registry = SubscriptionRegistry(self.path)
+        registry.subscribe("1", ["3AB", "4CD"])
+        registry.subscribe("2", ["3AB"])
+        
+        registry.unsubscribe("1", ["3AB"])
+        self.assertEqual(registry.chats_for({"3AB"}), {"2"})
+        self.assertEqual(registry.classes_of("1"), {"4CD"})
+        
+        registry.unsubscribe("1")
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(SubscriptionRegistry(self.path).chats_for({"4CD"}), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,440 @@
+"""
+Unit tests for TelegramNotifier connection handling
+Run against a local stand-in Bot API server
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import parse_qs
+
+from attachments import Attachment, FileIdCache
+from monitor import ClasseVivaMonitor, TelegramNotifier
+from rate_limit import RateLimiter
+from subscriptions import SubscriptionRegistry
+
+
+class FakeBotApi(BaseHTTPRequestHandler):
+    """Keep-alive Bot API stand-in recording the client port of each call"""
+    protocol_version = "HTTP/1.1"
+    
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        method = self.path.rsplit('/', 1)[-1]
+        self.server.calls.append((method, self.client_address[1]))
+        self.server.bodies.append(body)
+        
+        status = self.server.statuses.pop(0) if self.server.statuses else 200
+        reply = {'ok': status == 200}
+        if status == 429:
+            reply['parameters'] = {'retry_after': 3}
+        elif status == 400:
+            reply['description'] = getattr(self.server, 'description', "Bad Request: message is too long")
+        elif status == 200 and method == 'sendDocument':
+            reply['result'] = {'document': {'file_id': f"F{len(self.server.calls)}"}}
+        elif status == 200 and method == 'sendMediaGroup':
+            count = body.count(b'"type": "document"')
+            reply['result'] = [{'document': {'file_id': f"F{len(self.server.calls)}_{i}"}} for i in range(count)]
+        body = json.dumps(reply).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, *args):
+        pass
+
+
+class TestTelegramNotifier(unittest.TestCase):
+    """Test cases for the pooled Telegram session"""
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        self.server.calls = []
+        self.server.bodies = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        self.sleeps = []
+        self.limiter = RateLimiter(chat_rate=1000, chat_burst=1000, sleep=self.sleeps.append)
+        self.notifier = TelegramNotifier("token", "42", rate_limiter=self.limiter)
+        self.notifier.base_url = f"http://127.0.0.1:{self.server.server_port}/bottoken"
+    
+    def tearDown(self):
+        self.notifier.close()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_connection_reused(self):
+        """Test that a burst of notifications shares one connection"""
+        for i in range(5):
+            self.assertTrue(self.notifier.send_message(f"messaggio {i}"))
+        with Attachment.from_bytes("a.pdf", b"%PDF") as document:
+            self.assertTrue(self.notifier.send_document(document, caption="x"))
+        
+        ports = {port for _, port in self.server.calls}
+        self.assertEqual(len(self.server.calls), 6)
+        self.assertEqual(len(ports), 1)
+    
+    def test_retry_on_server_errors(self):
+        """Test that 5xx responses are retried"""
+        self.server.statuses = [503, 502]
+        with mock.patch('time.sleep'):
+            self.assertTrue(self.notifier.send_message("ciao"))
+        self.assertEqual(len(self.server.calls), 3)
+    
+    def test_429_rescheduled(self):
+        """Test that a 429 waits for retry_after and sends again"""
+        self.server.statuses = [429]
+        with Attachment.from_bytes("a.pdf", b"%PDF") as document:
+            self.assertTrue(self.notifier.send_document(document))
+        
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertEqual(self.limiter.throttled, 1)
+        self.assertGreaterEqual(max(self.sleeps), 2.9)
+    
+    def test_429_gives_up(self):
+        """Test that a chat throttled on every attempt reports a failure"""
+        self.server.statuses = [429] * 10
+        with mock.patch('monitor.TELEGRAM_SEND_ATTEMPTS', 3):
+            self.assertFalse(self.notifier.send_message("ciao"))
+        self.assertEqual(len(self.server.calls), 3)
+    
+    def test_failed_send_not_marked(self):
+        """Test that a communication whose send failed is retried next poll"""
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier)
+        monitor.fetch_communications = mock.Mock(return_value=[{'evtId': '1', 'evtText': 'x'}])
+        state = {'sent_hashes': []}
+        
+        self.server.statuses = [429] * 10
+        with mock.patch('monitor.TELEGRAM_SEND_ATTEMPTS', 2), mock.patch('monitor.save_state'):
+            self.assertEqual(monitor.check_updates(state), 0)
+            self.assertEqual(len(state['sent_hashes']), 0)
+            
+            self.server.statuses = []
+            self.assertEqual(monitor.check_updates(state), 1)
+            self.assertEqual(len(state['sent_hashes']), 1)
+    
+    def test_gives_up_after_max_retries(self):
+        """Test that a persistent failure is reported, not retried forever"""
+        self.notifier.close()
+        self.notifier.session = TelegramNotifier.create_session(pool_size=1, max_retries=1)
+        self.server.statuses = [500, 500, 500]
+        with mock.patch('time.sleep'):
+            self.assertFalse(self.notifier.send_message("ciao"))
+        self.assertEqual(len(self.server.calls), 2)
+    
+    def test_notifier_created_once(self):
+        """Test that check_updates reuses the monitor's notifier"""
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier)
+        monitor.fetch_communications = mock.Mock(return_value=[])
+        
+        with mock.patch('monitor.TelegramNotifier') as factory:
+            monitor.check_updates({'sent_hashes': []})
+            monitor.fetch_communications.return_value = [{'evtId': '1', 'evtText': 'x'}]
+            with mock.patch('monitor.save_state'):
+                monitor.check_updates({'sent_hashes': []})
+        factory.assert_not_called()
+        self.assertEqual(self.server.calls[0][0], 'sendMessage')
+
+
+class TestFileIdReuse(unittest.TestCase):
+    """Test cases for sending already uploaded documents by file_id"""
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        self.server.calls = []
+        self.server.bodies = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_ids = FileIdCache(os.path.join(self.temp_dir, "file_ids.json"))
+        limiter = RateLimiter(chat_rate=1000, chat_burst=1000, sleep=lambda seconds: None)
+        self.notifier = TelegramNotifier("token", "42", rate_limiter=limiter, file_ids=self.file_ids)
+        self.notifier.base_url = f"http://127.0.0.1:{self.server.server_port}/bottoken"
+        self.content = b"%PDF circolare " * 100
+    
+    def tearDown(self):
+        self.notifier.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+    
+    def test_second_send_by_file_id(self):
+        """Test that the same content is uploaded only once"""
+        for name in ("a.pdf", "copia.pdf"):
+            with Attachment.from_bytes(name, self.content) as document:
+                self.assertTrue(self.notifier.send_document(document, caption="x"))
+        
+        self.assertIn(self.content, self.server.bodies[0])
+        self.assertNotIn(self.content, self.server.bodies[1])
+        self.assertIn(b"document=F1", self.server.bodies[1])
+        self.assertEqual(self.file_ids.hits, 1)
+    
+    def test_stale_file_id_uploaded_again(self):
+        """Test that a file_id Telegram rejects is replaced by a new upload"""
+        with Attachment.from_bytes("a.pdf", self.content) as document:
+            self.file_ids.put(document.sha256, "OLD")
+            self.server.statuses = [400]
+            self.server.description = "Bad Request: wrong file identifier/HTTP URL specified"
+            self.assertTrue(self.notifier.send_document(document))
+            
+            self.assertEqual(len(self.server.calls), 2)
+            self.assertIn(self.content, self.server.bodies[1])
+            self.assertEqual(self.file_ids.get(document.sha256), "F2")
+    
+    def test_other_bad_request_keeps_file_id(self):
+        """Test that a 400 unrelated to the file_id neither re-uploads nor forgets it"""
+        with Attachment.from_bytes("a.pdf", self.content) as document:
+            self.file_ids.put(document.sha256, "OLD")
+            self.server.statuses = [400]
+            self.server.description = "Bad Request: message caption is too long"
+            self.assertFalse(self.notifier.send_document(document))
+            
+            self.assertEqual(len(self.server.calls), 1)
+            self.assertEqual(self.file_ids.get(document.sha256), "OLD")
+    
+    def test_stale_file_id_description(self):
+        """Test the descriptions recognised as a stale file_id"""
+        self.assertTrue(TelegramNotifier.stale_file_id(400, "Bad Request: wrong file identifier/HTTP URL specified"))
+        self.assertTrue(TelegramNotifier.stale_file_id(400, "Bad Request: invalid file_id"))
+        self.assertFalse(TelegramNotifier.stale_file_id(400, "Bad Request: message caption is too long"))
+        self.assertFalse(TelegramNotifier.stale_file_id(400, None))
+        self.assertFalse(TelegramNotifier.stale_file_id(500, "Bad Request: invalid file_id"))
+    
+    def test_media_group_mixed(self):
+        """Test that a media group uploads only the documents not sent before"""
+        known = Attachment.from_bytes("a.pdf", b"%PDF vecchio")
+        new = Attachment.from_bytes("b.pdf", b"%PDF nuovo")
+        self.file_ids.put(known.sha256, "KNOWN")
+        
+        self.assertTrue(self.notifier.send_media_group([known, new], caption="x"))
+        body = self.server.bodies[0]
+        self.assertNotIn(b"%PDF vecchio", body)
+        self.assertIn(b"%PDF nuovo", body)
+        self.assertIn(b"KNOWN", body)
+        self.assertIn(b"attach://attach_1", body)
+        self.assertEqual(self.file_ids.get(new.sha256), "F1_1")
+
+
+class TestDigest(unittest.TestCase):
+    """Test cases for digest mode"""
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        self.server.calls = []
+        self.server.bodies = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        limiter = RateLimiter(chat_rate=1000, chat_burst=1000, sleep=lambda seconds: None)
+        self.notifier = TelegramNotifier("token", "42", rate_limiter=limiter)
+        self.notifier.base_url = f"http://127.0.0.1:{self.server.server_port}/bottoken"
+    
+    def tearDown(self):
+        self.notifier.close()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_pack_messages(self):
+        """Test that texts fill messages up to the limit, in order"""
+        texts = [f"{i}" * 1500 for i in range(5)]
+        messages = TelegramNotifier.pack_messages(texts)
+        
+        self.assertEqual(len(messages), 3)
+        self.assertTrue(all(len(m) <= TelegramNotifier.MAX_MESSAGE_LENGTH for m in messages))
+        self.assertEqual("".join(messages).replace(TelegramNotifier.DIGEST_SEPARATOR, ""), "".join(texts))
+    
+    def test_long_text_split(self):
+        """Test that a text over the limit is split at line breaks"""
+        text = "\n".join(["riga" * 50] * 60)
+        messages = TelegramNotifier.pack_messages([text])
+        
+        self.assertGreater(len(messages), 1)
+        self.assertTrue(all(TelegramNotifier.message_length(m) <= TelegramNotifier.MAX_MESSAGE_LENGTH
+                            for m in messages))
+        self.assertTrue(all(m.startswith("riga") for m in messages))
+    
+    def test_long_text_split_keeps_html(self):
+        """Test that pieces never cut a tag or an entity and keep elements balanced"""
+        text = "<b>Titolo</b>\n" + "<i>" + "parola &amp; <a href=\"https://example.com\">link</a> " * 300 + "</i>\nfine"
+        messages = TelegramNotifier.split_text(text)
+        
+        self.assertGreater(len(messages), 1)
+        self.assertEqual(messages[0], "<b>Titolo</b>")
+        for message in messages:
+            self.assertLessEqual(TelegramNotifier.message_length(message), TelegramNotifier.MAX_MESSAGE_LENGTH)
+            self.assertEqual(message.count("<i>"), message.count("</i>"))
+            self.assertEqual(message.count("<a "), message.count("</a>"))
+            self.assertEqual(message.count("&"), message.count("&amp;"))
+            self.assertEqual(message.count("<"), message.count(">"))
+        self.assertTrue(messages[-1].endswith("</i>\nfine"))
+    
+    def test_emoji_counted_as_telegram_does(self):
+        """Test that characters outside the BMP count twice"""
+        self.assertEqual(TelegramNotifier.message_length("📌a"), 3)
+    
+    def test_check_updates_digest(self):
+        """Test that a burst becomes one message and media groups of ten"""
+        comms = [{'evtId': str(i), 'evtText': f"Circolare {i}"} for i in range(4)]
+        comms[1]['allegati'] = [{'allegato_id': str(100 + i), 'filename': f"{i}.pdf"} for i in range(11)]
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier,
+                                    detector=mock.Mock(**{'detect_classes_in_text.return_value': set(),
+                                                          'detect_classes_in_pdf.return_value': set()}))
+        monitor.fetch_communications = mock.Mock(return_value=comms)
+        monitor.download_attachment = lambda attachment_id, filename: Attachment.from_bytes(filename, b"%PDF")
+        state = {'sent_hashes': []}
+        
+        with mock.patch('monitor.DIGEST_MODE', True), mock.patch('monitor.save_state'):
+            self.assertEqual(monitor.check_updates(state), 4)
+        
+        self.assertEqual([method for method, _ in self.server.calls],
+                         ['sendMessage', 'sendMediaGroup', 'sendDocument'])
+        self.assertTrue(all(f"Circolare {i}".encode() in self.server.bodies[0] for i in range(4)))
+        self.assertEqual(len(state['sent_hashes']), 4)
+    
+    def test_digest_failure_not_marked(self):
+        """Test that a digest Telegram refuses is retried on the next check"""
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier,
+                                    detector=mock.Mock(**{'detect_classes_in_text.return_value': set()}))
+        monitor.fetch_communications = mock.Mock(return_value=[{'evtId': str(i)} for i in range(3)])
+        state = {'sent_hashes': []}
+        
+        self.server.statuses = [400]
+        with mock.patch('monitor.DIGEST_MODE', True), mock.patch('monitor.save_state'):
+            self.assertEqual(monitor.check_updates(state), 0)
+            self.assertEqual(len(state['sent_hashes']), 0)
+            self.assertEqual(monitor.check_updates(state), 3)
+    
+    
+    def test_digest_retry_skips_delivered_parts(self):
+        """Test that a partly sent digest resends only the parts that failed"""
+        comms = [{'evtId': str(i), 'evtText': f"Circolare {i}"} for i in range(3)]
+        comms[0]['allegati'] = [{'allegato_id': str(100 + i), 'filename': f"{i}.pdf"} for i in range(2)]
+        monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier,
+                                    detector=mock.Mock(**{'detect_classes_in_text.return_value': set(),
+                                                          'detect_classes_in_pdf.return_value': set()}))
+        monitor.fetch_communications = mock.Mock(return_value=comms)
+        monitor.download_attachment = lambda attachment_id, filename: Attachment.from_bytes(filename, filename.encode())
+        state = {'sent_hashes': []}
+        
+        self.server.statuses = [200, 400]
+        with mock.patch('monitor.DIGEST_MODE', True), mock.patch('monitor.save_state'):
+            self.assertEqual(monitor.check_updates(state), 0)
+            self.assertEqual(monitor.check_updates(state), 3)
+        
+        self.assertEqual([method for method, _ in self.server.calls],
+                         ['sendMessage', 'sendMediaGroup', 'sendMediaGroup'])
+        self.assertEqual(monitor._digest_parts, {})
+
+
+class TestFanOut(unittest.TestCase):
+    """Test cases for sending to every subscribed chat"""
+    
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeBotApi)
+        self.server.calls = []
+        self.server.bodies = []
+        self.server.statuses = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        
+        self.temp_dir = tempfile.mkdtemp()
+        self.file_ids = FileIdCache(os.path.join(self.temp_dir, "file_ids.json"))
+        limiter = RateLimiter(chat_rate=1000, chat_burst=1000, sleep=lambda seconds: None)
+        self.notifier = TelegramNotifier("token", "42", rate_limiter=limiter, file_ids=self.file_ids)
+        self.notifier.base_url = f"http://127.0.0.1:{self.server.server_port}/bottoken"
+        
+        self.subscriptions = SubscriptionRegistry(None)
+        self.subscriptions.subscribe("1", ["3AB"])
+        self.subscriptions.subscribe("2", ["3AB", "4CD"])
+        self.subscriptions.subscribe("3", ["4CD"])
+        detector = mock.Mock(**{'detect_classes_in_text.side_effect': lambda text: {text.split()[0]},
+                                'detect_classes_in_pdf.return_value': set()})
+        self.monitor = ClasseVivaMonitor("test@example.com", "testpass", notifier=self.notifier,
+                                         detector=detector, subscriptions=self.subscriptions)
+        self.monitor.download_attachment = lambda attachment_id, filename: Attachment.from_bytes(filename, b"%PDF 3AB")
+    
+    def tearDown(self):
+        self.notifier.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.temp_dir)
+    
+    def chats(self):
+        """Chat of every recorded call"""
+        chats = []
+        for body in self.server.bodies:
+            if body.startswith(b"{"):
+                chats.append(json.loads(body)['chat_id'])
+            elif body.startswith(b"chat_id="):
+                chats.append(parse_qs(body.decode())['chat_id'][0])
+            else:
+                chats.append(body.split(b'name="chat_id"\r\n\r\n')[1].split(b"\r\n")[0].decode())
+        return chats
+    
+    def test_routed_by_class(self):
+        """Test that each communication reaches only the chats of its classes"""
+        self.monitor.fetch_communications = mock.Mock(return_value=[
+            {'evtId': '1', 'evtText': '3AB gita'},
+            {'evtId': '2', 'evtText': '5ZZ nessuno'},
+        ])
+        self.monitor.commit_fingerprint = mock.Mock()
+        state = {'sent_hashes': []}
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 1)
+        
+        self.assertEqual(sorted(self.chats()), ["1", "2"])
+        # Nobody received 5ZZ: it is not marked as sent, but the response counts as processed
+        self.assertEqual(len(state['sent_hashes']), 1)
+        self.monitor.commit_fingerprint.assert_called_once()
+        
+        # Later polls do not scan it again while nobody is subscribed
+        scans = self.monitor.detector.detect_classes_in_text.call_count
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 0)
+        self.assertEqual(self.monitor.detector.detect_classes_in_text.call_count, scans)
+        
+        # Subscribing is enough, even if ClasseViva answers exactly as before
+        self.subscriptions.subscribe("5", ["5ZZ"])
+        listing = self.monitor.fetch_communications.return_value
+        self.monitor.fetch_communications.side_effect = lambda ncna: setattr(self.monitor, 'unchanged', True) or listing
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 1)
+        self.assertEqual(self.chats()[-1], "5")
+    
+    def test_one_upload_for_all_chats(self):
+        """Test that an attachment is uploaded once and referenced for the other chats"""
+        self.subscriptions.subscribe("4", ["3AB"])
+        self.monitor.fetch_communications = mock.Mock(return_value=[
+            {'evtId': '1', 'evtText': '3AB circolare', 'allegati': [{'allegato_id': '7', 'filename': 'c.pdf'}]},
+        ])
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates({'sent_hashes': []}), 1)
+        
+        self.assertEqual(sorted(self.chats()), ["1", "2", "4"])
+        uploads = [body for body in self.server.bodies if b"%PDF 3AB" in body]
+        self.assertEqual(len(uploads), 1)
+    
+    def test_partial_failure_resumes(self):
+        """Test that a retry only goes to the chats that did not get the message"""
+        self.monitor.fetch_communications = mock.Mock(return_value=[{'evtId': '1', 'evtText': '4CD avviso'}])
+        state = {'sent_hashes': []}
+        
+        self.server.statuses = [200, 400]
+        with mock.patch('monitor.save_state'):
+            self.assertEqual(self.monitor.check_updates(state), 0)
+            self.assertEqual(self.monitor.check_updates(state), 1)
+        
+        self.assertEqual(self.chats(), ["2", "3", "3"])
+
+
+if __name__ == '__main__':
+    unittest.main()